@@ -0,0 +1,414 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import argparse
+import contextlib
+import copy
+import importlib.util
+import io
+import json
+import os
+import time
+import numpy as np
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+from groundTruthFN import GroundTruthFN
+from nmsAnalysis import nmsAnalysis
+from plotRenderer import PlotRenderer, renderScaling
+from perClassNMS import PerClassNMS, greedyNMS
+
+###############################################################################
+
+# Stages timed by `Benchmark`. The [reference] stages run the original pycocotools path
+# (dict index, loadRes and per image dicts of evaluate) on the same detections, for comparison with the fast path.
+# The [loop] stages run one nms per category and image, for comparison with `PerClassNMS`.
+STAGES = ["NMS", "result writing", "pseudo-NMS", "loadRes", "evaluate", "accumulate",
+          "loadRes [reference]", "evaluate [reference]", "accumulate [reference]",
+          "per-class NMS", "per-class NMS [numpy loop]", "per-class NMS [tf loop]"]
+
+# Values of each parameter of `syntheticCoco` scaled by `python benchmark.py`.
+SCALINGS = {
+    "numberImages": [50, 100, 200, 400],
+    "numberCategories": [2, 5, 10, 20],
+    "boxesPerImage": [2, 8, 16, 32],
+    "crowdDensity": [0., 0.3, 0.6, 0.9],
+}
+
+
+def syntheticCoco(numberImages=100, numberCategories=5, boxesPerImage=8, crowdDensity=0.3, seed=0):
+    """
+    Generate a ground truth dataset in the coco format.
+    :param numberImages: number of images
+    :param numberCategories: number of categories, named `cat_1`, `cat_2`...
+    :param boxesPerImage: mean number of bbox per image (poisson distributed)
+    :param crowdDensity: probability for a bbox to be placed onto a previous bbox of the image, with the same category,
+                         instead of anywhere in the image. The higher the more the instances overlap.
+    :param seed: random seed to use
+    :return: dictionnary with keys "images", "annotations" and "categories"
+    """
+    random = np.random.RandomState(seed)
+    categories = [{"id": i + 1, "name": "cat_{}".format(i + 1), "supercategory": "synthetic"} for i in range(numberCategories)]
+    images = list()
+    annotations = list()
+    for imgId in range(1, numberImages + 1):
+        width, height = random.randint(320, 641, size=2)
+        images.append({"id": imgId, "file_name": "{:012d}.jpg".format(imgId), "width": int(width), "height": int(height)})
+        boxes = list()
+        for _ in range(random.poisson(boxesPerImage)):
+            if boxes and random.rand() < crowdDensity:
+                x, y, w, h, catId = boxes[random.randint(len(boxes))]
+                x, y = x + random.normal(0, 0.25) * w, y + random.normal(0, 0.25) * h
+                w, h = w * random.uniform(0.7, 1.3), h * random.uniform(0.7, 1.3)
+            else:
+                w, h = random.uniform(0.05, 0.4) * width, random.uniform(0.05, 0.4) * height
+                x, y = random.uniform(0, width - w), random.uniform(0, height - h)
+                catId = random.randint(1, numberCategories + 1)
+            x, y = min(max(x, 0.), width - 1.), min(max(y, 0.), height - 1.)
+            w, h = max(min(w, width - x), 1.), max(min(h, height - y), 1.)
+            boxes.append((x, y, w, h, catId))
+        for x, y, w, h, catId in boxes:
+            annotations.append({"id": len(annotations) + 1, "image_id": imgId, "category_id": int(catId),
+                                "bbox": [float(x), float(y), float(w), float(h)], "area": float(w * h), "iscrowd": 0})
+    return {"images": images, "annotations": annotations, "categories": categories}
+
+
+def syntheticDetections(dataset, recall=0.9, duplicates=2, falsePositives=0.5, seed=0):
+    """
+    Generate the detections of a model before nms for a dataset of `syntheticCoco`, in the format of
+    `nmsAnalysis.computeInferenceBbox`.
+    :param recall: probability for a ground truth bbox to be detected
+    :param duplicates: mean number of extra detections around a detected bbox (poisson distributed), the ones the nms must suppress
+    :param falsePositives: mean number of false positives per ground truth bbox
+    :param seed: random seed to use
+    :return: dictionnary {file_name: output_dict}
+    """
+    random = np.random.RandomState(seed)
+    numberCategories = len(dataset["categories"])
+    annotations = dict()
+    for ann in dataset["annotations"]:
+        annotations.setdefault(ann["image_id"], list()).append(ann)
+    all_output_dict = dict()
+    for img in dataset["images"]:
+        width, height = img["width"], img["height"]
+        detections = list()  # (x, y, w, h, score, class)
+        anns = annotations.get(img["id"], list())
+        for ann in anns:
+            if random.rand() > recall:
+                continue
+            x, y, w, h = ann["bbox"]
+            for i in range(1 + random.poisson(duplicates)):
+                jitter = random.normal(0, 0.03 if i == 0 else 0.12, size=4)
+                score = random.uniform(0.5, 1.) if i == 0 else random.uniform(0.1, 0.8)
+                detections.append((x + jitter[0] * w, y + jitter[1] * h, w * (1 + jitter[2]), h * (1 + jitter[3]), score, ann["category_id"]))
+        for _ in range(random.poisson(falsePositives * max(len(anns), 1))):
+            w, h = random.uniform(0.05, 0.4) * width, random.uniform(0.05, 0.4) * height
+            detections.append((random.uniform(0, width - w), random.uniform(0, height - h), w, h,
+                               random.uniform(0., 0.6), random.randint(1, numberCategories + 1)))
+        detections.sort(key=lambda detection: -detection[4])
+        boxes = [[min(max(y / height, 0.), 1.), min(max(x / width, 0.), 1.),
+                  min(max((y + h) / height, 0.), 1.), min(max((x + w) / width, 0.), 1.)] for x, y, w, h, _, _ in detections]
+        all_output_dict[img["file_name"]] = {
+            "detection_scores": [float(detection[4]) for detection in detections],
+            "detection_classes": [float(detection[5]) for detection in detections],
+            "detection_boxes": [[float(coordinate) for coordinate in box] for box in boxes],
+            "num_detections": len(detections),
+        }
+    return all_output_dict
+
+
+def writeSyntheticDataset(folder, seed=0, **settings):
+    """
+    Write a dataset of `syntheticCoco` and its detections in `folder`:
+
+    - folder/annotations.json
+    - folder/model/all_output_dict.json, read by `nmsAnalysis.load_all_output_dict` instead of running a model
+
+    :param settings: keyword arguments of `syntheticCoco`
+    :return: path of the annotation file, path of the model
+    """
+    modelPath = os.path.join(folder, "model")
+    if not os.path.isdir(modelPath):
+        os.makedirs(modelPath)
+    dataset = syntheticCoco(seed=seed, **settings)
+    annotationPath = os.path.join(folder, "annotations.json")
+    with open(annotationPath, "w") as fs:
+        json.dump(dataset, fs)
+    with open(os.path.join(modelPath, "all_output_dict.json"), "w") as fs:
+        json.dump(syntheticDetections(dataset, seed=seed), fs)
+    return annotationPath, modelPath
+
+
+class DictEvalImgs(list):
+
+    #The KxAxI list of per image dicts (or None) of the original `COCOeval.evaluate`, with the `block` read by
+    #`COCOeval.accumulate` rebuilt from the dicts the way the original accumulate did. It does not go through the
+    #columns, offsets and packed bits of `EvalImgs`, so a bug in them shows up as a difference with the fast path.
+
+    def block(self, start, i_list, maxDet):
+        """
+        :return: dtScores [D], dtMatches [TxD], dtIgnore [TxD] of the maxDet first detections and gtIgnore [G]
+                 of the entries start + i for i in i_list, see `EvalImgs.block`. None if they are all empty.
+        """
+        E = [self[start + i] for i in i_list]
+        E = [e for e in E if e is not None]
+        if len(E) == 0:
+            return None
+        return (np.concatenate([e['dtScores'][0:maxDet] for e in E]).astype(np.float64),
+                np.concatenate([e['dtMatches'][:, 0:maxDet] for e in E], axis=1),
+                np.concatenate([e['dtIgnore'][:, 0:maxDet] for e in E], axis=1),
+                np.concatenate([e['gtIgnore'] for e in E]))
+
+
+def referenceEvaluate(cocoEval):
+    """
+    Run `cocoEval.evaluate` the original way: one dict per category, area range and image built by `evaluateImg`,
+    stored in a `DictEvalImgs` instead of the packed `EvalImgs`.
+    :return: None
+    """
+    p = cocoEval.params
+    p.imgIds = list(np.unique(p.imgIds))
+    if p.useCats:
+        p.catIds = list(np.unique(p.catIds))
+    p.maxDets = sorted(p.maxDets)
+    cocoEval._prepare()
+    catIds = p.catIds if p.useCats else [-1]
+    cocoEval.ious = {(imgId, catId): cocoEval.computeIoU(imgId, catId) for imgId in p.imgIds for catId in catIds}
+    cocoEval.evalImgs = DictEvalImgs(cocoEval.evaluateImg(imgId, catId, areaRng, p.maxDets[-1])
+                                     for catId in catIds for areaRng in p.areaRng for imgId in p.imgIds)
+    cocoEval._paramsEval = copy.deepcopy(p)
+
+
+class Benchmark:
+
+    #The goal of this class is to measure how each stage of `nmsAnalysis` and `GroundTruthFN` scales with the number
+    #of images, categories and bbox per image, on synthetic datasets, and to check that the fast paths of
+    #pycocotools give the same AP and FN than the reference one.
+
+    #   Parameters:
+    #    folder:             - folder where the synthetic datasets and the results are written
+    #    number_IoU_thresh:  - number of different IoU treshold to analyse in between 0.2 and 0.9
+    #    timings:            - dictionnary {stage: seconds} filled by the current run
+    #    mismatches:         - list of the (category, IoU threshold, path) where the fast path differs from the reference
+
+    def __init__(self, folder="benchmark/", number_IoU_thresh=10):
+        """
+        Initialize Benchmark
+        :param folder: folder where the synthetic datasets and the results are written
+        :param number_IoU_thresh: number of different IoU treshold to analyse in between 0.2 and 0.9
+        :return: None
+        """
+        self.folder = folder
+        self.number_IoU_thresh = number_IoU_thresh
+        self.iou_thresholdXaxis = np.linspace(0.2, 0.9, number_IoU_thresh)
+        self.timings = dict()
+        self.mismatches = list()
+        self.plotter = PlotRenderer()
+
+    def _timed(self, stage, function, *args, **kwargs):
+        """
+        Call `function(*args, **kwargs)` and add its wall time to `self.timings[stage]`.
+        :return: the result of the function
+        """
+        tic = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.timings[stage] = self.timings.get(stage, 0.) + time.perf_counter() - tic
+        return result
+
+    def _evaluate(self, cocoGt, detections, imgIds, catId, iouThreshold, reference=False):
+        """
+        Evaluate the detections of a category the way `getClassAP` does.
+        :param reference: if set to True use `COCO.loadRes` instead of `COCO.loadResBbox`, and `referenceEvaluate`
+                          instead of the packed `COCOeval.evaluate`
+        :return: stats of COCOeval, number of false negatives, number of instances
+        """
+        suffix = " [reference]" if reference else ""
+        loadRes = cocoGt.loadRes if reference else cocoGt.loadResBbox
+        cocoDt = self._timed("loadRes" + suffix, loadRes, detections)
+        cocoEval = COCOeval(cocoGt, cocoDt, 'bbox')
+        cocoEval.params.imgIds = imgIds
+        cocoEval.params.catIds = catId
+        cocoEval.params.maxDets = [1, 10, 1000]
+        if reference:
+            self._timed("evaluate" + suffix, referenceEvaluate, cocoEval)
+            # count on the per image dicts of the original evaluate
+            number_FN = 0
+            instances_non_ignored = 0
+            for evalImg in cocoEval.evalImgs:
+                if evalImg is not None:
+                    number_FN += sum(evalImg["FN"])
+                    instances_non_ignored += sum(np.logical_not(evalImg['gtIgnore']))
+        else:
+            self._timed("evaluate" + suffix, cocoEval.evaluate)
+            number_FN = cocoEval.evalImgs.numberFN()
+            instances_non_ignored = cocoEval.evalImgs.numberInstances()
+        self._timed("accumulate" + suffix, cocoEval.accumulate, iouThreshold, withTrain=False)
+        cocoEval.summarize()
+        return cocoEval.stats, int(number_FN), int(instances_non_ignored)
+
+    def _check(self, referenceGt, fastGt, detections, imgIds, catId, iouThreshold, path):
+        """
+        Evaluate the detections with the fast and the reference path and record any difference in `self.mismatches`.
+        :return: None
+        """
+        if len(detections) == 0:
+            return
+        fast = self._evaluate(fastGt, detections, imgIds, catId, iouThreshold)
+        reference = self._evaluate(referenceGt, detections, imgIds, catId, iouThreshold, reference=True)
+        if not (np.allclose(fast[0], reference[0], equal_nan=True) and fast[1:] == reference[1:]):
+            self.mismatches.append((catId, float(iouThreshold), path))
+
+    def runGroundTruthFN(self, annotationPath, referenceGt):
+        """
+        Time the stages of `GroundTruthFN.getClassAP` for every category of the annotation file.
+        :return: None
+        """
+        fn = GroundTruthFN(annotationPath, dataType="validation", number_IoU_thresh=self.number_IoU_thresh)
+        for category in fn.categories:
+            fn._study["catStudied"] = category
+            fn.getImgClass(category)
+            for iouThreshold in fn.iou_thresholdXaxis:
+                fn._study["iouThreshold"] = iouThreshold
+                imgIds = self._timed("pseudo-NMS", fn.writeResToJson)
+                self._check(referenceGt, fn.coco, fn._study["detections"], imgIds, fn._study["catId"], iouThreshold, "GroundTruthFN")
+
+    def runNmsAnalysis(self, annotationPath, modelPath, referenceGt):
+        """
+        Time the stages of `nmsAnalysis.getClassAP` for every category of the annotation file, using the detections
+        written by `writeSyntheticDataset`. The time of `writeResJson` is split between the nms and the result writing.
+        :return: None
+        """
+        analyser = nmsAnalysis([modelPath], None, annotationPath, number_IoU_thresh=self.number_IoU_thresh)
+        analyser._study["modelPath"] = modelPath
+        analyser.load_all_output_dict()
+        computeNMS = analyser.computeNMS
+        analyser.computeNMS = lambda output_dict: self._timed("NMS", computeNMS, output_dict)
+        for category in analyser.categories:
+            analyser._study["catStudied"] = category
+            analyser.getImgClass(category)
+            for iouThreshold in analyser.iou_thresholdXaxis:
+                analyser._study["iouThreshold"] = iouThreshold
+                nmsTime = self.timings.get("NMS", 0.)
+                imgIds = self._timed("result writing", analyser.writeResJson)
+                self.timings["result writing"] -= self.timings.get("NMS", 0.) - nmsTime
+                self._check(referenceGt, analyser.coco, analyser._study["detections"], imgIds, analyser._study["catId"], iouThreshold, "nmsAnalysis")
+
+    def _loopNMS(self, outputs, engine, nms):
+        """
+        Apply `nms(boxes, scores, iouThreshold, maxOutput)` once per category of each image, with the thresholds of `engine`.
+        :return: list of the boolean arrays of the detections kept in each image
+        """
+        keeps = list()
+        for output_dict in outputs:
+            classes = np.asarray(output_dict["detection_classes"]).astype(np.int64)
+            keep = np.zeros((len(classes),), dtype=bool)
+            for catId in np.unique(classes):
+                index = np.flatnonzero(classes == catId)
+                selected = nms(np.asarray(output_dict["detection_boxes"])[index], np.asarray(output_dict["detection_scores"])[index],
+                               engine.thresholds.get(int(catId), engine.defaultThreshold), engine.maxOutput)
+                keep[index[np.asarray(selected, dtype=np.int64)]] = True
+            keeps.append(keep)
+        return keeps
+
+    def runPerClassNMS(self, modelPath, catIds):
+        """
+        Time `PerClassNMS` on all the images at once against one nms per category and image, with a different
+        IoU threshold for each category. The tensorflow loop is skipped without tensorflow.
+        :return: None
+        """
+        with open(modelPath + "/all_output_dict.json", "r") as fs:
+            outputs = [output_dict for output_dict in json.load(fs).values() if output_dict and output_dict["num_detections"]]
+        engine = PerClassNMS()
+        engine.thresholds = {catId: threshold for catId, threshold in zip(catIds, np.linspace(0.3, 0.8, len(catIds)))}
+        numDetections = np.array([output_dict["num_detections"] for output_dict in outputs], dtype=np.int64)
+        N = numDetections.max(initial=0)
+        boxes = np.zeros((len(outputs), N, 4))
+        scores = np.zeros((len(outputs), N))
+        classes = np.zeros((len(outputs), N), dtype=np.int64)
+        for i, output_dict in enumerate(outputs):
+            boxes[i, :numDetections[i]] = output_dict["detection_boxes"]
+            scores[i, :numDetections[i]] = output_dict["detection_scores"]
+            classes[i, :numDetections[i]] = output_dict["detection_classes"]
+        keep = self._timed("per-class NMS", engine.applyBatch, boxes, scores, classes, numDetections)
+        reference = self._timed("per-class NMS [numpy loop]", self._loopNMS, outputs, engine, greedyNMS)
+        if any(not np.array_equal(keep[i, :numDetections[i]], reference[i]) for i in range(len(outputs))):
+            self.mismatches.append((None, None, "PerClassNMS"))
+        if importlib.util.find_spec("tensorflow") is not None:
+            import tensorflow as tf
+            tfNMS = lambda boxes, scores, iouThreshold, maxOutput: tf.image.non_max_suppression(
+                boxes, scores, maxOutput, iou_threshold=float(iouThreshold)).numpy()
+            self._timed("per-class NMS [tf loop]", self._loopNMS, outputs, engine, tfNMS)
+
+    def run(self, seed=0, **settings):
+        """
+        Generate a synthetic dataset and time every stage on it. The nms and result writing stages need tensorflow
+        and are skipped without it.
+        :param settings: keyword arguments of `syntheticCoco`
+        :return: dictionnary {stage: seconds}
+        """
+        self.timings = dict()
+        self.mismatches = list()
+        name = "_".join("{}={}".format(key, value) for key, value in sorted(settings.items())) or "default"
+        folder = os.path.join(self.folder, name)
+        annotationPath, modelPath = writeSyntheticDataset(folder, seed=seed, **settings)
+        # the analysis classes write their results in the relative path
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            annotationPath, modelPath = os.path.basename(annotationPath), os.path.basename(modelPath)
+            with contextlib.redirect_stdout(io.StringIO()):
+                referenceGt = COCO(annotationPath)
+                self.runGroundTruthFN(annotationPath, referenceGt)
+                self.runPerClassNMS(modelPath, referenceGt.getCatIds())
+                if importlib.util.find_spec("tensorflow") is not None:
+                    self.runNmsAnalysis(annotationPath, modelPath, referenceGt)
+        finally:
+            os.chdir(cwd)
+        assert not self.mismatches, "The fast path differs from the reference for (catId, IoU threshold, class): {}".format(self.mismatches)
+        return dict(self.timings)
+
+    def scaling(self, parameter, values, **settings):
+        """
+        Run the benchmark for each value of a parameter of `syntheticCoco`, the others being fixed by `settings`.
+        The timings are written in `folder/scaling_{parameter}.json` and graphed in `folder/scaling_{parameter}.png`.
+        :param parameter: one of "numberImages", "numberCategories", "boxesPerImage", "crowdDensity"
+        :param values: list of values of the parameter
+        :return: dictionnary {stage: list of seconds for each value}
+        """
+        timings = {stage: list() for stage in STAGES}
+        for value in values:
+            settings[parameter] = value
+            result = self.run(**settings)
+            print("{} = {}: ".format(parameter, value) + ", ".join("{} {:0.3f}s".format(stage, result[stage]) for stage in STAGES if stage in result))
+            for stage in STAGES:
+                timings[stage].append(result.get(stage))
+        timings = {stage: seconds for stage, seconds in timings.items() if None not in seconds}
+        with open(os.path.join(self.folder, "scaling_{}.json".format(parameter)), "w") as fs:
+            json.dump({"parameter": parameter, "values": list(values), "settings": settings,
+                       "number_IoU_thresh": self.number_IoU_thresh, "timings": timings}, fs, indent=1)
+        self.plotter.submit(renderScaling, parameter, list(values), timings,
+                            os.path.join(self.folder, "scaling_{}.png".format(parameter)))
+        return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the analysis on synthetic datasets of growing size.")
+    parser.add_argument("--folder", default="benchmark/", help="folder where the synthetic datasets and the results are written")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic datasets")
+    parser.add_argument("--number_IoU_thresh", type=int, default=10, help="number of IoU thresholds in between 0.2 and 0.9")
+    parser.add_argument("--numberImages", type=int, default=100, help="number of images when it is not the parameter scaled")
+    parser.add_argument("--numberCategories", type=int, default=5, help="number of categories when it is not the parameter scaled")
+    parser.add_argument("--boxesPerImage", type=float, default=8, help="mean number of bbox per image when it is not the parameter scaled")
+    parser.add_argument("--crowdDensity", type=float, default=0.3, help="crowd density when it is not the parameter scaled")
+    parser.add_argument("--scaling", nargs="+", choices=sorted(SCALINGS), default=list(SCALINGS),
+                        help="parameters to scale, all by default, see `SCALINGS`")
+    args = parser.parse_args()
+    benchmark = Benchmark(args.folder, args.number_IoU_thresh)
+    try:
+        for parameter in args.scaling:
+            settings = {name: getattr(args, name) for name in SCALINGS if name != parameter}
+            benchmark.scaling(parameter, SCALINGS[parameter], seed=args.seed, **settings)
+    finally:
+        benchmark.plotter.close()
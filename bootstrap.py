@@ -0,0 +1,296 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import numpy as np
+
+###############################################################################
+
+# Recall thresholds of COCOeval, the AP is the mean of the precision at each of them.
+RECALL_THRESHOLDS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+
+
+def imageStatistics(cocoEval, maxDet=1000, iouThr=.5):
+    """
+    Extract from an evaluated COCOeval of a single category what is needed to recompute its AP[IoU=iouThr] for any
+    resampling of the images: the score and the true/false positive flag of each detection at IoU=iouThr, with its image,
+    and the number of non ignored instances of each image. Only the area range 'all' is used.
+    :param cocoEval: COCOeval after `evaluate` and `accumulate`
+    :param maxDet: maximal number of detections per image, the last of `params.maxDets`
+    :param iouThr: IoU threshold of the evaluation, one of `params.iouThrs`
+    :return: dictionnary with keys:
+
+    - "images": [D] position in `params.imgIds` of the image of each detection
+    - "scores": [D] score of each detection
+    - "tp", "fp": [D] true and false positive flags, both False for ignored detections
+    - "instances": [N] number of non ignored instances of each image of `params.imgIds`
+    - "nmsFN": [4] (fn_nms_validation, npig_val, fn_nms_train, npig_train) of the recall with train, NaN without
+    """
+    p = cocoEval.params
+    N = len(p.imgIds)
+    T = len(p.iouThrs)
+    t = np.where(iouThr == p.iouThrs)[0][0]
+    block = cocoEval.evalImgs.block(0, range(N), maxDet, images=True)
+    if block is None:
+        scores, dtm, dtIg, gtIg = np.zeros((0,)), np.zeros((T, 0)), np.zeros((T, 0), dtype=bool), np.zeros((0,), dtype=bool)
+        dtImages, gtImages = np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+    else:
+        scores, dtm, dtIg, gtIg, dtImages, gtImages = block
+    nmsFN = cocoEval.eval.get('nmsFN')
+    return {
+        "images": dtImages.astype(np.int32),
+        "scores": scores,
+        "tp": np.logical_and(dtm[t] > 0, np.logical_not(dtIg[t])),
+        "fp": np.logical_and(dtm[t] == 0, np.logical_not(dtIg[t])),
+        "instances": np.bincount(gtImages[np.logical_not(gtIg)], minlength=N).astype(np.int32),
+        "nmsFN": np.full((4,), np.nan) if nmsFN is None else np.array(nmsFN, dtype=np.float64),
+    }
+
+
+def packImageStatistics(imgIds, iouThresholds, statistics, falseNegatives=None, numberInstances=None):
+    """
+    Pack the `imageStatistics` of a category for every IoU threshold of the nms in the format saved by `saveImageStatistics`.
+    :param imgIds: [N] ids of the images of the category
+    :param iouThresholds: [T] IoU thresholds of the nms
+    :param statistics: list of the T `imageStatistics`
+    :param falseNegatives: [T] number of false negatives of `EvalImgs.numberFN`, saved as "false_negatives" if given
+    :param numberInstances: number of instances of `EvalImgs.numberInstances`, saved as "number_instances" if given
+    :return: dictionnary of arrays, the detections of the IoU threshold t being in [offsets[t], offsets[t+1])
+    """
+    offsets = np.concatenate(([0], np.cumsum([len(s["scores"]) for s in statistics]))).astype(np.int64)
+    counts = dict()
+    if falseNegatives is not None:
+        counts["false_negatives"] = np.asarray(falseNegatives, dtype=np.int64)
+    if numberInstances is not None:
+        counts["number_instances"] = np.int64(numberInstances)
+    return dict(image_ids=np.asarray(imgIds, dtype=np.int64), iou_threshold=np.asarray(iouThresholds),
+                offsets=offsets, instances=statistics[0]["instances"],
+                images=np.concatenate([s["images"] for s in statistics]),
+                scores=np.concatenate([s["scores"] for s in statistics]),
+                tp=np.concatenate([s["tp"] for s in statistics]),
+                fp=np.concatenate([s["fp"] for s in statistics]),
+                nms_fn=np.stack([s["nmsFN"] for s in statistics]), **counts)
+
+
+def saveImageStatistics(dataFile, imgIds, iouThresholds, statistics, falseNegatives=None, numberInstances=None):
+    """
+    Save the `imageStatistics` of a category for every IoU threshold of the nms in a compressed npz, see `packImageStatistics`.
+    :return: None
+    """
+    np.savez_compressed(dataFile, **packImageStatistics(imgIds, iouThresholds, statistics, falseNegatives, numberInstances))
+
+
+def mergeImageStatistics(dataFiles):
+    """
+    Merge the statistics saved by `saveImageStatistics` for disjoint sets of images of the same category, e.g the shards
+    of `sharding`. Given in the order of the image ids, the detections are concatenated in the order `COCOeval.accumulate`
+    would see them, so that equal scores are ranked the same way and the AP is found again exactly.
+    :param dataFiles: list of npz files with the same IoU thresholds
+    :return: dictionnary with the keys of the npz files, the counts "false_negatives" and "number_instances" are summed
+    """
+    parts = [dict(np.load(dataFile)) for dataFile in dataFiles]
+    T = len(parts[0]["iou_threshold"])
+    imageOffsets = np.concatenate(([0], np.cumsum([len(part["image_ids"]) for part in parts])))
+    merged = {
+        "image_ids": np.concatenate([part["image_ids"] for part in parts]),
+        "iou_threshold": parts[0]["iou_threshold"],
+        "instances": np.concatenate([part["instances"] for part in parts]),
+        "nms_fn": parts[0]["nms_fn"],
+    }
+    for key in ("images", "scores", "tp", "fp"):
+        columns = list()
+        for t in range(T):
+            for part, imageOffset in zip(parts, imageOffsets):
+                column = part[key][part["offsets"][t]:part["offsets"][t + 1]]
+                columns.append(column + imageOffset if key == "images" else column)
+        merged[key] = np.concatenate(columns)
+    sizes = np.array([np.diff(part["offsets"]) for part in parts]).sum(axis=0)
+    merged["offsets"] = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+    for key in ("false_negatives", "number_instances"):
+        if all(key in part for part in parts):
+            merged[key] = np.sum([part[key] for part in parts], axis=0)
+    return merged
+
+
+def _recall(nmsFN, tp_sum, npig):
+    """
+    Recall the way `COCOeval.accumulate` computes it, with the ratio fn/npig of the training when `nmsFN` is not NaN.
+    :param nmsFN: [4] (fn_nms_validation, npig_val, fn_nms_train, npig_train), see `imageStatistics`
+    :return: recall of each cumulated number of true positives
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fn_nms_validation, npig_val, fn_nms_train, npig_train = nmsFN
+        if np.isnan(fn_nms_validation):
+            return tp_sum / npig
+        fn = npig - tp_sum
+        return 1 - (fn / npig - fn_nms_validation/npig_val + fn_nms_train/npig_train)
+
+
+def resampledPrecision(data, t, weights, recThrs=RECALL_THRESHOLDS):
+    """
+    Precision at each recall threshold of the IoU threshold `t` of the nms for each resampling of the images, computed
+    the way `COCOeval.accumulate` does. An image drawn twice counts twice, so with all the weights set to 1 the
+    precision to recall written by `nmsAnalysis` is found again.
+    :param data: npz written by `saveImageStatistics`
+    :param t: index of the IoU threshold of the nms
+    :param weights: [BxN] number of times each image is drawn in each of the B resamplings
+    :return: [BxR] precision, NaN for the resamplings without instances
+    """
+    start, end = data["offsets"][t], data["offsets"][t + 1]
+    scores = data["scores"][start:end]
+    order = np.argsort(-scores, kind='mergesort')
+    images = data["images"][start:end][order]
+    tp = data["tp"][start:end][order]
+    fp = data["fp"][start:end][order]
+    weights = np.asarray(weights, dtype=np.float64)
+    B, D = len(weights), len(order)
+
+    npig = weights @ data["instances"]
+    w = weights[:, images]
+    tp_sum = np.cumsum(w * tp, axis=1)
+    fp_sum = np.cumsum(w * fp, axis=1)
+    rc = _recall(data["nms_fn"][t], tp_sum, npig[:, None])
+    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+    # precision envelope, from the right
+    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+    precision = np.full((B, len(recThrs)), np.nan)
+    for b in np.nonzero(npig > 0)[0]:
+        inds = np.searchsorted(rc[b], recThrs, side='left')
+        precision[b] = np.where(inds < D, pr[b, np.minimum(inds, D - 1)] if D else 0., 0.)
+    return precision
+
+
+def resampledAP(data, t, weights):
+    """
+    AP of the IoU threshold `t` of the nms for each resampling of the images, the mean of `resampledPrecision`.
+    With all the weights set to 1 the AP written by `nmsAnalysis` is found again.
+    :return: [B] AP, NaN for the resamplings without instances
+    """
+    return resampledPrecision(data, t, weights).mean(axis=1)
+
+
+def truncatedPrecision(data, t, scoreThresholds, maxDetections, recThrs=RECALL_THRESHOLDS):
+    """
+    Precision at each recall threshold of the IoU threshold `t` of the nms when the detections left are also cut by a score
+    threshold and a maximal number of detections per image, as `score_threshold` and `max_output_size` of the nms.
+    Both only drop the last detections of a list sorted by score: the nms is greedy in the order of the scores and
+    `COCOeval` matches the detections of an image in the same order, so the detections kept are matched as before.
+    The detections are sorted once, each maximal number of detections is a mask and each score threshold a prefix of it.
+    :param data: npz written by `saveImageStatistics` with a nms keeping at least max(maxDetections) detections per image
+    :param t: index of the IoU threshold of the nms
+    :param scoreThresholds: [S] the detections whose score is strictly above are kept, as in tensorflow
+    :param maxDetections: [M] maximal number of detections per image
+    :return: [SxMxR] precision, NaN without instances
+    """
+    start, end = data["offsets"][t], data["offsets"][t + 1]
+    scores = data["scores"][start:end]
+    images = data["images"][start:end]
+    D = len(scores)
+    # rank of each detection in its image by decreasing score
+    byImage = np.lexsort((np.arange(D), -scores, images))
+    rank = np.empty((D,), dtype=np.int64)
+    rank[byImage] = np.arange(D) - np.searchsorted(images[byImage], images[byImage], side='left')
+
+    order = np.argsort(-scores, kind='mergesort')
+    scores, rank = scores[order], rank[order]
+    tp = data["tp"][start:end][order]
+    fp = data["fp"][start:end][order]
+    npig = data["instances"].sum()
+    precision = np.full((len(scoreThresholds), len(maxDetections), len(recThrs)), np.nan)
+    if npig == 0:
+        return precision
+    for m, maxDet in enumerate(maxDetections):
+        keep = rank < maxDet
+        tp_sum = np.cumsum(tp[keep])
+        fp_sum = np.cumsum(fp[keep])
+        rc = _recall(data["nms_fn"][t], tp_sum, npig)
+        pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+        for s, scoreThreshold in enumerate(scoreThresholds):
+            k = np.searchsorted(-scores[keep], -scoreThreshold, side='left')
+            # precision envelope of the k first detections, from the right
+            envelope = np.maximum.accumulate(pr[:k][::-1])[::-1]
+            inds = np.searchsorted(rc[:k], recThrs, side='left')
+            precision[s, m] = np.where(inds < k, envelope[np.minimum(inds, k - 1)] if k else 0., 0.)
+    return precision
+
+
+def _bootstrap(data, numberResamples, seed, batchSize):
+    """
+    Draw `numberResamples` resamplings of the images with replacement and compute the AP of every IoU threshold for each.
+    :return: [T] AP on all the images, [BxT] AP of each resampling, NaN without instances
+    """
+    T, N = len(data["iou_threshold"]), len(data["image_ids"])
+    random = np.random.RandomState(seed)
+    weights = random.multinomial(N, np.full((N,), 1. / N), size=numberResamples) if N else np.zeros((numberResamples, 0))
+    AP = np.array([resampledAP(data, t, np.ones((1, N)))[0] for t in range(T)])
+    resampled = np.empty((numberResamples, T))
+    for start in range(0, numberResamples, batchSize):
+        batch = weights[start:start + batchSize]
+        for t in range(T):
+            resampled[start:start + batchSize, t] = resampledAP(data, t, batch)
+    return AP, resampled
+
+
+def _bestThresholds(iou, resampled):
+    # best threshold of each resampling, on equality the greatest threshold is kept. NaN without instances.
+    T = len(iou)
+    valid = ~np.isnan(resampled).any(axis=1)
+    idx = T - 1 - np.argmax(resampled[:, ::-1], axis=1)
+    return np.where(valid, iou[idx], np.nan)
+
+
+def bootstrapThresholds(dataFile, numberResamples=500, seed=0, batchSize=64):
+    """
+    Draw `numberResamples` resamplings of the images of a category with replacement and find the best IoU threshold
+    of the nms for each of them. Nothing is rerun, the AP comes from the statistics saved by `saveImageStatistics`.
+    :param dataFile: npz written by `saveImageStatistics`
+    :param batchSize: number of resamplings computed at once, bounds the memory used
+    :return:
+
+    - iou: [T] IoU thresholds of the nms
+    - AP: [T] AP on all the images
+    - bestIoU: [B] best threshold of each resampling, on equality the greatest threshold is kept. NaN without instances.
+    """
+    data = dict(np.load(dataFile))
+    AP, resampled = _bootstrap(data, numberResamples, seed, batchSize)
+    return data["iou_threshold"], AP, _bestThresholds(data["iou_threshold"], resampled)
+
+
+def sampledEstimates(data, imageFN, population, numberResamples=200, seed=0, confidence=0.95, batchSize=64):
+    """
+    Estimate the curves of all the images of a category from a sample of them drawn without replacement, see
+    `nmsAnalysis.sampleImages`. The standard error of the AP comes from a bootstrap of the sampled images, the one of the
+    total number of false negatives from their variance across images. Both shrink by the finite population correction
+    sqrt(1 - n/N), so they are 0 when every image is sampled.
+
+    :param data: statistics of the sampled images, see `packImageStatistics`
+    :param imageFN: [TxN] number of false negatives of each sampled image for each IoU threshold, see `EvalImgs.imageCounts`
+    :param population: number of images of the category
+    :param confidence: level of the interval of the best threshold
+    :return: dictionnary with the keys
+
+    - "AP", "AP standard error": [T] AP on the sample and its standard error
+    - "False Negatives", "False Negatives standard error": [T] estimated number of false negatives on all the images
+    - "best iou threshold": threshold of the best AP on the sample, on equality the greatest
+    - "best iou threshold interval": [2] interval of the best threshold of the bootstrap resamplings
+    """
+    iou = data["iou_threshold"]
+    imageFN = np.asarray(imageFN, dtype=np.float64).reshape((len(iou), -1))
+    n = imageFN.shape[1]
+    correction = np.sqrt(max(0., 1. - n / population)) if population else 0.
+    AP, resampled = _bootstrap(data, numberResamples, seed, batchSize)
+    bestIoU = _bestThresholds(iou, resampled)
+    bestIoU = bestIoU[~np.isnan(bestIoU)]
+    alpha = (1. - confidence) / 2.
+    FNError = imageFN.std(axis=1, ddof=1) / np.sqrt(n) if n > 1 else np.zeros((len(iou),))
+    return {
+        "AP": AP,
+        "AP standard error": np.nanstd(resampled, axis=0) * correction if len(resampled) else np.zeros((len(iou),)),
+        "False Negatives": imageFN.mean(axis=1) * population if n else np.zeros((len(iou),)),
+        "False Negatives standard error": population * correction * FNError,
+        "best iou threshold": float(iou[len(iou) - 1 - np.argmax(AP[::-1])]) if not np.isnan(AP).any() else float("nan"),
+        "best iou threshold interval": np.quantile(bestIoU, [alpha, 1. - alpha]) if len(bestIoU) else np.full((2,), np.nan),
+    }
@@ -0,0 +1,166 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import hashlib
+import numpy as np
+import os
+import pickle
+import shutil
+import time
+from pycocotools.coco import COCO
+
+###############################################################################
+
+# Folder in the relative path where the parsed annotations are stored.
+# Every annotation file gets a sub folder named after the sha1 of its content and `CACHE_FORMAT`.
+CACHE_DIRECTORY = ".coco_cache/"
+# Version of the files of the cache, to increase when the pickled COCO object or the columns change.
+CACHE_FORMAT = 1
+INDEX_FILE = "index.pickle"
+COLUMNS_FOLDER = "columns"
+
+# In-process registry: (real path, size, modification time) -> COCO object.
+# It allows `nmsAnalysis`, `GroundTruthFN` and `optimisedNMS` to share the same
+# loaded annotations inside a single run.
+_registry = dict()
+
+# Number of annotation files loaded from the registry, from the disk cache or parsed, read by `metrics.Metrics`.
+cacheStatistics = {"registry": 0, "disk": 0, "miss": 0}
+
+
+def annotationHash(annotationPath, blockSize=1 << 20):
+    """
+    Compute the sha1 of an annotation file.
+    :param annotationPath: path redirecting to an annotation file in the coco format
+    :param blockSize: number of bytes read at once
+    :return: hexadecimal digest of the file content
+    """
+    sha1 = hashlib.sha1()
+    with open(annotationPath, 'rb') as fs:
+        for block in iter(lambda: fs.read(blockSize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _registryKey(annotationPath):
+    """
+    :return: key identifying an annotation file in `_registry` without reading it
+    """
+    stat = os.stat(annotationPath)
+    return (os.path.realpath(annotationPath), stat.st_size, stat.st_mtime_ns)
+
+
+def cacheFolder(annotationPath, cacheDirectory=CACHE_DIRECTORY):
+    """
+    :return: folder containing the cached index of the given annotation file
+    """
+    return os.path.join(cacheDirectory, "{}_v{}".format(annotationHash(annotationPath), CACHE_FORMAT))
+
+
+def _writeIndex(coco, folder):
+    """
+    Pickle the coco object (dataset and index) inside `folder`.
+    The file is first written under a temporary name so that a concurrent reader never sees a partial index.
+    """
+    os.makedirs(folder, exist_ok=True)
+    tmpFile = os.path.join(folder, "{}.{}.tmp".format(INDEX_FILE, os.getpid()))
+    with open(tmpFile, 'wb') as fs:
+        pickle.dump(coco, fs, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpFile, os.path.join(folder, INDEX_FILE))
+
+
+def _readIndex(folder):
+    """
+    :return: the coco object pickled inside `folder`
+    """
+    print('loading annotations from cache {}...'.format(folder))
+    tic = time.time()
+    with open(os.path.join(folder, INDEX_FILE), 'rb') as fs:
+        coco = pickle.load(fs)
+    print('Done (t={:0.2f}s)'.format(time.time() - tic))
+    return coco
+
+
+def _writeColumns(columns, folder):
+    """
+    Save each column of the columnar index as a .npy file inside `folder/columns` so that it can be memory mapped.
+    """
+    tmpFolder = os.path.join(folder, "{}.{}.tmp".format(COLUMNS_FOLDER, os.getpid()))
+    os.makedirs(tmpFolder, exist_ok=True)
+    for key, value in columns.items():
+        np.save(os.path.join(tmpFolder, key + ".npy"), value)
+    try:
+        os.rename(tmpFolder, os.path.join(folder, COLUMNS_FOLDER))
+    except OSError:
+        # written in the meantime by another process
+        shutil.rmtree(tmpFolder, ignore_errors=True)
+
+
+def _readColumns(folder):
+    """
+    :return: dictionnary of the columns memory mapped from `folder/columns`
+    """
+    columnFolder = os.path.join(folder, COLUMNS_FOLDER)
+    return {name[:-len(".npy")]: np.load(os.path.join(columnFolder, name), mmap_mode='r')
+            for name in os.listdir(columnFolder) if name.endswith(".npy")}
+
+
+def loadCoco(annotationPath, cacheDirectory=CACHE_DIRECTORY, columnar=True):
+    """
+    Load the coco object associated to an annotation file.
+
+    - If the annotation file was already loaded in this process, return the same object.
+    - Else if an index with the same content hash exists in `cacheDirectory`, read it.
+    - Else parse the json, build the index and write it in `cacheDirectory` for the next runs.
+
+    :param annotationPath: path redirecting to an annotation file in the coco format
+    :param cacheDirectory: folder where the parsed annotations are stored. If set to None the disk cache is not used.
+    :param columnar: if set to True the coco object answers getAnnIds/getImgIds with its columnar index
+                     (memory mapped from the disk cache when available), see `COCO.createColumnarIndex`.
+    :return: coco object
+    """
+    key = _registryKey(annotationPath)
+    if key in _registry:
+        cacheStatistics["registry"] += 1
+        return _registry[key]
+
+    if cacheDirectory is None:
+        cacheStatistics["miss"] += 1
+        coco = COCO(annotationPath)
+        if columnar:
+            coco.createColumnarIndex()
+    else:
+        folder = cacheFolder(annotationPath, cacheDirectory)
+        coco = None
+        if os.path.isfile(os.path.join(folder, INDEX_FILE)):
+            try:
+                coco = _readIndex(folder)
+            except Exception:
+                # truncated, or pickled by an incompatible version of pycocotools
+                print('Unreadable cache in {}, rebuilding it'.format(folder))
+                shutil.rmtree(os.path.join(folder, COLUMNS_FOLDER), ignore_errors=True)
+        if coco is None:
+            cacheStatistics["miss"] += 1
+            coco = COCO(annotationPath)
+            _writeIndex(coco, folder)
+        else:
+            cacheStatistics["disk"] += 1
+        if columnar:
+            if os.path.isdir(os.path.join(folder, COLUMNS_FOLDER)):
+                coco.createColumnarIndex(_readColumns(folder))
+            else:
+                _writeColumns(coco.createColumnarIndex(), folder)
+
+    _registry[key] = coco
+    return coco
+
+
+def clearRegistry():
+    """
+    Forget all the coco objects loaded in this process. The disk cache is kept.
+    :return: None
+    """
+    _registry.clear()
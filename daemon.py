@@ -0,0 +1,275 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import time
+import traceback
+import numpy as np
+from nmsAnalysis import nmsAnalysis
+from cocoCache import clearRegistry
+from nmsCore import sweepCategory, loadNMSError
+
+###############################################################################
+
+SOCKET_PATH = ".nms_daemon.sock"
+
+# Settings of a job, with their default value. An analyser is kept for each combination of the first ones.
+JOB_DEFAULTS = {
+    "annotationPath": None,
+    "imagesPath": None,
+    "number_IoU_thresh": 50,
+    "iouType": "bbox",
+    "inputSize": None,
+    "maxOutput": 100,
+    "with_train": False,
+    "models": [],
+    "categories": None,
+}
+ANALYSER_KEYS = ("annotationPath", "imagesPath", "number_IoU_thresh", "iouType", "inputSize", "maxOutput", "with_train")
+
+
+def _mtime(path):
+    return os.stat(path).st_mtime_ns if path is not None and os.path.isfile(path) else None
+
+
+class WarmAnalysis(nmsAnalysis):
+
+    #The goal of this class is to run `nmsAnalysis` with the models and the detections kept in memory in between the
+    #jobs of the daemon: the saved models are loaded once, and all_output_dict.json is read again only when it changed
+    #on disk. The annotations are already shared by `cocoCache.loadCoco`.
+
+    #   Parameters:
+    #    loadedModels:       - dictionnary {modelPath: TF model} shared by every analyser of the daemon
+    #    detectionCache:     - dictionnary {detections file: (modification time, all_output_dict)} shared by every analyser of the daemon
+
+    def __init__(self, imagesPath, annotationPath, number_IoU_thresh, loadedModels, detectionCache):
+        """
+        Initialize WarmAnalysis, see `nmsAnalysis`. The models and categories are given by each job.
+        :return: None
+        """
+        super().__init__([], imagesPath, annotationPath, catFocus=[], number_IoU_thresh=number_IoU_thresh)
+        self.loadedModels = loadedModels
+        self.detectionCache = detectionCache
+
+    def loadModel(self, modelPath):
+        """
+        Load the TF model of `modelPath` at its first use, see `nmsAnalysis.loadModel`.
+        """
+        if modelPath not in self.loadedModels:
+            self.loadedModels[modelPath] = super().loadModel(modelPath)
+        return self.loadedModels[modelPath]
+
+    def load_all_output_dict(self, categories=None):
+        """
+        Reuse the detections in memory unless the json changed on disk or images of the categories studied are missing
+        in it, see `nmsAnalysis.load_all_output_dict`.
+        :return: None
+        """
+        filename = self._detectionsFile()
+        cached = self.detectionCache.get(filename)
+        if cached is not None and cached[0] == _mtime(filename) and \
+                not self.imagesToInfer(self.categories if categories is None else categories, cached[1]):
+            self.metrics.increment("detection_cache_hits")
+            self._study["all_output_dict"] = cached[1]
+            return
+        super().load_all_output_dict(categories)
+        self.detectionCache[filename] = (_mtime(filename), self._study["all_output_dict"])
+
+
+class AnalysisDaemon:
+
+    #The goal of this class is to answer analysis jobs in a long running process, so that tensorflow, the annotations,
+    #the models and the detections are loaded once for the whole tuning session instead of once per job.
+    #Each job is a json dictionnary with the keys of `JOB_DEFAULTS`, the answer holds for each model and category the
+    #AP[IoU=0.5] and false negatives of every IoU threshold computed by `nmsCore.sweepCategory`, nothing is written.
+
+    #   Parameters:
+    #    analysers:          - dictionnary {settings of `ANALYSER_KEYS`: WarmAnalysis}
+    #    loadedModels:       - dictionnary {modelPath: TF model}
+    #    detectionCache:     - dictionnary {detections file: (modification time, all_output_dict)}
+    #    results:            - dictionnary {job: (modification times of its inputs, answer)} of the jobs already answered
+
+    def __init__(self):
+        self.analysers = dict()
+        self.loadedModels = dict()
+        self.detectionCache = dict()
+        self.results = dict()
+
+    def analyser(self, job):
+        """
+        :param job: job completed with `JOB_DEFAULTS`
+        :return: the WarmAnalysis of the settings of `job`, built at their first use
+        """
+        key = json.dumps([job[name] for name in ANALYSER_KEYS])
+        if key not in self.analysers:
+            analyser = WarmAnalysis(job["imagesPath"], job["annotationPath"], job["number_IoU_thresh"],
+                                    self.loadedModels, self.detectionCache)
+            analyser.iouType = job["iouType"]
+            analyser.inputSize = job["inputSize"]
+            analyser.maxOutput = job["maxOutput"]
+            analyser.with_train = job["with_train"]
+            self.analysers[key] = analyser
+        return self.analysers[key]
+
+    def _inputTimes(self, analyser, job):
+        # modification times of the files an answer depends on
+        files = [job["annotationPath"]]
+        for model in job["models"]:
+            analyser._study["modelPath"] = model
+            files.append(analyser._detectionsFile())
+        if job["with_train"]:
+            files += ["FN_with_nms/{}/{}.json".format(dataType, category) for category in job["categories"]
+                      for dataType in ("validationFN", "trainFN")]
+        return [_mtime(file) for file in files]
+
+    def analyse(self, job):
+        """
+        Sweep the IoU thresholds of the nms for every model and category of `job`.
+        An identical job whose annotations, detections and false negatives did not change is answered from memory.
+
+        :param job: dictionnary with the keys of `JOB_DEFAULTS`, "annotationPath" and "models" are required
+        :return: dictionnary {model: {category: {"iou threshold", "AP[IoU:0.5]", "False Negatives", "number of instances",
+                 "best iou threshold"}}}, a category is None when the model does not detect it
+        """
+        unknown = set(job) - set(JOB_DEFAULTS)
+        assert not unknown, "Unknown settings in the job: {}".format(sorted(unknown))
+        job = dict(JOB_DEFAULTS, **job)
+        analyser = self.analyser(job)
+        if job["categories"] is None:
+            job["categories"] = analyser.getCategories()
+        key = json.dumps(job, sort_keys=True)
+        inputTimes = self._inputTimes(analyser, job)
+        if key in self.results and self.results[key][0] == inputTimes:
+            return self.results[key][1]
+
+        analyser.categories = job["categories"]
+        answer = dict()
+        for model in job["models"]:
+            analyser._study["modelPath"] = model
+            analyser.load_all_output_dict()
+            answer[model] = dict()
+            for category in job["categories"]:
+                nmsError = loadNMSError(category) if job["with_train"] else None
+                curve = sweepCategory(analyser.coco, analyser._study["all_output_dict"], category, analyser.iou_thresholdXaxis,
+                                      job["iouType"], job["maxOutput"], nmsError)
+                if curve is None:
+                    answer[model][category] = None
+                    continue
+                result = {name: curve[name] for name in ("iou threshold", "AP[IoU:0.5]", "False Negatives", "number of instances")}
+                result["best iou threshold"] = result["iou threshold"][int(np.argmax(result["AP[IoU:0.5]"]))]
+                answer[model][category] = result
+        self.results[key] = (self._inputTimes(analyser, job), answer)
+        return answer
+
+    def status(self):
+        """
+        :return: dictionnary of what is kept in memory
+        """
+        return {"analysers": len(self.analysers), "models": sorted(self.loadedModels),
+                "detections": sorted(self.detectionCache), "results": len(self.results)}
+
+    def evict(self):
+        """
+        Forget everything kept in memory, e.g after retraining a model in place.
+        :return: None
+        """
+        for analyser in self.analysers.values():
+            analyser.plotter.close()
+        self.analysers.clear()
+        self.loadedModels.clear()
+        self.detectionCache.clear()
+        self.results.clear()
+        clearRegistry()
+
+    def handle(self, request):
+        """
+        Answer a request of a client.
+        :param request: dictionnary {"command": "analyse", "status", "evict" or "shutdown", "job": job of `analyse`}
+        :return: dictionnary {"ok": True, "result", "seconds"} or {"ok": False, "error"}
+        """
+        start = time.time()
+        try:
+            command = request.get("command", "analyse")
+            if command == "analyse":
+                result = self.analyse(request["job"])
+            elif command == "status":
+                result = self.status()
+            elif command in ("evict", "shutdown"):
+                result = self.evict()
+            else:
+                raise ValueError("Unknown command {}".format(command))
+        except Exception:
+            return {"ok": False, "error": traceback.format_exc()}
+        return {"ok": True, "result": result, "seconds": time.time() - start}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # one json request per line, one json answer per line
+        for line in self.rfile:
+            request = json.loads(line)
+            answer = self.server.daemon.handle(request)
+            self.wfile.write((json.dumps(answer) + "\n").encode())
+            self.wfile.flush()
+            if request.get("command") == "shutdown":
+                self.server.shutdownRequested = True
+                return
+
+
+def serve(socketPath=SOCKET_PATH):
+    """
+    Answer the requests sent to the Unix socket `socketPath` one at a time until a "shutdown" request.
+    :param socketPath: path of the socket, removed when the daemon stops
+    :return: None
+    """
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = socketserver.UnixStreamServer(socketPath, _Handler)
+    server.daemon = AnalysisDaemon()
+    server.shutdownRequested = False
+    print("Daemon listening on {}".format(socketPath))
+    try:
+        while not server.shutdownRequested:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(socketPath)
+
+
+def query(request, socketPath=SOCKET_PATH):
+    """
+    Send a request to the daemon listening on `socketPath`, see `AnalysisDaemon.handle`.
+    :return: the answer of the daemon, the result when it succeeded
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socketPath)
+        client.sendall((json.dumps(request) + "\n").encode())
+        with client.makefile("r") as fs:
+            answer = json.loads(fs.readline())
+    if not answer["ok"]:
+        raise RuntimeError("The daemon failed:\n" + answer["error"])
+    return answer["result"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the annotations, models and detections in memory and answer analysis jobs.")
+    parser.add_argument("command", choices=["serve", "analyse", "status", "evict", "shutdown"])
+    parser.add_argument("job", nargs="?", help="json file of the job to analyse, see `daemon.JOB_DEFAULTS`")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="path of the Unix socket")
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args.socket)
+    else:
+        request = {"command": args.command}
+        if args.command == "analyse":
+            with open(args.job, "r") as fs:
+                request["job"] = json.load(fs)
+        print(json.dumps(query(request, args.socket), indent=1))
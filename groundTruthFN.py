@@ -6,11 +6,15 @@ __author__ = 'noahsfi'
 
 import numpy as np
 import json
-from matplotlib import pyplot as plt
 from tqdm import tqdm
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 from nmsAnalysis import nmsAnalysis
+from nmsCore import evaluateDetections
+from bootstrap import imageStatistics, packImageStatistics
+from plotRenderer import PlotRenderer, renderAPCurve, renderHistogram
+from profiler import Profiler
+from metrics import Metrics
 import random
 import os
 
@@ -28,9 +32,13 @@ class GroundTruthFN(nmsAnalysis):
     #    catFocus:           - if set to None, it will analyse all the categories of objects given in the annotation file.
     #                               One can give a list of category of the form ["person","car"]
     #    number_IoU_thresh:  - number of different IoU treshold to analyse in between 0.2 and 0.9
-    #    resFilePath:        - path to the json file where the detection results will be written in order to use COCOeval
+    #    sampleImages:       - None to sweep all the images. Otherwise maximal number of images of each category drawn at random,
+    #                           the estimates are written in FN_with_nms/{trainFN,validationFN}/sampled, see `nmsAnalysis.sampleImages`
+    #    sampleSeed:         - seed of the images drawn when `sampleImages` is set
     #    study:              - dictionnary containing the required current informations by the class when analysing a given model/category
    
+    # IoU threshold of the evaluation of the AP written, the 3rd of `COCOeval.stats`
+    AP_IOU_THRESHOLD = .75
     
     def __init__(self,annotationPath,dataType = "train" ,catFocus=None, number_IoU_thresh=50):
         
@@ -47,7 +55,6 @@ class GroundTruthFN(nmsAnalysis):
         self.DIRECTORY = "FN_with_nms/"
         self.resultPath = "trainFN/" if "train" in dataType else "validationFN/"
         self.annotationPath = annotationPath
-        self.resFilePath = self._createResFilePath()
         self.dataType = dataType
         self.number_IoU_thresh = number_IoU_thresh
         self.iou_thresholdXaxis = np.linspace(0.2, 0.9, number_IoU_thresh)
@@ -60,16 +67,23 @@ class GroundTruthFN(nmsAnalysis):
             "img": dict(),
             "catId": int(),
             "catStudied": str(),
+            "population": int(),  # number of images of the category studied, see `sampleImages`
             "all_output_dict": dict(),
             "iouThreshold": float(),
+            "detections": np.zeros((0, 7)),  # [Nx7] results {imageID,x1,y1,w,h,score,class} given to COCO.loadResBbox
         }
         
         # Create folder to put the results in
-        if not os.path.isdir(self.DIRECTORY):
-            os.mkdir(self.DIRECTORY)
+        os.makedirs(self.DIRECTORY, exist_ok=True)
 
-        if not os.path.isdir(self.DIRECTORY + self.resultPath):
-            os.mkdir(self.DIRECTORY + self.resultPath)
+        os.makedirs(self.DIRECTORY + self.resultPath, exist_ok=True)
+
+        # Can be changed after initialization
+        self.plotter = PlotRenderer()
+        self.profiler = Profiler()  # set `profiler.enabled = True` to write FN_with_nms/{trainFN,validationFN}/profile.json
+        self.metrics = Metrics()  # set `metrics.path` to export the progress of `runAnalysis`
+        self.sampleImages = None
+        self.sampleSeed = 0
 
     def getBbox(self,image_Id):
         """
@@ -161,11 +175,12 @@ class GroundTruthFN(nmsAnalysis):
     
     def writeResToJson(self,newFile = True):
         """
-        Write a `self.resFilePath` in the coco annotations format describing final detections for a unique category after having applied `computeNMS`.
+        Write in `self._study["detections"]` the ground truth bbox of a unique category remaining after `pseudoNMS`, used as detections.
+        Each row is of the form {imageID,x1,y1,w,h,score,class} in order to be loaded with `COCO.loadResBbox`.
 
         input:
         ----------
-        - newFile: if set to True rewrite the file else append the detections to the file
+        - newFile: if set to True replace the previous detections else append the detections to them
             
         output:
         ----------
@@ -177,33 +192,33 @@ class GroundTruthFN(nmsAnalysis):
             image_Id = image["id"]
             imgIds.add(image_Id)
             bbox = self.getBbox(image_Id)
-            bboxAfterNms = self.pseudoNMS(bbox)
+            with self.profiler.stage("pseudoNMS"):
+                bboxAfterNms = self.pseudoNMS(bbox)
             for i in range(len(bboxAfterNms)):
-                #ex : {"image_id":42,"category_id":18,"bbox":[258.15,41.29,348.26,243.78],"score":0.236}
-                properties = {}
-                #json format doesnt support int64
-                properties["category_id"] = int(self._study["catId"])
-                properties["image_id"] = int(image_Id)
-                
-                
-
-                #we want [ymin,xmin,ymax,xmax] -> [xmin,ymin,width,height]
-                properties["bbox"] = bboxAfterNms[i]
-                properties["score"]= float(1.)
+                #ex : [42, 258.15, 41.29, 348.26, 243.78, 1., 18] i.e {imageID,x1,y1,w,h,score,class}
+                #the ground truth bbox are already in the coco format [xmin,ymin,width,height]
+                result.append([int(image_Id)] + list(bboxAfterNms[i]) + [1., int(self._study["catId"])])
 
-                result.append(properties)
-                
+        result = np.array(result, dtype=np.float64).reshape((-1, 7))
         if newFile:
-            with open(self.resFilePath, 'w') as fs:
-                json.dump(result, fs, indent=1)
+            self._study["detections"] = result
         else:
-            with open(self.resFilePath, 'r') as fs:
-                data = json.load(fs)
-                result += data
-            with open(self.resFilePath, 'w') as fs:
-                json.dump(result, fs, indent=1) 
+            self._study["detections"] = np.concatenate((self._study["detections"], result))
         return list(imgIds) 
 
+    def evaluateThreshold(self,iouThreshold):
+        """
+        Apply `pseudoNMS` with `iouThreshold` to the ground truth of the images of `self._study["img"]` and evaluate
+        the bbox of `self._study["catStudied"]` left.
+        :return: COCOeval after `accumulate` and `summarize`
+        """
+        self._study["iouThreshold"] = iouThreshold
+        self.profiler.setLabels(self._study["catStudied"], iouThreshold)
+        #Create the Json result file and read it.
+        with self.profiler.stage("writeResToJson"):
+            imgIds = self.writeResToJson()
+        return evaluateDetections(self.coco,self._study["detections"],imgIds,self._study["catId"],iouThreshold,profiler=self.profiler)
+
     def getClassAP(self):
         """
         Evaluate `self._study["catStudied"]` for different IoU. Write the result in json format in FN_with_nms.
@@ -217,37 +232,45 @@ class GroundTruthFN(nmsAnalysis):
         
         AP = list()
         FN = list()
+        statistics = list()
+        imageFN = list()
         for iouThreshold in tqdm(self.iou_thresholdXaxis,desc = "progressbar IoU Threshold"):
-            self._study["iouThreshold"] = iouThreshold
-            #Create the Json result file and read it.
-            imgIds = self.writeResToJson()
-            cocoDt= self.coco.loadRes(self.resFilePath)
-            cocoEval = COCOeval(self.coco,cocoDt,'bbox')
-            cocoEval.params.imgIds  = imgIds
-            cocoEval.params.catIds  = self._study["catId"]
-            #Here we increase the maxDet to 1000 (same as in model config file)
-            #Because we want to optimize the nms that is normally in charge of dealing with
-            #bbox that detects the same object twice or detection that are not very precise
-            #compared to the best one.
-            cocoEval.params.maxDets = [1,10,1000]
-            cocoEval.evaluate()
-            number_FN = 0
-            instances_non_ignored = 0
-            for evalImg in cocoEval.evalImgs:
-                number_FN += sum(evalImg["FN"])
-                
-                instances_non_ignored += sum(np.logical_not(evalImg['gtIgnore']))     
+            cocoEval = self.evaluateThreshold(iouThreshold)
+            if self.sampleImages is not None:
+                statistics.append(imageStatistics(cocoEval, iouThr=self.AP_IOU_THRESHOLD))
+                imageFN.append(cocoEval.evalImgs.imageCounts()[0])
+            number_FN = cocoEval.evalImgs.numberFN()
+            instances_non_ignored = cocoEval.evalImgs.numberInstances()
             FN.append(int(number_FN))
-            #Need it only once
-            cocoEval.accumulate(iouThreshold,withTrain=False)
-            cocoEval.summarize()
             #readDoc and find self.evals
             #modified version of pycocotools to have 3rd argument to be AP[IoU = 0.95]
             AP.append(cocoEval.stats[2])
-        with open(self.DIRECTORY + self.resultPath+ "{}.json".format(self._study["catStudied"]), 'w') as fs:
-            json.dump({"iou threshold": list(self.iou_thresholdXaxis),"AP[IoU:0.95]":AP,"False Negatives":FN,"number of instances":int(instances_non_ignored)}, fs, indent=1)
+            self.metrics.increment("thresholds")
+        if self.sampleImages is not None:
+            self.writeSampledClassAP("AP[IoU:0.95]", packImageStatistics(cocoEval.params.imgIds, self.iou_thresholdXaxis, statistics), imageFN)
+            return AP
+        self.writeClassAP(AP,FN,instances_non_ignored)
         return AP
 
+    def _sampledFolder(self):
+        """
+        Create if necessary the folder of the sampled sweeps, FN_with_nms/{trainFN,validationFN}/sampled/
+        :return: path to the folder
+        """
+        folder = self.DIRECTORY + self.resultPath + "sampled/"
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def writeClassAP(self,AP,FN,instances):
+        """
+        Write the AP and the number of false negatives of `self._study["catStudied"]` for every IoU threshold
+        in FN_with_nms/{trainFN,validationFN}/category.json
+        
+        :return: None
+        """
+        with open(self.DIRECTORY + self.resultPath+ "{}.json".format(self._study["catStudied"]), 'w') as fs:
+            json.dump({"iou threshold": list(self.iou_thresholdXaxis),"AP[IoU:0.95]":AP,"False Negatives":FN,"number of instances":int(instances)}, fs, indent=1)
+
     def getIoU(self):
         """
         Use COCOeval api in order to get the intersection over union in between all instances in a given image.
@@ -258,7 +281,7 @@ class GroundTruthFN(nmsAnalysis):
         res_iou = list()
         self._study["iouThreshold"] = 1
         imgIds = self.writeResToJson()
-        cocoDt=self.coco.loadRes(self.resFilePath)
+        cocoDt=self.coco.loadResBbox(self._study["detections"])
         cocoEval = COCOeval(self.coco,cocoDt,'bbox')
         cocoEval.params.imgIds  = imgIds
         cocoEval.params.catIds  = self._study["catId"]
@@ -277,35 +300,22 @@ class GroundTruthFN(nmsAnalysis):
     def plotAP(self,AP):
         """
         Plot the AP to IoU Threshold inside the graph folder in the corresponding result folder.
-        i.e `FN_with_nms/trainFN` or ``FN_with_nms/validationFN``
+        i.e `FN_with_nms/trainFN` or ``FN_with_nms/validationFN``. The graph is rendered in background by `self.plotter`.
         
         :return: None
         """
-        plt.figure(figsize=(18,10))
-        # Plot the data
-        plt.plot(self.iou_thresholdXaxis, AP, label='AP[IoU=0.95]')
-        # Add a legend
-        plt.legend(loc = "lower left")
-        plt.title('Class = {}'.format(self._study["catStudied"]))
-        plt.xlabel('iou threshold')
-        plt.ylabel('AP[IoU=0.95]')
-        plt.savefig(self.DIRECTORY + self.resultPath+ 'graph/graph_{}.png'.format(self._study["catStudied"]), bbox_inches='tight')
-        plt.clf()
+        self.plotter.submit(renderAPCurve, list(self.iou_thresholdXaxis), AP, self._study["catStudied"], 'AP[IoU=0.95]',
+                            self.DIRECTORY + self.resultPath+ 'graph/graph_{}.png'.format(self._study["catStudied"]))
     
     def plotHistIou(self,ious):
         """
         Plot the historigram of the intersection over union in between all instances in a given image.
         It is usefull in order to visualize how much a given category is overlapping.
         Graphs will be in the corresponding result folder i.e `FN_with_nms/trainFN` or ``FN_with_nms/validationFN``
+        The graph is rendered in background by `self.plotter`.
         """
-        plt.figure(figsize=(18,10))
-        nb_bins = 20
-        plt.hist(ious,bins=nb_bins)
-        plt.ylabel('Number of detections')
-        plt.xlabel("IoU")
-        plt.title('Class = {}'.format(self._study["catStudied"]))
-        plt.savefig(self.DIRECTORY + self.resultPath+ 'graph/hist_{}.png'.format(self._study["catStudied"]), bbox_inches='tight')
-        plt.clf()
+        self.plotter.submit(renderHistogram, ious, self._study["catStudied"],
+                            self.DIRECTORY + self.resultPath+ 'graph/hist_{}.png'.format(self._study["catStudied"]))
         
     def runAnalysis(self):
         """
@@ -313,12 +323,24 @@ class GroundTruthFN(nmsAnalysis):
         :return: None
         """
         print("Analysing {} ...".format(self.dataType))
+        self.profiler.reset()
+        self.metrics.start("GroundTruthFN", categories=len(self.categories), thresholds=len(self.categories) * self.number_IoU_thresh)
+        self.metrics.labels["dataset"] = self.dataType
         for catStudied in tqdm(self.categories,desc="Categories Processed",leave=False):
             self._study["catStudied"] = catStudied
+            self.profiler.setLabels(catStudied)
             self.getImgClass(catStudied)
             AP = self.getClassAP()  
-            ious = self.getIoU()
-            if not os.path.isdir(self.DIRECTORY + self.resultPath + "graph/"):
-                os.mkdir(self.DIRECTORY + self.resultPath + "graph/")
+            self.metrics.increment("categories")
+            if self.sampleImages is not None:
+                continue
+            self.profiler.setLabels(catStudied)
+            with self.profiler.stage("getIoU"):
+                ious = self.getIoU()
+            os.makedirs(self.DIRECTORY + self.resultPath + "graph/", exist_ok=True)
             self.plotHistIou(ious)
-            self.plotAP(AP,catStudied,50)
\ No newline at end of file
+            self.plotAP(AP)
+        self.metrics.update(force=True)
+        if self.profiler.enabled:
+            self.profiler.report(self.DIRECTORY + self.resultPath + "profile.json")
+        self.plotter.wait()
\ No newline at end of file
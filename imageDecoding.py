@@ -0,0 +1,63 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import re
+import numpy as np
+from PIL import Image
+
+###############################################################################
+
+
+def readResizer(pipelineFile):
+    """
+    Read the `image_resizer` of the pipeline.config of an OD model of the tensorflow object detection api.
+    :param pipelineFile: path of the pipeline.config, e.g modelPath/pipeline.config
+    :return: dictionnary {"height", "width"} for a fixed_shape_resizer, {"min_dimension", "max_dimension"} for a
+             keep_aspect_ratio_resizer, None if the file has no such resizer
+    """
+    with open(pipelineFile, "r") as fs:
+        text = fs.read()
+    for resizer in ("fixed_shape_resizer", "keep_aspect_ratio_resizer"):
+        found = re.search(resizer + r"\s*\{([^}]*)\}", text)
+        if found:
+            fields = dict(re.findall(r"(\w+):\s*(\d+)", found.group(1)))
+            if resizer == "fixed_shape_resizer":
+                return {"height": int(fields["height"]), "width": int(fields["width"])}
+            return {"min_dimension": int(fields["min_dimension"]), "max_dimension": int(fields["max_dimension"])}
+    return None
+
+
+def targetSize(width, height, resizer):
+    """
+    Size of the input of the model for an image, the way its resizer computes it.
+    :param width, height: size of the image
+    :param resizer: dictionnary returned by `readResizer`
+    :return: (width, height) given to the model
+    """
+    if "height" in resizer:
+        return resizer["width"], resizer["height"]
+    scale = resizer["min_dimension"] / min(width, height)
+    if max(width, height) * scale > resizer["max_dimension"]:
+        scale = resizer["max_dimension"] / max(width, height)
+    return int(round(width * scale)), int(round(height * scale))
+
+
+def loadImage(imagePath, resizer=None):
+    """
+    Decode an image, at a reduced resolution when the model resizes it anyway. The JPEG decoder of PIL scales
+    the image by 1/2, 1/4 or 1/8 while decoding (`Image.draft`), keeping the smallest scale at least as large as the
+    input of the model on both sides: the model sees nearly the same pixels, the normalized bbox stay valid and
+    the decoding time and memory drop with the scale. The other formats are decoded at full resolution.
+
+    :param imagePath: path of the image
+    :param resizer: dictionnary returned by `readResizer`, if None the image is decoded at full resolution
+    :return: a numpy array representing the image and (height, width) of the image at full resolution
+    """
+    image = Image.open(imagePath)
+    width, height = image.size
+    if resizer is not None:
+        image.draft(image.mode, targetSize(width, height, resizer))
+    return np.array(image), (height, width)
@@ -3,69 +3,55 @@
 
 # import the necessary packages
 
-from nmsAnalysis import nmsAnalysis
-from groundTruthFN import GroundTruthFN
-from optimised_nms import optimisedNMS
-import time
-import os
+from pipeline import Pipeline, DEFAULT_CONFIG, runGroundTruthFN, runOptimiser
 
 ###############################################################################
 
 def evaluateFN(annotationTrain,annotationValidation,catFocus=None):
-
-    fn_validation = GroundTruthFN(annotationValidation,dataType="validation",catFocus=catFocus)
-    print("Evaluate false negatives generated by nms on validation dataset....")
-    time.sleep(3)
-    fn_validation.runAnalysis()
-    print("\n Done. \n")
-    print("Evaluate false negatives generated by nms on training dataset....")
-    fn_train = GroundTruthFN(annotationTrain,dataType="train",catFocus=catFocus)
-    time.sleep(3)
-    fn_train.runAnalysis()
-    print("\n Done. \n")
-    
-def main(models,imagesPath,annotationValidation,catFocus = None,number_IoU_thresh=50,overall = True,with_train = True,annotationTrain = None):
-    
+    """
+    Compute the false negatives generated by the nms on the ground truth of the validation and training datasets,
+    i.e the stages fn/validation and fn/train of `pipeline.Pipeline` run without checking their state.
+    :return: None
+    """
+    config = dict(DEFAULT_CONFIG, annotationTrain=annotationTrain, annotationValidation=annotationValidation)
+    for dataType in ("validation", "train"):
+        print("Evaluate false negatives generated by nms on {} dataset....".format(dataType))
+        runGroundTruthFN(config, dataType, catFocus)
+        print("\n Done. \n")
+
+def main(models,imagesPath,annotationValidation,catFocus = None,number_IoU_thresh=50,overall = True,with_train = True,annotationTrain = None,
+         workers = None,stateFile = ".pipeline_state.json"):
+    """
+    Run the whole study, from the inference to the iouThreshmap.pbtxt of each model, see `pipeline.Pipeline`.
+    Only the stages whose inputs changed since the last call are run again, `workers` of them at once.
+    :return: dictionnary {stage: "fresh", "ran", "failed" or "skipped"}
+    """
     if with_train and annotationTrain == None:
         print("Please input an annotation file for the training set")
         raise ReferenceError
-        
-    if with_train:
-        evaluateFN(annotationTrain,annotationValidation,catFocus=catFocus)
-    
-    print("Starting analysis only with validation dataset... \n")
-    analyser = nmsAnalysis(models,imagesPath,annotationValidation,catFocus=catFocus,number_IoU_thresh = number_IoU_thresh,overall=overall)
-    time.sleep(2)
-    analyser.with_train = False
-    analyser.runAnalysis()
-    
-    print("\n Starting analysis mixed with training dataset... \n")
-    time.sleep(2)
-    analyser.with_train = True
-    analyser.runAnalysis()
+
+    pipeline = Pipeline({"models": models, "imagesPath": imagesPath, "annotationValidation": annotationValidation,
+                         "annotationTrain": annotationTrain, "catFocus": catFocus, "number_IoU_thresh": number_IoU_thresh,
+                         "overall": overall, "with_train": with_train, "stateFile": stateFile})
+    return pipeline.run(workers)
 
 
 def getResult(models,annotationValidation,catFocus = None,with_train = True):
-    """Once one get the all the required files. Check your models directort to get the result """
-    optimiser = optimisedNMS(models,None,annotationValidation,catFocus=catFocus)
-    optimiser.with_train = with_train
-    optimiser.compare_model()
-    for model in models:
-        optimiser.overallArgmax(model)
-    optimiser.plotOverall()
-    optimiser.writeMapIoU()
+    """Once one get the all the required files. Check your models directort to get the result, see `pipeline.runOptimiser`"""
+    config = dict(DEFAULT_CONFIG, models=models, annotationValidation=annotationValidation, with_train=with_train)
+    runOptimiser(config, catFocus)
 
-models = [
-    "ssd_mobilenet_v1_fpn"
-]
-imagesPath = "cocoapi/val2017"
-annotationTrain = "cocoapi/annotations/instances_train2017.json"
-annotationValidation = "cocoapi/annotations/instances_val2017.json"
 
-#Set to None if you wish to work on all categories
-catFocus = ["bicycle"]
-with_train = True
+if __name__ == "__main__":
+    models = [
+        "ssd_mobilenet_v1_fpn"
+    ]
+    imagesPath = "cocoapi/val2017"
+    annotationTrain = "cocoapi/annotations/instances_train2017.json"
+    annotationValidation = "cocoapi/annotations/instances_val2017.json"
 
-# main(models,imagesPath,annotationValidation,annotationTrain= annotationTrain,catFocus=catFocus,overall=True,evaluateFNnms=with_Train)
+    #Set to None if you wish to work on all categories
+    catFocus = ["bicycle"]
+    with_train = True
 
-getResult(models,annotationValidation,catFocus=catFocus,with_train = with_train)
\ No newline at end of file
+    main(models,imagesPath,annotationValidation,annotationTrain= annotationTrain,catFocus=catFocus,overall=True,with_train=with_train)
@@ -0,0 +1,50 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import numpy as np
+from pycocotools.cocoeval import oks, Params
+
+###############################################################################
+
+# Standard deviation of the 17 keypoints of a person, the ones of `COCOeval` for the 'keypoints' evaluation.
+SIGMAS = Params('keypoints').kpt_oks_sigmas
+
+
+def detectionOks(keypoints, areas, sigmas=SIGMAS):
+    """
+    OKS of every pair of detections, each detection being compared to the others as a ground truth with all
+    its keypoints visible and the area of its bbox.
+    :param keypoints: [NxK*3] keypoints of the form [x1,y1,v1,...] in the image scale
+    :param areas: [N] area of the bbox of each detection in the image scale
+    :return: [NxN] OKS, row i is the OKS of every detection with the detection i as reference
+    """
+    keypoints = np.asarray(keypoints, dtype=np.float64)
+    reference = keypoints.copy()
+    reference[:, 2::3] = 2
+    return oks(keypoints, reference, np.zeros((len(keypoints), 4)), np.asarray(areas, dtype=np.float64), sigmas).T
+
+
+class KeypointOKS:
+
+    #The goal of this class is to compute the OKS in between the detections of a category in an image only once
+    #for the whole sweep of OKS thresholds of the keypoint nms.
+
+    #   Parameters:
+    #    detections:         - dictionnary {(imgId, catId): [NxN] OKS in between the detections, see `detectionOks`}
+
+    def __init__(self):
+        self.detections = dict()
+
+    def detectionOKS(self, imgId, catId, keypoints, areas):
+        """
+        :param keypoints: [NxK*3] keypoints of every detection of the category in the image before nms
+        :param areas: [N] area of their bbox
+        :return: [NxN] OKS in between the detections, computed at the first call
+        """
+        key = (imgId, catId)
+        if key not in self.detections:
+            self.detections[key] = detectionOks(keypoints, areas)
+        return self.detections[key]
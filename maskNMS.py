@@ -0,0 +1,91 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import numpy as np
+from pycocotools import mask as maskUtils
+
+###############################################################################
+
+
+def encodeMasks(masks):
+    """
+    Encode binary masks in the compressed RLE of pycocotools, with the counts as a string to be written in json.
+    :param masks: [NxHxW] binary masks in the image scale
+    :return: list of N dictionnaries {"size": [H, W], "counts": str}
+    """
+    masks = np.asarray(masks, dtype=np.uint8)
+    if len(masks) == 0:
+        return list()
+    rles = maskUtils.encode(np.asfortranarray(masks.transpose(1, 2, 0)))
+    return [{"size": list(rle["size"]), "counts": rle["counts"].decode("ascii")} for rle in rles]
+
+
+def maskNMS(iou, scores, iouThreshold, maxOutput=100):
+    """
+    Non max suppression from the IoU of every pair of detections, e.g between their masks. Same greedy order
+    as `tf.image.non_max_suppression`: a detection is suppressed when its IoU with a kept one is above the threshold.
+    :param iou: [NxN] IoU in between the detections
+    :param scores: [N] score of each detection
+    :return: indexes of the detections kept, by decreasing score
+    """
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind='mergesort')
+    suppressed = np.zeros((len(order),), dtype=bool)
+    selected = list()
+    for i in order:
+        if suppressed[i]:
+            continue
+        selected.append(i)
+        if len(selected) == maxOutput:
+            break
+        suppressed |= iou[i] > iouThreshold
+    return np.array(selected, dtype=np.int64)
+
+
+class MaskIoU:
+
+    #The goal of this class is to compute the IoU of the masks of a category in an image only once for the whole sweep
+    #of IoU thresholds: in between the detections for `maskNMS`, and with the ground truth for `COCOeval.computeIoU`
+    #when it is given as `cocoEval.maskIoU`. Every detection left by the nms keeps the index of its mask in "sourceIndex",
+    #so the rows of the detections kept are read from the matrices of all the detections. The masks stay in RLE.
+
+    #   Parameters:
+    #    masks:              - dictionnary {(imgId, catId): list of the RLE of every detection before nms}
+    #    detections:         - dictionnary {(imgId, catId): [NxN] IoU in between the detections}
+    #    groundTruth:        - dictionnary {(imgId, catId): [NxG] IoU of the detections with the ground truth}
+
+    def __init__(self):
+        self.masks = dict()
+        self.detections = dict()
+        self.groundTruth = dict()
+
+    def setMasks(self, imgId, catId, masks):
+        """
+        Keep the masks of every detection of a category in an image, unless they are already known.
+        :return: None
+        """
+        if (imgId, catId) not in self.masks:
+            self.masks[imgId, catId] = masks
+
+    def detectionIoU(self, imgId, catId):
+        """
+        :return: [NxN] IoU in between the masks of the detections, computed at the first call
+        """
+        key = (imgId, catId)
+        if key not in self.detections:
+            masks = self.masks[key]
+            self.detections[key] = np.asarray(maskUtils.iou(masks, masks, [0] * len(masks))).reshape((len(masks), len(masks)))
+        return self.detections[key]
+
+    def groundTruthIoU(self, imgId, catId, gt, iscrowd):
+        """
+        :param gt: RLE of the ground truth, in the order of `COCOeval`
+        :param iscrowd: crowd flag of each ground truth
+        :return: [NxG] IoU of the masks of the detections with the ground truth, computed at the first call
+        """
+        key = (imgId, catId)
+        if key not in self.groundTruth:
+            self.groundTruth[key] = np.asarray(maskUtils.iou(self.masks[key], gt, iscrowd)).reshape((len(self.masks[key]), len(gt)))
+        return self.groundTruth[key]
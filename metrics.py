@@ -0,0 +1,162 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import json
+import os
+import socket
+import time
+import cocoCache
+
+###############################################################################
+
+# Prefix of every metric written in the prometheus format.
+PREFIX = "optimisenms_"
+
+
+class Metrics:
+
+    #The goal of this class is to export the progress of a long analysis in a file refreshed while it runs,
+    #so that a monitoring agent can scrape it when no one looks at the tqdm bars.
+
+    #   Parameters:
+    #    path:               - file where the metrics are written. If set to None nothing is exported.
+    #                           A path ending with ".prom" is written in the prometheus textfile format (replaced at each refresh),
+    #                           any other path gets one json object appended per refresh.
+    #    interval:           - minimal number of seconds in between two refreshes
+    #    job:                - name of the analysis running e.g "nmsAnalysis"
+    #    labels:             - dictionnary of labels attached to the metrics e.g {"model": ...}
+    #    counters:           - dictionnary {name: value} of what was done since `start`
+    #    totals:             - dictionnary {name: value} of what has to be done, used for the ETA
+
+    def __init__(self, path=None, interval=10.):
+        """
+        Initialize Metrics
+        :param path: file where the metrics are written, None to disable the export
+        :param interval: minimal number of seconds in between two refreshes
+        :return: None
+        """
+        self.path = path
+        self.interval = interval
+        self.start("")
+
+    def start(self, job, **totals):
+        """
+        Reset the counters for a new analysis.
+        :param job: name of the analysis
+        :param totals: what has to be done e.g thresholds=..., categories=...
+        :return: None
+        """
+        self.job = job
+        self.labels = dict()
+        self.counters = dict()
+        self.totals = dict(totals)
+        self._startTime = time.time()
+        self._firstTime = dict()  # time of the first increment of each counter
+        self._lastWrite = (self._startTime, dict())  # time and counters of the last refresh
+
+    def setTotal(self, name, value):
+        """
+        Set what has to be done for a counter e.g the number of images to infer.
+        :return: None
+        """
+        self.totals[name] = value
+
+    def increment(self, name, value=1):
+        """
+        Add `value` to the counter `name` and refresh the file if `interval` seconds passed.
+        :return: None
+        """
+        if self.path is None:
+            return
+        if name not in self.counters:
+            self.counters[name] = 0
+            self._firstTime[name] = time.time()
+        self.counters[name] += value
+        self.update()
+
+    def update(self, force=False):
+        """
+        Refresh the file if `interval` seconds passed since the last refresh, or if `force` is set to True.
+        :return: None
+        """
+        if self.path is None:
+            return
+        now = time.time()
+        if not force and now - self._lastWrite[0] < self.interval:
+            return
+        values = self.snapshot(now)
+        if self.path.endswith(".prom"):
+            self._writePrometheus(values)
+        else:
+            self._writeJsonLines(values, now)
+        self._lastWrite = (now, dict(self.counters))
+
+    def snapshot(self, now=None):
+        """
+        :return: dictionnary {metric: value} with:
+
+        - {counter}_total, the counters
+        - {counter}_per_second, their rate since the last refresh
+        - {counter}_expected, the totals
+        - eta_seconds, the estimated remaining time from the rate of the `thresholds` counter, or `images` during the inference
+        - {cache}_cache_hits_total, {cache}_cache_misses_total and {cache}_cache_hit_ratio for the annotation and detection caches
+        - elapsed_seconds
+        """
+        now = time.time() if now is None else now
+        lastTime, lastCounters = self._lastWrite
+        values = {"elapsed_seconds": now - self._startTime}
+        for name, value in self.counters.items():
+            values[name + "_total"] = value
+            if now > lastTime:
+                values[name + "_per_second"] = (value - lastCounters.get(name, 0)) / (now - lastTime)
+        for name, value in self.totals.items():
+            values[name + "_expected"] = value
+        for name in ("thresholds", "images"):
+            done = self.counters.get(name, 0)
+            if name in self.totals and 0 < done < self.totals[name]:
+                values["eta_seconds"] = (now - self._firstTime[name]) / done * (self.totals[name] - done)
+                break
+        caches = {
+            "annotation": (cocoCache.cacheStatistics["registry"] + cocoCache.cacheStatistics["disk"], cocoCache.cacheStatistics["miss"]),
+            "detection": (self.counters.get("detection_cache_hits", 0), self.counters.get("detection_cache_misses", 0)),
+        }
+        for cache, (hits, misses) in caches.items():
+            values[cache + "_cache_hits_total"] = hits
+            values[cache + "_cache_misses_total"] = misses
+            if hits + misses:
+                values[cache + "_cache_hit_ratio"] = hits / (hits + misses)
+        return values
+
+    def _labels(self):
+        """
+        :return: the labels in the prometheus format
+        """
+        labels = dict(job=self.job, host=socket.gethostname(), **self.labels)
+        return ",".join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items())
+
+    def _writePrometheus(self, values):
+        """
+        Replace the file with the metrics in the prometheus textfile format. The file is renamed into place so that
+        the monitoring agent never reads a partial file.
+        """
+        labels = self._labels()
+        lines = list()
+        for name, value in sorted(values.items()):
+            lines.append("# TYPE {}{} {}".format(PREFIX, name, "counter" if name.endswith("_total") else "gauge"))
+            lines.append("{}{}{{{}}} {}".format(PREFIX, name, labels, float(value)))
+        tmpFile = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmpFile, "w") as fs:
+            fs.write("\n".join(lines) + "\n")
+        os.replace(tmpFile, self.path)
+
+    def _writeJsonLines(self, values, now):
+        """
+        Append the metrics as one json object to the file.
+        """
+        record = dict(time=now, job=self.job, **self.labels)
+        record.update(values)
+        with open(self.path, "a") as fs:
+            fs.write(json.dumps(record) + "\n")
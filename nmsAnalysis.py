@@ -7,20 +7,41 @@ __author__ = 'noahsfi'
 import glob
 import numpy as np
 import time
-import tensorflow as tf
 import json
-from matplotlib import pyplot as plt
-from object_detection.utils import ops as utils_ops
-from object_detection.core import post_processing
 from tqdm import tqdm
-from PIL import Image, ImageDraw
-from pycocotools.coco import COCO
-from pycocotools.cocoeval import COCOeval
-import copy
+from cocoCache import loadCoco
+from plotRenderer import PlotRenderer, savePrecisionToRecall, renderPrecisionToRecall
+from profiler import Profiler
+from metrics import Metrics
+from bootstrap import imageStatistics, saveImageStatistics, packImageStatistics, truncatedPrecision, sampledEstimates
+from maskNMS import MaskIoU, encodeMasks
+from keypointNMS import KeypointOKS
+from imageDecoding import readResizer, loadImage
+from prTensors import prTensors, savePRTensors
+from nmsCore import (bboxNMS, putCOCOformat, bboxDetections, segmDetections, keypointDetections, loadNMSError,
+                     evaluateDetections, sweepCategory)
 import os
-utils_ops.tf = tf.compat.v1
-# Patch the location of gfile
-tf.gfile = tf.io.gfile
+
+# tensorflow and the object detection api take seconds and hundreds of MB to import.
+# They are only needed to run a model, hence imported by `importTensorflow` on first use.
+tf = None
+utils_ops = None
+
+
+def importTensorflow():
+    """
+    Import tensorflow and the object detection utils the first time it is called.
+    :return: the tensorflow module
+    """
+    global tf, utils_ops
+    if tf is None:
+        import tensorflow
+        from object_detection.utils import ops
+        ops.tf = tensorflow.compat.v1
+        # Patch the location of gfile
+        tensorflow.gfile = tensorflow.io.gfile
+        tf, utils_ops = tensorflow, ops
+    return tf
 
 ###############################################################################
 
@@ -38,12 +59,33 @@ class nmsAnalysis:
     #                               One can give a list of category of the form ["person","car"]
     #    number_IoU_thresh:  - number of different IoU treshold to analyse in between 0.2 and 0.9
     #    overall:            - if set to True it will compute the AP to IoU treshold for the overall given categories
-    #    resFilePath:        - path to the json file where the detection results will be written in order to use COCOeval
     #    graph_precision_to_recall:  - If set to True will graph the precision to recall for every IoU
+    #    small_multiples:    - If set to True the precision to recall of a category are graphed in a single figure with one graph per IoU
+    #    plotter:            - PlotRenderer drawing the graphs in background processes
+    #    profiler:           - Profiler recording the time and memory of each stage. Set `profiler.enabled = True` to write
+    #                           a report in modelPath/nms_analysis/profile_{validation,validation_train}.json at the end of `runAnalysis`
+    #    metrics:            - Metrics exporting the progress of `runAnalysis`. Set `metrics.path` to a file scraped by your monitoring
     #    with_train:         - if set to True will replace the ration fn/npig generated by the nms on the validation data set by the one of the training.
     #                           Please run groundTruthFN before setting it to True in order to have the informations requried. See doc for more infos.
+    #    iouType:            - "bbox", or "segm" for an instance segmentation model: the nms and the evaluation use the IoU of the masks.
+    #                           The masks are kept in RLE in all_output_dict_segm.json and the results are written in modelPath/nms_analysis_segm
+    #                           "keypoints" for a keypoint model: the nms and the evaluation use the OKS of the keypoints, kept in
+    #                           all_output_dict_keypoints.json, and the results are written in modelPath/nms_analysis_keypoints
+    #    inputSize:          - None to decode the images at full resolution before the inference. "config" to read the resizer of
+    #                           modelPath/pipeline.config, or (height, width) of the input of the model: the JPEG are then decoded
+    #                           directly at a reduced resolution still larger than the input, see `imageDecoding.loadImage`
+    #    maxOutput:          - maximal number of detections per category kept by the nms in an image, `max_output_size` of the nms
+    #    sampleImages:       - None to sweep all the images. Otherwise maximal number of images of each category drawn at random
+    #                           for a fast approximate sweep: the AP and false negatives are written with their standard error
+    #                           in modelPath/nms_analysis/sampled, see `writeSampledClassAP`. The categories with fewer images keep them all.
+    #    sampleSeed:         - seed of the images drawn when `sampleImages` is set, the seed of a category being sampleSeed + its index
     #    study:              - dictionnary containing the required current informations by the class when analysing a given model/category
 
+    # IoU threshold of the evaluation of the AP written, see `shardStatistics`
+    AP_IOU_THRESHOLD = .5
+    # Folder of the results inside the model folder for each `iouType`
+    ANALYSIS_FOLDERS = {"bbox": "nms_analysis", "segm": "nms_analysis_segm", "keypoints": "nms_analysis_keypoints"}
+
     def __init__(self, models, imagesPath, annotationPath, catFocus=None, number_IoU_thresh=50, overall=False):
         """
         The goal of this class is giving annotations and models, to compute the AP[IoU=0.5] depending 
@@ -66,7 +108,6 @@ class nmsAnalysis:
         self.models = models
         self.imagesPath = imagesPath
         self.annotationPath = annotationPath
-        self.resFilePath = self._createResFilePath()
         self.number_IoU_thresh = number_IoU_thresh
         self.iou_thresholdXaxis = np.linspace(0.2, 0.9, number_IoU_thresh)
         self.overall = overall
@@ -79,44 +120,51 @@ class nmsAnalysis:
             "img": dict(),
             "catId": int(),
             "catStudied": str(),
+            "population": int(),  # number of images of the category studied, see `sampleImages`
             "all_output_dict": dict(),
             "modelPath": str(),
             "model": None,  # TF model
             "iouThreshold": float(),
+            "detections": np.zeros((0, 7)),  # [Nx7] results {imageID,x1,y1,w,h,score,class} given to COCO.loadResBbox
+            "precisions": list(),  # precision to recall of the category studied for each IoU threshold
+            "prTensors": list(),  # precision and recall of COCOeval for each IoU threshold, see `prTensors`
+            "maskIoU": None,  # MaskIoU of the category studied when `iouType` is "segm"
+            "keypointOKS": None,  # KeypointOKS of the category studied when `iouType` is "keypoints"
         }
 
         # Can be changed after initialization
         self.graph_precision_to_recall = False
+        self.small_multiples = False
         self.with_train = False
-
-    def _createResFilePath(self):
-        """
-        :return: path to the json file where the detection results will be written in order to use COCOeval
-        """
-        return "cocoDt.json"
+        self.iouType = "bbox"
+        self.inputSize = None
+        self.maxOutput = 100
+        self.sampleImages = None
+        self.sampleSeed = 0
+        self.plotter = PlotRenderer()
+        self.profiler = Profiler()
+        self.metrics = Metrics()
 
     def loadModel(self, modelPath):
         """
         Load associate tf OD model
         :return: a trackable object from the tf librairy
         """
+        importTensorflow()
         model_dir = modelPath + "/saved_model"
         detection_model = tf.saved_model.load(str(model_dir))
         detection_model = detection_model.signatures['serving_default']
-        general_folder = "{}/nms_analysis".format(modelPath)
-        if not os.path.isdir(general_folder):
-            os.mkdir(general_folder)
-        
         return detection_model
 
     def loadCocoApi(self):
         """
-        Read self.annotationPath and load coco associated to it
+        Read self.annotationPath and load coco associated to it.
+        The parsed annotations are cached on disk and shared by every class of the same run, see `cocoCache.loadCoco`.
         :return: coco object
         """
         annFile = self.annotationPath
         # initialize COCO api for instance annotations
-        coco = COCO(annFile)
+        coco = loadCoco(annFile)
         return coco
 
     def getCategories(self):
@@ -146,14 +194,29 @@ class nmsAnalysis:
                 'id': 100274
             }
         :param self.study["catId"]: Index associated to the input category
+        :param self.study["population"]: number of images of the category, more than len(self._study["img"]) when `sampleImages` is set
         :return: None
         """
-        catIds = self.coco.getCatIds(catNms=[category])
-        imgIds = self.coco.getImgIds(catIds=catIds)
-        img = self.coco.loadImgs(imgIds)
+        with self.profiler.stage("getImgClass"):
+            catIds = self.coco.getCatIds(catNms=[category])
+            imgIds = self.coco.getImgIds(catIds=catIds)
+            img = self.coco.loadImgs(self.sampleImgIds(imgIds, catIds[0]))
 
         self._study["img"] = img
         self._study["catId"] = catIds[0]
+        self._study["population"] = len(imgIds)
+
+    def sampleImgIds(self, imgIds, catId):
+        """
+        Draw without replacement `self.sampleImages` images of a category, the same for every model and IoU threshold.
+        :param imgIds: ids of all the images of the category
+        :param catId: index of the category, added to `self.sampleSeed`
+        :return: sorted ids of the images sampled, all of `imgIds` when `sampleImages` is None or larger
+        """
+        if self.sampleImages is None or len(imgIds) <= self.sampleImages:
+            return imgIds
+        random = np.random.RandomState(self.sampleSeed + catId)
+        return sorted(int(imgId) for imgId in random.choice(sorted(imgIds), self.sampleImages, replace=False))
 
     def getCatId(self, category):
         """
@@ -163,31 +226,61 @@ class nmsAnalysis:
         catIds = self.coco.getCatIds(catNms=[category])
         return catIds[0]
 
-    def load_all_output_dict(self):
+    def imagesToInfer(self, categories, all_output_dict):
+        """
+        Plan the inference from the annotation file: only the images containing one of `categories` are read by the analysis.
+        :param categories: list of categories studied
+        :param all_output_dict: inferences already computed, see `computeInferenceBbox`
+        :return: file names of the images of `categories` present in `self.imagesPath` and missing in `all_output_dict`
+        """
+        if not categories or self.imagesPath is None:
+            return list()
+        imgIds = set()
+        for catId in self.coco.getCatIds(catNms=categories):
+            imgIds.update(self.sampleImgIds(self.coco.getImgIds(catIds=[catId]), catId))
+        fileNames = sorted(img["file_name"] for img in self.coco.loadImgs(list(imgIds)) if img["file_name"] not in all_output_dict)
+        return [fileName for fileName in fileNames if os.path.isfile("/".join([self.imagesPath, fileName]))]
+
+    def _detectionsFile(self):
+        """
+        :return: json of the inferences of the model studied, modelPath/all_output_dict.json or all_output_dict_{iouType}.json
+        """
+        return self._study["modelPath"] + ("/all_output_dict.json" if self.iouType == "bbox" else "/all_output_dict_{}.json".format(self.iouType))
+
+    def load_all_output_dict(self, categories=None):
 
         """
-        Write the dictionnary containing all detections made by the model studied inside a json if the file "all_outpout_dict.json" 
-        is not existing inside the model folder in order to fast next use of the class with the same model. For more details look at
-        `computeInferenceBbox`.
+        Read the dictionnary containing all detections made by the model studied from the json "all_outpout_dict.json" inside the model folder
+        and infer only the images of the categories studied that are missing in it, see `imagesToInfer`. The json is then updated
+        in order to fast next use of the class with the same model. For more details look at `computeInferenceBbox`.
         
-        If the file already exists then read it.
+        The model is only loaded when some images are missing.
         
         Update self._study["all_output_dict"] to be equal to it.
         
+        :param categories: categories whose images are needed, by default `self.categories`
         :return: None
         """
-        self._study["model"] = self.loadModel(self._study["modelPath"])
-        filename = self._study["modelPath"] + "/all_output_dict.json"
-        is_all_output_dict = os.path.isfile(filename)
-        if not is_all_output_dict:
-            print("Compute all the inferences boxes in the validation set for the model {} and save it for faster computations of you reuse the interface in {}/all_output_dict.json".format(
-                self._study["modelPath"], self._study["modelPath"]))
-            all_output_dict = self.computeInferenceBbox(self._study["model"])
-            with open(filename, 'w') as fs:
-                json.dump(all_output_dict, fs, indent=1)
-        else:
-            with open(filename, 'r') as fs:
+        general_folder = self._analysisFolder()
+        os.makedirs(general_folder, exist_ok=True)
+        filename = self._detectionsFile()
+        all_output_dict = dict()
+        if os.path.isfile(filename):
+            with self.profiler.stage("loadDetections"), open(filename, 'r') as fs:
                 all_output_dict = json.load(fs)
+        fileNames = self.imagesToInfer(self.categories if categories is None else categories, all_output_dict)
+        self.metrics.increment("detection_cache_misses" if fileNames else "detection_cache_hits")
+        if fileNames:
+            print("Compute the inferences of the {} images missing for the model {} and save them for faster computations of you reuse the interface in {}".format(
+                len(fileNames), self._study["modelPath"], filename))
+            with self.profiler.stage("loadModel"):
+                self._study["model"] = self.loadModel(self._study["modelPath"])
+            with self.profiler.stage("computeInferenceBbox"):
+                all_output_dict.update(self.computeInferenceBbox(fileNames))
+            tmpFile = "{}.{}.tmp".format(filename, os.getpid())
+            with open(tmpFile, 'w') as fs:
+                json.dump(all_output_dict, fs, indent=1)
+            os.replace(tmpFile, filename)
         self._study["all_output_dict"] = all_output_dict
 
     def expand_image_to_4d(self, image):
@@ -208,9 +301,22 @@ class nmsAnalysis:
         assert training_image.shape[-1] == 3
         return training_image
 
-    def run_inference_for_single_image(self, image):
+    def _resizer(self):
+        """
+        :return: resizer of the model studied described by `self.inputSize`, see `imageDecoding.readResizer`. None to decode at full resolution
+        """
+        if self.inputSize is None:
+            return None
+        if self.inputSize == "config":
+            pipelineFile = self._study["modelPath"] + "/pipeline.config"
+            return readResizer(pipelineFile) if os.path.isfile(pipelineFile) else None
+        height, width = self.inputSize
+        return {"height": int(height), "width": int(width)}
+
+    def run_inference_for_single_image(self, image, imageSize=None):
         """
         :param image: a numpy array representing an image in 4d
+        :param imageSize: (height, width) of the image at full resolution, where the masks are reframed. By default the size of `image`
         
         :return:
             If image in right format an output_dict:
@@ -220,6 +326,7 @@ class nmsAnalysis:
                 valuesType = [int,list of int, list of 4 integers, list int]
             Else: None
         """
+        importTensorflow()
         image = np.asarray(image)
         # The input needs to be a tensor, convert it using `tf.convert_to_tensor`.
         input_tensor = tf.convert_to_tensor(image)
@@ -239,9 +346,20 @@ class nmsAnalysis:
         num_detections = int(output_dict.pop('num_detections'))
         output_dict = {key: value[0, :num_detections].numpy()
                        for key, value in output_dict.items()}
+        if self.iouType == "segm":
+            assert 'detection_masks' in output_dict, "The model does not output masks, please use iouType 'bbox'"
+            # the masks are relative to their bbox, reframe them to the image and keep them in RLE
+            masks = utils_ops.reframe_box_masks_to_image_masks(
+                tf.convert_to_tensor(output_dict['detection_masks']), tf.convert_to_tensor(output_dict['detection_boxes']),
+                *(image.shape[:2] if imageSize is None else imageSize))
+            detection_masks = encodeMasks(masks.numpy() > 0.5)
+        if self.iouType == "keypoints":
+            assert 'detection_keypoints' in output_dict, "The model does not output keypoints, please use iouType 'bbox'"
 
         key_of_interest = ['detection_scores',
                            'detection_classes', 'detection_boxes']
+        if self.iouType == "keypoints":
+            key_of_interest += ['detection_keypoints', 'detection_keypoint_scores']
         output_dict = {key: list(output_dict[key]) for key in key_of_interest}
         output_dict["num_detections"] = int(num_detections)
         output_dict['detection_boxes'] = [[float(box) for box in output_dict['detection_boxes'][i]] for i in range(
@@ -250,51 +368,66 @@ class nmsAnalysis:
             float(box) for box in output_dict['detection_scores']]
         output_dict['detection_classes'] = [
             float(box) for box in output_dict['detection_classes']]
+        if self.iouType == "segm":
+            output_dict['detection_masks'] = detection_masks
+        if self.iouType == "keypoints":
+            # [y,x] of each keypoint in the percentage of the image scale
+            output_dict['detection_keypoints'] = [[[float(coordinate) for coordinate in keypoint] for keypoint in keypoints]
+                                                  for keypoints in output_dict['detection_keypoints']]
+            output_dict['detection_keypoint_scores'] = [[float(score) for score in scores]
+                                                        for scores in output_dict['detection_keypoint_scores']]
 
         if len(output_dict["detection_boxes"]) == 0:
             return None
         return output_dict
 
-    def computeInferenceBbox(self):
+    def computeInferenceBbox(self, fileNames=None):
         """
         For all the images in the coco img, compute the output_dict with
         `run_inference_for_single_image`. Store them as a dictionnary with keys
         being the index of the image in our coco dataset.
 
+        :param fileNames: if given, only the images of `self.imagesPath` with these file names are inferred
+
         :return:
         A dictionnary describing the inferences for each image:
         {id: keyDic = ['num_detections','detection_classes','detection_boxes',
-                    'detection_scores']}
+                    'detection_scores']}, None for the images without detection so that they are not inferred again
         """
         all_output_dict = dict()
         i = 0
-        folder = "/".join([self.imagesPath, "*.jpg"])
-        for image_path in tqdm(glob.glob(folder)):
-            # the array based representation of the image
-            image = Image.open(image_path)
-            image_np = np.array(image)
+        if fileNames is None:
+            folder = "/".join([self.imagesPath, "*.jpg"])
+            image_paths = glob.glob(folder)
+        else:
+            image_paths = ["/".join([self.imagesPath, fileName]) for fileName in fileNames]
+        self.metrics.setTotal("images", len(image_paths))
+        resizer = self._resizer()
+        for image_path in tqdm(image_paths):
+            self.metrics.increment("images")
+            # the array based representation of the image, decoded at the size of the input of the model if known
+            image_np, imageSize = loadImage(image_path, resizer)
             """If image is gray_scale one need to reshape to dimension 4
             using the utility function defined above"""
             if len(image_np.shape) == 2:
                 image_np = self.expand_image_to_4d(image_np)
             # Actual detection.
-            output_dict = self.run_inference_for_single_image(image_np)
-            if output_dict is None:
-                continue
+            output_dict = self.run_inference_for_single_image(image_np, imageSize)
             idx = image_path.split("/")[-1]
             all_output_dict[idx] = output_dict
             i += 1
         return all_output_dict
 
-    def computeNMS(self, output_dict):
+    def computeNMS(self, output_dict, iouThreshold=None, maxOutput=None):
         """
-        Apply the non max suppresion on the given detections of an image. The IoU treshold used is `self._study[iouThreshold]` updated in 
-        `getClassAP` or `getOverallAP`.
+        Apply the non max suppresion on the given detections of an image, see `nmsCore.bboxNMS`. The IoU treshold used is
+        `self._study[iouThreshold]` updated in `evaluateThreshold` or `getOverallAP` unless `iouThreshold` is given.
         
         input:
         ----------
         - output_dict: the dictionnary ouput of the inference computation
         keyDic = ['num_detections','detection_classes','detection_boxes','detection_scores']
+        - iouThreshold, maxOutput: by default `self._study["iouThreshold"]` and `self.maxOutput`
 
         output:
         ----------
@@ -303,125 +436,115 @@ class nmsAnalysis:
         - final_scores : list of float64 scoring each bbox
         - final_boxes : list of coordinates of each bbox (format : [ymin,xmin,ymax,xmax] )
         """
+        with self.profiler.stage("computeNMS"):
+            return bboxNMS(output_dict, self._study["iouThreshold"] if iouThreshold is None else iouThreshold,
+                           self.maxOutput if maxOutput is None else maxOutput)
 
-        if not output_dict:
-            return None, None, None
+    def putCOCOformat(self, boxes, im_width, im_height):
+        """
+        Transform a bbox in the tensorflow OD format into cocoformat, see `nmsCore.putCOCOformat`.
+        :return: List of the form [left,top,width,height] describing the bbox, in the image scale
+        """
+        return putCOCOformat(boxes, im_width, im_height)
 
-        # Apply the nms
-        box_selection = tf.image.non_max_suppression_with_scores(
-            output_dict['detection_boxes'], output_dict['detection_scores'], 100,
-            iou_threshold=float(self._study["iouThreshold"]), score_threshold=float(
-                '-inf'),
-            soft_nms_sigma=0.0, name=None)
+    def writeResJson(self, newFile=True):
+        """
+        Write in `self._study["detections"]` the final detections for a unique category after having applied `computeNMS`.
+        Each row is of the form {imageID,x1,y1,w,h,score,class} in order to be loaded with `COCO.loadResBbox`.
 
-        # Index in the list output_dict['detection_boxes']
-        final_boxes = list(box_selection[0].numpy())
-        # Index in the list output_dict['detection_scores']
-        final_scores = list(box_selection[1].numpy())
-        final_classes = []
-        for i in range(len(final_boxes)):
-            index = final_boxes[i]
-            # We want the actual bbox coordinate not the index
-            final_boxes[i] = output_dict['detection_boxes'][index]
-            final_classes.append(output_dict['detection_classes'][index])
+        input:
+        ----------
+        - newFile: if set to True replace the previous detections else append the detections to them
+            
+        output:
+        ----------
+        - List of the image ids that are studied
+        """
+        if self.iouType == "segm":
+            return self.writeResSegm(newFile)
+        if self.iouType == "keypoints":
+            return self.writeResKeypoints(newFile)
+        result, imgIds = bboxDetections(self._study["img"], self._study["all_output_dict"], self._study["catId"], self.computeNMS)
+        if newFile:
+            self._study["detections"] = result
+        else:
+            self._study["detections"] = np.concatenate((self._study["detections"], result))
 
-        return final_classes, final_scores, final_boxes
+        return imgIds
 
-    def putCOCOformat(self, boxes, im_width, im_height):
+    def writeResSegm(self, newFile=True):
         """
-        Transform a bbox in the tensorflow OD format into cocoformat
+        Write in `self._study["detections"]` the final detections for a unique category after having applied `maskNMS` on the IoU
+        of their masks. Each detection is of the form {image_id, category_id, segmentation, score, sourceIndex} in order to be loaded
+        with `COCO.loadRes`, sourceIndex being its index in the detections of the category in the image before nms.
+        The IoU of the masks are computed once per image in `self._study["maskIoU"]` and reused for every IoU threshold.
+
         input:
         ----------
-        -  boxes: List of the form [ymin,xmin,ymax,xmax] in the percentage of the image scale
-        -  im_width: real width of the associated image
-        -  im_height: real height of the associated image
-        
+        - newFile: if set to True replace the previous detections else append the detections to them
+            
         output:
         ----------
-        -   List of the form [left,top,width,height] describing the bbox, in the image scale
+        - List of the image ids that are studied
         """
-        # float to respect json format
-        left = float(boxes[1]) * im_width
-        right = float(boxes[3]) * im_width
-        top = float(boxes[0]) * im_height
-        bottom = float(boxes[2]) * im_height
-        width = right - left
-        height = bottom - top
-
-        return [left, top, width, height]
+        result, imgIds = segmDetections(self._study["img"], self._study["all_output_dict"], self._study["catId"],
+                                        self._study["iouThreshold"], self.maxOutput, self._study["maskIoU"], self.profiler)
+        if newFile:
+            self._study["detections"] = result
+        else:
+            self._study["detections"] = list(self._study["detections"]) + result
+        return imgIds
 
-    def writeResJson(self, newFile=True):
+    def writeResKeypoints(self, newFile=True):
         """
-        Write a `self.resFilePath` in the coco annotations format describing final detections for a unique category after having applied `computeNMS`.
+        Write in `self._study["detections"]` the final detections for a unique category after having applied `maskNMS` on the OKS
+        of their keypoints. Each detection is of the form {image_id, category_id, keypoints, score} in order to be loaded
+        with `COCO.loadRes`, the keypoints being [x1,y1,score1,...] in the image scale.
+        The OKS in between the detections are computed once per image in `self._study["keypointOKS"]` and reused for every threshold.
 
         input:
         ----------
-        - newFile: if set to True rewrite the file else append the detections to the file
+        - newFile: if set to True replace the previous detections else append the detections to them
             
         output:
         ----------
         - List of the image ids that are studied
         """
-        result = []
-        imgIds = set()  # set to avoid repetition
-        key_of_interest = ['detection_scores',
-                           'detection_classes', 'detection_boxes']
-        for img in self._study["img"]:
-            imgId = img["id"]
-            imgIds.add(imgId)
-
-            output_dict = copy.deepcopy(
-                self._study["all_output_dict"][img['file_name']])
-            if output_dict == None:
-                continue
-
-            # remove detection of other classes that are not studied
-            idx_to_remove = [i for i, x in enumerate(
-                output_dict["detection_classes"]) if x != self._study["catId"]]
-            for index in sorted(idx_to_remove, reverse=True):
-                del output_dict['detection_scores'][index]
-                del output_dict['detection_classes'][index]
-                del output_dict['detection_boxes'][index]
-                output_dict["num_detections"] -= 1
-            num_detections = output_dict["num_detections"]
-            output_dict = {key: np.array(
-                output_dict[key]) for key in key_of_interest}
-            output_dict["num_detections"] = num_detections
-            if len(output_dict['detection_boxes']) == 0:
-                output_dict = None
-
-            final_classes, final_scores, final_boxes = self.computeNMS(
-                output_dict)
-
-            if not final_classes:
-                continue
-
-            for j in range(len(final_classes)):
-
-                #ex : {"image_id":42,"category_id":18,"bbox":[258.15,41.29,348.26,243.78],"score":0.236}
-                properties = {}
-                # json format doesnt support int64
-                properties["category_id"] = int(final_classes[j])
-                properties["image_id"] = imgId
-                im_width = img['width']
-                im_height = img['height']
-                # we want [ymin,xmin,ymax,xmax] -> [xmin,ymin,width,height]
-                properties["bbox"] = self.putCOCOformat(
-                    final_boxes[j], im_width, im_height)
-                properties["score"] = float(final_scores[j])
-
-                result.append(properties)
+        result, imgIds = keypointDetections(self._study["img"], self._study["all_output_dict"], self._study["catId"],
+                                            self._study["iouThreshold"], self.maxOutput, self._study["keypointOKS"], self.profiler)
         if newFile:
-            with open(self.resFilePath, 'w') as fs:
-                json.dump(result, fs, indent=1)
+            self._study["detections"] = result
         else:
-            with open(self.resFilePath, 'r') as fs:
-                data = json.load(fs)
-                result += data
-            with open(self.resFilePath, 'w') as fs:
-                json.dump(result, fs, indent=1)
+            self._study["detections"] = list(self._study["detections"]) + result
+        return imgIds
 
-        return list(imgIds)
+    def _resetPairwiseIoU(self):
+        """
+        Forget the IoU of the masks and the OKS of the keypoints kept for the previous sweep.
+        :return: None
+        """
+        self._study["maskIoU"] = MaskIoU()
+        self._study["keypointOKS"] = KeypointOKS()
+
+    def _analysisFolder(self):
+        """
+        :return: folder of the results of the model studied, modelPath/nms_analysis or modelPath/nms_analysis_segm
+        """
+        return "{}/{}".format(self._study["modelPath"], self.ANALYSIS_FOLDERS[self.iouType])
+
+    def evaluateThreshold(self, iouThreshold):
+        """
+        Apply the nms with `iouThreshold` to the images of `self._study["img"]` and evaluate the detections of
+        `self._study["catStudied"]` left.
+        :return: COCOeval after `accumulate` and `summarize`, None if the detections could not be loaded
+        """
+        self._study["iouThreshold"] = iouThreshold
+        self.profiler.setLabels(self._study["catStudied"], iouThreshold)
+        with self.profiler.stage("writeResJson"):
+            imgIds = self.writeResJson()
+        nmsError = loadNMSError(self._study["catStudied"]) if self.with_train else None
+        return evaluateDetections(self.coco, self._study["detections"], imgIds, self._study["catId"], iouThreshold, self.iouType,
+                                  self._study["catStudied"], nmsError, self._study["maskIoU"], self.profiler)
 
     def getClassAP(self):
         """
@@ -433,68 +556,152 @@ class nmsAnalysis:
         :return: None
         """
 
-        AP = []
-        FN = []
-        computeInstances = True
-        for iouThreshold in tqdm(self.iou_thresholdXaxis, desc="progressbar IoU Threshold"):
-
-            self._study["iouThreshold"] = iouThreshold
-            imgIds = self.writeResJson()
-            try:
-                # Load cocoapi object for the detections
-                cocoDt = self.coco.loadRes(self.resFilePath)
-            except:
-                return None
-            # load COCOeval object to compare groundtruth and detections
-            cocoEval = COCOeval(self.coco, cocoDt, 'bbox')
-            cocoEval.params.imgIds = imgIds
-            cocoEval.params.catIds = self._study["catId"]
-            # Here we increase the maxDet to 1000 (same as in model config file)
-            # Because we want to optimize the nms that is normally in charge of dealing with
-            # bbox that detects the same object twice or detection that are not very precise
-            # compared to the best one.
-            cocoEval.params.maxDets = [1, 10, 1000]
-            cocoEval.evaluate()
-            # Count the number of false negatives and number of instances
-            number_FN = 0
-            if computeInstances:
-                instances_non_ignored = 0
-            for evalImg in cocoEval.evalImgs:
-                number_FN += sum(evalImg["FN"])
-                if computeInstances:
-                    instances_non_ignored += sum(
-                        np.logical_not(evalImg['gtIgnore']))
-            computeInstances = False
-            FN.append(int(number_FN))
-            cocoEval.accumulate(
-                iouThreshold, withTrain=self.with_train, category=self._study["catStudied"])
-
-            cocoEval.summarize()
-            # readDoc and find self.evals
-            AP.append(cocoEval.stats[1])
-            precisions = cocoEval.s.reshape((101,))
-            if self.graph_precision_to_recall:
-                self.precisionToRecall(precisions)
-
+        nmsError = loadNMSError(self._study["catStudied"]) if self.with_train else None
+        curve = sweepCategory(self.coco, self._study["all_output_dict"], self._study["catStudied"],
+                              tqdm(self.iou_thresholdXaxis, desc="progressbar IoU Threshold"), self.iouType, self.maxOutput,
+                              nmsError, self.computeNMS, self.profiler, self.metrics, self._study["img"])
+        if curve is None:
+            return None
+        if self.sampleImages is not None:
+            self.writeSampledClassAP("AP[IoU:0.5]", packImageStatistics(curve["image ids"], self.iou_thresholdXaxis,
+                                                                        curve["image statistics"]),
+                                     curve["image false negatives"])
+            return None
+        self._study["precisions"] = list()
+        for precisions in curve["precisions"]:
+            self.precisionToRecall(precisions)
+
+        self.writeClassAP(curve["AP[IoU:0.5]"], curve["False Negatives"], curve["number of instances"])
+        saveImageStatistics(self._studyFolder("image_statistics") + self._study["catStudied"].replace(' ', '_') + ".npz",
+                            curve["image ids"], self.iou_thresholdXaxis, curve["image statistics"])
+        savePRTensors(self._studyFolder("pr_tensors") + self._study["catStudied"].replace(' ', '_') + ".npz",
+                      self.iou_thresholdXaxis, curve["pr tensors"], curve["params"])
+        dataFile = self.savePrecisionToRecall()
+        if self.graph_precision_to_recall:
+            self.plotPrecisionToRecall(dataFile)
+
+    def writeClassAP(self, AP, FN, instances):
+        """
+        Write the AP[IoU=0.5] and the number of false negatives of `self._study["catStudied"]` for every IoU threshold
+        in modelPath/nms_analysis/AP[IoU=0.5]/{validation,validation_train}/category.json
+        
+        :param AP: [T] AP of each IoU threshold
+        :param FN: [T] number of false negatives of each IoU threshold
+        :param instances: number of non ignored instances
+        :return: None
+        """
         # Create folder if necessary and write result
         
-        general_folder = "{}/nms_analysis".format(self._study["modelPath"])
-        if not os.path.isdir(general_folder):
-            os.mkdir(general_folder)
+        general_folder = self._analysisFolder()
+        os.makedirs(general_folder, exist_ok=True)
         general_folder += "/AP[IoU=0.5]/"
-        if not os.path.isdir(general_folder):
-            os.mkdir(general_folder)
+        os.makedirs(general_folder, exist_ok=True)
 
         if not self.with_train:
             general_folder += "validation/"
         else:
             general_folder += "validation_train/"
-        if not os.path.isdir(general_folder):
-            os.mkdir(general_folder)
+        os.makedirs(general_folder, exist_ok=True)
 
         with open(general_folder + "{}.json".format(self._study["catStudied"]), 'w') as fs:
             json.dump({"iou threshold": list(self.iou_thresholdXaxis), "AP[IoU:0.5]": AP, "False Negatives": FN,
-                       "number of instances": int(instances_non_ignored)}, fs, indent=1)
+                       "number of instances": int(instances)}, fs, indent=1)
+
+    def _sampledFolder(self):
+        """
+        Create if necessary the folder of the sampled sweeps of the model studied.
+        :return: path to the folder
+        """
+        return self._studyFolder("sampled")
+
+    def writeSampledClassAP(self, apName, data, imageFN):
+        """
+        Write the AP and the number of false negatives of `self._study["catStudied"]` estimated from the images sampled,
+        with their standard error and the best IoU threshold, in `self._sampledFolder()`/category.json, see `bootstrap.sampledEstimates`.
+
+        :param apName: name of the AP in the json, e.g "AP[IoU:0.5]"
+        :param data: statistics of the sampled images, see `bootstrap.packImageStatistics`
+        :param imageFN: [TxN] number of false negatives of each sampled image, see `EvalImgs.imageCounts`
+        :return: None
+        """
+        estimates = sampledEstimates(data, imageFN, self._study["population"], seed=self.sampleSeed)
+        with open(self._sampledFolder() + "{}.json".format(self._study["catStudied"]), 'w') as fs:
+            json.dump({"iou threshold": list(self.iou_thresholdXaxis), apName: list(estimates["AP"]),
+                       apName + " standard error": list(estimates["AP standard error"]),
+                       "False Negatives": list(estimates["False Negatives"]),
+                       "False Negatives standard error": list(estimates["False Negatives standard error"]),
+                       "best iou threshold": estimates["best iou threshold"],
+                       "best iou threshold interval": list(estimates["best iou threshold interval"]),
+                       "sampled images": len(data["image_ids"]), "images": self._study["population"]}, fs, indent=1)
+        low, high = estimates["best iou threshold interval"]
+        print("{}: best iou threshold {:.3f} in [{:.3f}, {:.3f}] on {} of {} images".format(
+            self._study["catStudied"], estimates["best iou threshold"], low, high, len(data["image_ids"]),
+            self._study["population"]))
+
+    def shardStatistics(self, imgIds):
+        """
+        Evaluate `self._study["catStudied"]` for every IoU threshold on the images `imgIds` only, a shard of
+        the images of the category. Nothing is written, the statistics of the shards are merged by `sharding.reduceShards`.
+        
+        :param imgIds: ids of the images of the shard, all containing the category studied
+        :return:
+        
+        - imgIds: [N] ids of the images evaluated, sorted
+        - statistics: list of the T `bootstrap.imageStatistics`
+        - FN: [T] number of false negatives of each IoU threshold
+        - instances: number of non ignored instances
+        """
+        shard = set(imgIds)
+        self._study["img"] = [img for img in self._study["img"] if img["id"] in shard]
+        self._resetPairwiseIoU()
+        statistics = list()
+        FN = list()
+        for iouThreshold in tqdm(self.iou_thresholdXaxis, desc="progressbar IoU Threshold"):
+            cocoEval = self.evaluateThreshold(iouThreshold)
+            if cocoEval is None:
+                raise ValueError("The detections of {} could not be loaded".format(self._study["catStudied"]))
+            FN.append(int(cocoEval.evalImgs.numberFN()))
+            statistics.append(imageStatistics(cocoEval, iouThr=self.AP_IOU_THRESHOLD))
+            self.metrics.increment("thresholds")
+        return cocoEval.params.imgIds, statistics, FN, int(cocoEval.evalImgs.numberInstances())
+
+    def jointSweep(self, scoreThresholds=None, maxDetections=None):
+        """
+        Sweep jointly the IoU threshold, the score threshold and the maximal number of detections per image of the nms for
+        every model and category. The nms and the evaluation run once per IoU threshold, keeping max(maxDetections) detections
+        per image, and the AP of every score threshold and maximal number of detections is read from these detections,
+        see `bootstrap.truncatedPrecision`. The surfaces are written in
+        modelPath/nms_analysis/joint_sweep/{validation,validation_train}/category.npz with the keys
+        iou_threshold [T], score_threshold [S], max_detections [M] and AP [TxSxM].
+
+        :param scoreThresholds: [S] the detections whose score is strictly above are kept, by default 0 to 0.9
+        :param maxDetections: [M] maximal numbers of detections per image, by default 1, 10, 20, 50 and 100
+        :return: dictionnary {modelPath: {category: [TxSxM] AP}}, NaN without instances
+        """
+        scoreThresholds = np.linspace(0., 0.9, 10) if scoreThresholds is None else np.asarray(scoreThresholds, dtype=np.float64)
+        maxDetections = np.array([1, 10, 20, 50, 100] if maxDetections is None else maxDetections, dtype=np.int64)
+        maxOutput = self.maxOutput
+        self.maxOutput = int(maxDetections.max())
+        surfaces = dict()
+        try:
+            for modelPath in self.models:
+                self._study["modelPath"] = modelPath
+                self.load_all_output_dict()
+                surfaces[modelPath] = dict()
+                for catStudied in tqdm(self.categories, desc="Categories Processed", leave=False):
+                    self._study["catStudied"] = catStudied
+                    self.getImgClass(catStudied)
+                    imgIds, statistics, _, _ = self.shardStatistics([img["id"] for img in self._study["img"]])
+                    data = packImageStatistics(imgIds, self.iou_thresholdXaxis, statistics)
+                    AP = np.stack([truncatedPrecision(data, t, scoreThresholds, maxDetections).mean(axis=-1)
+                                   for t in range(len(self.iou_thresholdXaxis))])
+                    np.savez_compressed(self._studyFolder("joint_sweep") + catStudied.replace(' ', '_') + ".npz",
+                                        iou_threshold=self.iou_thresholdXaxis, score_threshold=scoreThresholds,
+                                        max_detections=maxDetections, AP=AP)
+                    surfaces[modelPath][catStudied] = AP
+        finally:
+            self.maxOutput = maxOutput
+        return surfaces
 
     def getOverallAP(self):
         """
@@ -508,9 +715,12 @@ class nmsAnalysis:
         AP = []
         FN = []
         computeInstances = True
+        self._resetPairwiseIoU()
+        self._study["prTensors"] = list()
 
         for iouThreshold in tqdm(self.iou_thresholdXaxis, desc="progressbar IoU Threshold"):
             self._study["iouThreshold"] = iouThreshold
+            self.profiler.setLabels("all", iouThreshold)
             allCatIds = []
             allImgIds = []
             for i, category in tqdm(enumerate(self.categories), desc="category"):
@@ -518,54 +728,36 @@ class nmsAnalysis:
                 self.getImgClass(category)
                 allCatIds += [self._study["catId"]]
             # Create the Json result file and read it.
-                if i == 0:
-                    imgIds = self.writeResJson(newFile=True)
+                with self.profiler.stage("writeResJson"):
+                    if i == 0:
+                        imgIds = self.writeResJson(newFile=True)
 
-                else:
-                    imgIds = self.writeResJson(newFile=False)
+                    else:
+                        imgIds = self.writeResJson(newFile=False)
                 allImgIds += imgIds
-            try:
-                cocoDt = self.coco.loadRes(self.resFilePath)
-            except:
+            cocoEval = evaluateDetections(self.coco, self._study["detections"], allImgIds, allCatIds, iouThreshold, self.iouType,
+                                          maskIoU=self._study["maskIoU"], profiler=self.profiler)
+            if cocoEval is None:
                 return 1
-            cocoEval = COCOeval(self.coco, cocoDt, 'bbox')
-            cocoEval.params.imgIds = allImgIds
-            cocoEval.params.catIds = allCatIds
-            # Here we increase the maxDet to 1000 (same as in model config file)
-            # Because we want to optimize the nms that is normally in charge of dealing with
-            # bbox that detects the same object twice or detection that are not very precise
-            # compared to the best one.
-            cocoEval.params.maxDets = [1, 10, 1000]
-            cocoEval.evaluate()
-            number_FN = 0
+            number_FN = cocoEval.evalImgs.numberFN()
             if computeInstances:
-                instances_non_ignored = 0
-
-            for evalImg in cocoEval.evalImgs:
-                if evalImg != None:
-                    number_FN += sum(evalImg["FN"])
-                    if computeInstances:
-                        instances_non_ignored += sum(
-                            np.logical_not(evalImg['gtIgnore']))
+                instances_non_ignored = cocoEval.evalImgs.numberInstances()
             computeInstances = False
             FN.append(int(number_FN))
-            cocoEval.accumulate(iouThreshold, withTrain=False, category='all')
-
-            cocoEval.summarize()
             # readDoc and find self.evals
             AP.append(cocoEval.stats[1])
+            self._study["prTensors"].append(prTensors(cocoEval))
+            self.metrics.increment("thresholds")
 
-        general_folder = "{}/nms_analysis/AP[IoU=0.5]/".format(
-            self._study["modelPath"])
-        if not os.path.isdir(general_folder):
-            os.mkdir(general_folder)
+        savePRTensors(self._studyFolder("pr_tensors") + "all.npz", self.iou_thresholdXaxis, self._study["prTensors"], cocoEval.params)
+        general_folder = self._analysisFolder() + "/AP[IoU=0.5]/"
+        os.makedirs(general_folder, exist_ok=True)
 
         if not self.with_train:
             general_folder += "validation/"
         else:
             general_folder += "validation_train/"
-        if not os.path.isdir(general_folder):
-            os.mkdir(general_folder)
+        os.makedirs(general_folder, exist_ok=True)
         with open(general_folder + "all.json", 'w') as fs:
             json.dump({"iou threshold": list(self.iou_thresholdXaxis), "AP[IoU:0.5]": AP, "False Negatives": FN,
                        "number of instances": int(instances_non_ignored)}, fs, indent=1)
@@ -574,48 +766,64 @@ class nmsAnalysis:
 
     def precisionToRecall(self, precision):
         """
-        Graph the precision to recall for `self._study[IoUThreshold]`
+        Keep the precision to recall for `self._study[IoUThreshold]` in `self._study["precisions"]`.
+        The curves are written at the end of `getClassAP` with `savePrecisionToRecall` and graphed apart from the computation.
         
         :param precision: -[all] P = 101. Precision for each recall
         :return: None
         """
-        plt.figure(figsize=(18, 10))
-        recall = np.linspace(0, 1, 101)
-        iouThreshold = round(self._study["iouThreshold"], 3)
-
-        # Plot the data
-        plt.plot(recall, precision,
-                 label='Precision to recall for IoU = {}'.format(iouThreshold))
-        # Add a legend
-        plt.legend(loc="lower left")
-        plt.title('Class = {}'.format(self._study["catStudied"]))
-        plt.xlabel('Recall')
-        plt.ylabel('Precision')
-
-        # Create correct folder
-        general_folder = "{}/nms_analysis/precision_to_recall/".format(
-            self._study["modelPath"])
-        if not os.path.isdir(general_folder):
-            os.mkdir(general_folder)
+        self._study["precisions"].append(precision)
+
+    def _precisionToRecallFolder(self):
+        """
+        Create if necessary the folder containing the precision to recall of the model studied.
+        :return: path to the folder
+        """
+        return self._studyFolder("precision_to_recall")
+
+    def _studyFolder(self, name):
+        """
+        Create if necessary the folder modelPath/nms_analysis/name/{validation,validation_train}/ of the model studied.
+        :return: path to the folder
+        """
+        general_folder = "{}/{}/".format(self._analysisFolder(), name)
+        os.makedirs(general_folder, exist_ok=True)
 
         if self.with_train:
             general_folder += "validation_train/"
         else:
             general_folder += "validation/"
 
-        if not os.path.isdir(general_folder):
-            os.mkdir(general_folder)
-
-        category_folder = general_folder + \
-            self._study["catStudied"].replace(' ', '_')
-        if not os.path.isdir(category_folder):
-            os.mkdir(category_folder)
+        os.makedirs(general_folder, exist_ok=True)
+        return general_folder
 
-        plt.savefig(category_folder +
-                    '/iou={}.png'.format(iouThreshold), bbox_inches='tight')
+    def savePrecisionToRecall(self):
+        """
+        Write the precision to recall of `self._study["catStudied"]` for every IoU threshold in
+        modelPath/nms_analysis/precision_to_recall/{validation,validation_train}/category.npz
+        
+        :return: path to the npz file
+        """
+        dataFile = self._precisionToRecallFolder() + \
+            self._study["catStudied"].replace(' ', '_') + ".npz"
+        savePrecisionToRecall(dataFile, self._study["catStudied"], self.iou_thresholdXaxis, self._study["precisions"])
+        return dataFile
 
-        # plt.clf()
-        plt.close('all')
+    def plotPrecisionToRecall(self, dataFile=None):
+        """
+        Graph in background processes the precision to recall saved by `savePrecisionToRecall`. The graphs of a category are in
+        the folder named after it next to its npz file. Call `self.plotter.wait()` to wait for them.
+        
+        :param dataFile: npz file of a category. If set to None graph all the categories saved for the model studied.
+        :return: None
+        """
+        if dataFile is None:
+            folder = self._precisionToRecallFolder()
+            dataFiles = [folder + name for name in sorted(os.listdir(folder)) if name.endswith(".npz")]
+        else:
+            dataFiles = [dataFile]
+        for dataFile in dataFiles:
+            self.plotter.submit(renderPrecisionToRecall, dataFile, dataFile[:-len(".npz")], self.small_multiples)
 
     def runAnalysis(self):
         """
@@ -627,14 +835,25 @@ class nmsAnalysis:
                 print(
                     "Please run analysis on the groundtruth in order to know the number of false negatives genreated by nms.")
                 return
+        # the overall AP is not estimated from a sample
+        overall = self.overall and not self.with_train and self.sampleImages is None
+        self.metrics.start("nmsAnalysis", categories=len(self.models) * len(self.categories),
+                           thresholds=len(self.models) * (len(self.categories) + overall) * self.number_IoU_thresh)
         for modelPath in self.models:
             self._study["modelPath"] = modelPath
+            self.metrics.labels["model"] = modelPath
+            self.profiler.reset()
             self.load_all_output_dict()
             for catStudied in tqdm(self.categories, desc="Categories Processed", leave=False):
                 self._study["catStudied"] = catStudied
+                self.profiler.setLabels(catStudied)
                 self.getImgClass(catStudied)
                 self.getClassAP()
-            if self.overall and not self.with_train:
+                self.metrics.increment("categories")
+            if overall:
                 self.getOverallAP()
-
-        os.remove(self.resFilePath)
+            if self.profiler.enabled:
+                self.profiler.report("{}/profile_{}.json".format(
+                    self._analysisFolder(), "validation_train" if self.with_train else "validation"))
+        self.metrics.update(force=True)
+        self.plotter.wait()
@@ -0,0 +1,269 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import json
+import numpy as np
+from pycocotools.cocoeval import COCOeval
+from profiler import Profiler
+from bootstrap import imageStatistics
+from prTensors import prTensors
+from maskNMS import MaskIoU, maskNMS
+from keypointNMS import KeypointOKS
+
+###############################################################################
+
+# The functions of this module take all their inputs explicitly and write no file: they can be called at once from
+# threads, processes or the daemon. `nmsAnalysis`, `GroundTruthFN` and `optimisedNMS` keep their state in `_study`
+# and call them.
+
+
+def bboxNMS(output_dict, iouThreshold, maxOutput=100):
+    """
+    Apply the non max suppresion of tensorflow on the detections of an image.
+    :param output_dict: detections of an image with the keys 'detection_boxes', 'detection_scores' and 'detection_classes',
+                        see `nmsAnalysis.run_inference_for_single_image`
+    :return: A 3D tuple in this order:
+        - final_classes : list of int64 telling the category of each detected bbox
+        - final_scores : list of float64 scoring each bbox
+        - final_boxes : list of coordinates of each bbox (format : [ymin,xmin,ymax,xmax] )
+    """
+    if not output_dict:
+        return None, None, None
+    # imported on first use, see `nmsAnalysis.importTensorflow`
+    import tensorflow as tf
+    box_selection = tf.image.non_max_suppression_with_scores(
+        output_dict['detection_boxes'], output_dict['detection_scores'], maxOutput,
+        iou_threshold=float(iouThreshold), score_threshold=float('-inf'), soft_nms_sigma=0.0, name=None)
+    # Index in the list output_dict['detection_boxes']
+    indexes = list(box_selection[0].numpy())
+    final_scores = list(box_selection[1].numpy())
+    final_boxes = [output_dict['detection_boxes'][index] for index in indexes]
+    final_classes = [output_dict['detection_classes'][index] for index in indexes]
+    return final_classes, final_scores, final_boxes
+
+
+def putCOCOformat(boxes, im_width, im_height):
+    """
+    Transform a bbox in the tensorflow OD format into cocoformat
+    :param boxes: List of the form [ymin,xmin,ymax,xmax] in the percentage of the image scale
+    :param im_width: real width of the associated image
+    :param im_height: real height of the associated image
+    :return: List of the form [left,top,width,height] describing the bbox, in the image scale
+    """
+    # float to respect json format
+    left = float(boxes[1]) * im_width
+    right = float(boxes[3]) * im_width
+    top = float(boxes[0]) * im_height
+    bottom = float(boxes[2]) * im_height
+    return [left, top, right - left, bottom - top]
+
+
+def _categoryIndexes(output_dict, catId):
+    # indexes of the detections of the category in the detections of an image
+    if output_dict is None:
+        return list()
+    return [i for i, x in enumerate(output_dict["detection_classes"]) if x == catId]
+
+
+def bboxDetections(images, all_output_dict, catId, nms):
+    """
+    Detections of a category left by the nms in every image.
+    :param images: images studied, in the format of `COCO.loadImgs`
+    :param all_output_dict: detections of the model, in the format of all_output_dict.json
+    :param nms: function (output_dict) -> (final_classes, final_scores, final_boxes), e.g `bboxNMS` with its threshold
+    :return: [Nx7] detections {imageID,x1,y1,w,h,score,class} for `COCO.loadResBbox`, list of the image ids studied
+    """
+    result = []
+    for img in images:
+        output_dict = all_output_dict.get(img['file_name'])
+        index = _categoryIndexes(output_dict, catId)
+        if not index:
+            continue
+        output_dict = {key: np.array([output_dict[key][i] for i in index])
+                       for key in ('detection_scores', 'detection_classes', 'detection_boxes')}
+        output_dict["num_detections"] = len(index)
+        final_classes, final_scores, final_boxes = nms(output_dict)
+        if not final_classes:
+            continue
+        for j in range(len(final_classes)):
+            # we want [ymin,xmin,ymax,xmax] -> [xmin,ymin,width,height]
+            bbox = putCOCOformat(final_boxes[j], img['width'], img['height'])
+            result.append([img["id"]] + bbox + [float(final_scores[j]), int(final_classes[j])])
+    return np.array(result, dtype=np.float64).reshape((-1, 7)), [img["id"] for img in images]
+
+
+def segmDetections(images, all_output_dict, catId, iouThreshold, maxOutput=100, maskIoU=None, profiler=None):
+    """
+    Detections of a category left by `maskNMS` on the IoU of their masks in every image.
+    :param maskIoU: MaskIoU keeping the IoU of the masks for the whole sweep, see `maskNMS.MaskIoU`
+    :return: list of {image_id, category_id, segmentation, score, sourceIndex} for `COCO.loadRes`, sourceIndex being the
+             index of the detection in the detections of the category in the image before nms, list of the image ids studied
+    """
+    maskIoU = MaskIoU() if maskIoU is None else maskIoU
+    profiler = Profiler() if profiler is None else profiler
+    result = []
+    for img in images:
+        output_dict = all_output_dict.get(img['file_name'])
+        index = _categoryIndexes(output_dict, catId)
+        if not index:
+            continue
+        masks = [output_dict["detection_masks"][i] for i in index]
+        scores = [output_dict["detection_scores"][i] for i in index]
+        maskIoU.setMasks(img["id"], catId, masks)
+        with profiler.stage("computeNMS"):
+            kept = maskNMS(maskIoU.detectionIoU(img["id"], catId), scores, float(iouThreshold), maxOutput)
+        for k in kept:
+            result.append({"image_id": img["id"], "category_id": int(catId), "segmentation": masks[k],
+                           "score": float(scores[k]), "sourceIndex": int(k)})
+    return result, [img["id"] for img in images]
+
+
+def keypointDetections(images, all_output_dict, catId, iouThreshold, maxOutput=100, keypointOKS=None, profiler=None):
+    """
+    Detections of a category left by `maskNMS` on the OKS of their keypoints in every image.
+    :param keypointOKS: KeypointOKS keeping the OKS for the whole sweep, see `keypointNMS.KeypointOKS`
+    :return: list of {image_id, category_id, keypoints, score} for `COCO.loadRes`, the keypoints being [x1,y1,score1,...]
+             in the image scale, list of the image ids studied
+    """
+    keypointOKS = KeypointOKS() if keypointOKS is None else keypointOKS
+    profiler = Profiler() if profiler is None else profiler
+    result = []
+    for img in images:
+        output_dict = all_output_dict.get(img['file_name'])
+        index = _categoryIndexes(output_dict, catId)
+        if not index:
+            continue
+        # [y,x] in the percentage of the image scale -> [x1,y1,score1,...] in the image scale
+        points = np.array([output_dict["detection_keypoints"][i] for i in index], dtype=np.float64).reshape((len(index), -1, 2))
+        keypoints = np.zeros((len(index), points.shape[1] * 3))
+        keypoints[:, 0::3] = points[..., 1] * img['width']
+        keypoints[:, 1::3] = points[..., 0] * img['height']
+        keypoints[:, 2::3] = [output_dict["detection_keypoint_scores"][i] for i in index]
+        boxes = np.array([output_dict["detection_boxes"][i] for i in index], dtype=np.float64).reshape((-1, 4))
+        areas = (boxes[:, 2] - boxes[:, 0]) * img['height'] * (boxes[:, 3] - boxes[:, 1]) * img['width']
+        scores = [output_dict["detection_scores"][i] for i in index]
+        with profiler.stage("computeNMS"):
+            kept = maskNMS(keypointOKS.detectionOKS(img["id"], catId, keypoints, areas), scores, float(iouThreshold), maxOutput)
+        for k in kept:
+            result.append({"image_id": img["id"], "category_id": int(catId),
+                           "keypoints": keypoints[k].tolist(), "score": float(scores[k])})
+    return result, [img["id"] for img in images]
+
+
+def loadNMSError(category, directory="FN_with_nms/"):
+    """
+    Read the false negatives generated by the nms on the ground truth, written by `GroundTruthFN`.
+    :return: (validation, train) dictionnaries of FN_with_nms/validationFN/category.json and FN_with_nms/trainFN/category.json
+    """
+    curves = list()
+    for dataType in ("validationFN", "trainFN"):
+        with open("{}{}/{}.json".format(directory, dataType, category), "r") as fs:
+            curves.append(json.load(fs))
+    return tuple(curves)
+
+
+def evaluateDetections(coco, detections, imgIds, catIds, iouThreshold, iouType="bbox", category="all", nmsError=None,
+                       maskIoU=None, profiler=None):
+    """
+    Evaluate detections with `COCOeval`, up to 1000 detections per image.
+    :param coco: COCO of the ground truth
+    :param detections: detections of `bboxDetections`, `segmDetections` or `keypointDetections`
+    :param catIds: category id or list of category ids evaluated
+    :param iouThreshold: IoU threshold of the nms, used to read the false negatives of `nmsError`
+    :param nmsError: if given (validation, train) of `loadNMSError`: the recall uses the ratio fn/npig generated by the nms
+                     on the training set instead of the one of the validation set
+    :param maskIoU: MaskIoU of `segmDetections`, reused for the IoU with the ground truth
+    :return: COCOeval after `accumulate` and `summarize`, None if the detections could not be loaded
+    """
+    profiler = Profiler() if profiler is None else profiler
+    try:
+        # Load cocoapi object for the detections
+        with profiler.stage("loadResBbox"):
+            cocoDt = coco.loadRes(detections) if iouType != "bbox" else coco.loadResBbox(detections)
+    except Exception:
+        return None
+    cocoEval = COCOeval(coco, cocoDt, iouType)
+    cocoEval.profiler = profiler
+    cocoEval.maskIoU = maskIoU
+    cocoEval.params.imgIds = imgIds
+    cocoEval.params.catIds = catIds
+    # Here we increase the maxDet to 1000 (same as in model config file)
+    # Because we want to optimize the nms that is normally in charge of dealing with
+    # bbox that detects the same object twice or detection that are not very precise
+    # compared to the best one.
+    cocoEval.params.maxDets = [1, 10, 1000]
+    with profiler.stage("evaluate"):
+        cocoEval.evaluate()
+    with profiler.stage("accumulate"):
+        cocoEval.accumulate(iouThreshold, category=category, withTrain=nmsError is not None, nmsError=nmsError)
+    with profiler.stage("summarize"):
+        cocoEval.summarize()
+    return cocoEval
+
+
+def sweepCategory(coco, all_output_dict, category, thresholds, iouType="bbox", maxOutput=100, nmsError=None, nms=None,
+                  profiler=None, metrics=None, images=None):
+    """
+    Apply the nms with every IoU threshold of `thresholds` to the detections of a category and evaluate them.
+    Nothing is shared with another call, so several categories or models can be swept at once.
+
+    :param coco: COCO of the ground truth
+    :param all_output_dict: detections of the model, in the format of all_output_dict.json
+    :param category: name of the category
+    :param thresholds: [T] IoU thresholds of the nms
+    :param iouType: "bbox", "segm" or "keypoints", see `nmsAnalysis.iouType`
+    :param maxOutput: maximal number of detections kept by the nms in an image
+    :param nmsError: (validation, train) of `loadNMSError` to replace the ratio fn/npig of the validation set by the one of the training
+    :param nms: for "bbox", function (output_dict, iouThreshold, maxOutput) -> (final_classes, final_scores, final_boxes),
+                `bboxNMS` by default
+    :param profiler, metrics: Profiler and Metrics recording the sweep, if given
+    :param images: images evaluated in the format of `COCO.loadImgs`, by default all the images of the category
+    :return: dictionnary with the keys
+        - "iou threshold", "AP[IoU:0.5]", "False Negatives": [T] values of each threshold, as written by `nmsAnalysis.writeClassAP`
+        - "number of instances": number of non ignored instances
+        - "image ids": [N] ids of the images evaluated
+        - "precisions": [T] precision of the 101 recall thresholds
+        - "image statistics": [T] `bootstrap.imageStatistics`
+        - "image false negatives": [TxN] number of false negatives of each image, see `EvalImgs.imageCounts`
+        - "pr tensors": [T] `prTensors.prTensors`
+        - "params": `COCOeval.params` of the evaluations
+        None if the model does not detect the category
+    """
+    nms = bboxNMS if nms is None else nms
+    profiler = Profiler() if profiler is None else profiler
+    catId = coco.getCatIds(catNms=[category])[0]
+    images = coco.loadImgs(coco.getImgIds(catIds=[catId])) if images is None else images
+    pairwise = MaskIoU() if iouType == "segm" else KeypointOKS()
+    curve = {"iou threshold": list(), "AP[IoU:0.5]": list(), "False Negatives": list(), "precisions": list(),
+             "image statistics": list(), "image false negatives": list(), "pr tensors": list()}
+    for iouThreshold in thresholds:
+        profiler.setLabels(category, iouThreshold)
+        with profiler.stage("writeResJson"):
+            if iouType == "segm":
+                detections, imgIds = segmDetections(images, all_output_dict, catId, iouThreshold, maxOutput, pairwise, profiler)
+            elif iouType == "keypoints":
+                detections, imgIds = keypointDetections(images, all_output_dict, catId, iouThreshold, maxOutput, pairwise, profiler)
+            else:
+                detections, imgIds = bboxDetections(images, all_output_dict, catId,
+                                                    lambda output_dict: nms(output_dict, iouThreshold, maxOutput))
+        cocoEval = evaluateDetections(coco, detections, imgIds, catId, iouThreshold, iouType, category, nmsError,
+                                      pairwise if iouType == "segm" else None, profiler)
+        if cocoEval is None or len(detections) == 0:
+            return None
+        curve["iou threshold"].append(float(iouThreshold))
+        curve["AP[IoU:0.5]"].append(cocoEval.stats[1])
+        curve["False Negatives"].append(int(cocoEval.evalImgs.numberFN()))
+        curve["precisions"].append(cocoEval.s.reshape((101,)))
+        curve["image statistics"].append(imageStatistics(cocoEval))
+        curve["image false negatives"].append(cocoEval.evalImgs.imageCounts()[0])
+        curve["pr tensors"].append(prTensors(cocoEval))
+        if "number of instances" not in curve:
+            curve["number of instances"] = int(cocoEval.evalImgs.numberInstances())
+        if metrics is not None:
+            metrics.increment("thresholds")
+    curve["image ids"] = cocoEval.params.imgIds
+    curve["params"] = cocoEval.params
+    return curve
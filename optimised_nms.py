@@ -5,13 +5,48 @@ __author__ = 'noahsfi'
 # import the necessary packages
 import numpy as np
 import json
-import matplotlib.pyplot as plt
 from nmsAnalysis import nmsAnalysis
+from plotRenderer import renderModelComparison, renderOverall, renderOverallSum
+from resultsStore import ResultsStore, readCurve
+from prTensors import metricCurve
+from bootstrap import bootstrapThresholds
+from perClassNMS import PerClassNMS
+from nmsCore import evaluateDetections
+import time
 from tqdm import tqdm
 import os
 
 ###############################################################################
 
+def writeThresholdMap(pbtxtFile, items):
+    """
+    Write the IoU threshold of each category in a pbtxt of the form:
+    
+    - item {
+        id: 2
+        display_name: category
+        iou_threshold: optimal iou
+    }
+    
+    :param items: list of (category id, category, IoU threshold)
+    :return: None
+    """
+    for catId,category,iouThreshold in items:
+        if not np.isfinite(iouThreshold):
+            raise ValueError("No IoU threshold for the category {}: {}".format(category, iouThreshold))
+    end = '\n'
+    s = ' '
+    out = ''
+    for catId,category,iouThreshold in items:
+        out += 'item' + s + '{' + end
+        out += s*2 + 'id:' + s + str(catId) + end
+        out += s*2 + 'display_name:' + s + str(category)  + end
+        out += s*2 + 'iou_threshold:' + s  + str(iouThreshold)  + end
+        out += '}' + end*2
+    with open(pbtxtFile,"w") as fs:
+        fs.write(out)
+
+
 class optimisedNMS(nmsAnalysis):
     
     """
@@ -35,6 +70,12 @@ class optimisedNMS(nmsAnalysis):
             - optimiser.overallArgmax(model)
         -optimiser.plotOverall()
         -optimiser.writeMapIoU()
+        -optimiser.validateMapIoU()
+    
+    - Every objective maximises the AP[IoU=0.5] by default. Set `optimiser.metric` to "AP" (AP[IoU=.5:.95]), "AP75",
+    "APs", "APm", "APl", "AR1", "AR10", "AR", ... (see `prTensors.METRICS`) or to a function such as
+    `prTensors.recallWeighted(weights)` to optimise another metric. It is computed from the precision and recall
+    saved in `nms_analysis/pr_tensors` by `runAnalysis`, no sweep is rerun.
     
     - Here is a complete example of use if one wants to replace the ratio of false negatives generated
     by the nms algoeithm in the validation dataset by the one in the training dataset. The run will be
@@ -56,15 +97,40 @@ class optimisedNMS(nmsAnalysis):
             - optimiser.overallArgmax(model)
         - optimiser.plotOverall()
         - optimiser.writeMapIoU()
+        - optimiser.validateMapIoU(with_train=True)
     
     """
     
-    #Inside any model directory after running analysis on it
-    DIR_GENERAL = "nms_analysis/"
-    DIR_ANALYSIS = DIR_GENERAL +  "AP[IoU=0.5]/"
-    DIR_VALIDATION = DIR_ANALYSIS +  "validation/"
-    DIR_VALIDATION_TRAIN = DIR_ANALYSIS + "validation_train/"
-    DIR_MODEL_COMPARISON = "model_comparisons/"
+    def __init__(self, models, imagesPath, annotationPath, catFocus=None, number_IoU_thresh=50, overall=False):
+        """
+        Initialize optimisedNMS, see `nmsAnalysis`.
+        :return: None
+        """
+        super().__init__(models, imagesPath, annotationPath, catFocus=catFocus, number_IoU_thresh=number_IoU_thresh, overall=overall)
+        
+        # Can be changed after initialization
+        self.metric = None  # None for the AP[IoU=0.5] of the json, else a metric of `prTensors.metricCurve`
+    
+    #Inside any model directory after running analysis on it, `nms_analysis_segm` or `nms_analysis_keypoints` for the other `iouType`
+    @property
+    def DIR_GENERAL(self):
+        return self.ANALYSIS_FOLDERS[self.iouType] + "/"
+
+    @property
+    def DIR_ANALYSIS(self):
+        return self.DIR_GENERAL +  "AP[IoU=0.5]/"
+
+    @property
+    def DIR_VALIDATION(self):
+        return self.DIR_ANALYSIS +  "validation/"
+
+    @property
+    def DIR_VALIDATION_TRAIN(self):
+        return self.DIR_ANALYSIS + "validation_train/"
+
+    @property
+    def DIR_MODEL_COMPARISON(self):
+        return "model_comparisons/" if self.iouType == "bbox" else "model_comparisons_{}/".format(self.iouType)
         
     def openJsonData(self,file):
         """
@@ -76,49 +142,37 @@ class optimisedNMS(nmsAnalysis):
         - fn:  false negatives corresponding to each treshold
         - numberInstances: The number of instances that were evaluated.
         """
-        with open(file,"r") as fs:
-            data = json.load(fs)
-            iou = np.array(data['iou threshold'])
-            try:
-                AP = np.array(data['AP[IoU:0.5]'])
-            except :
-                AP = np.array(data['AP[IoU:0.95]'])
-                
-            numberInstances = data["number of instances"]
-            fn = np.array(data['False Negatives'])
-        return iou,AP,fn,numberInstances
-
+        return readCurve(file)
 
-    def _minMaxScaler(self,array):
+    def getStore(self,with_train=None):
         """
-        :param array: array of digits
-        
-        :return: (array-min)/(max - min) if max != min else array.
+        Gather the results of `nmsAnalysis` for `self.models` and `self.categories` in a `ResultsStore`.
+        The store is saved in `model_comparisons/results_{validation,validation_train}.npz` and only rebuilt
+        when a json result is more recent than it.
+        If `self.metric` is set the AP is replaced by the metric computed from the precision and recall saved in `nms_analysis/pr_tensors`.
+        :param with_train: use the results computed with the fn/npig ratio of the training dataset. If None `self.with_train` is used.
+        :return: ResultsStore
         """
-        M = max(array)
-        m = min(array)
-        if m == M:
-            return array
-        else:
-            return (array-m)/(M - m)
+        with_train = self.with_train if with_train is None else with_train
+        computationDir = self.DIR_VALIDATION_TRAIN if with_train else self.DIR_VALIDATION
+        name = "validation_train" if with_train else "validation"
+        if self.metric is not None:
+            return ResultsStore.fromTensors(self.models, self.categories, self.DIR_GENERAL + "pr_tensors/{}/".format(name),
+                                            computationDir, self.metric)
+        if not os.path.isdir(self.DIR_MODEL_COMPARISON):
+            os.mkdir(self.DIR_MODEL_COMPARISON)
+        return ResultsStore.build(self.models, self.categories, computationDir,
+                                  self.DIR_MODEL_COMPARISON + "results_{}.npz".format(name))
 
-    def _plotModels(self,ax,iou,AP,model):
+    def getWeights(self,weight):
         """
-        Plot the AP to IoU for a given model onto a given axis of the graph
-        :param ax: a matplotlib.pyplot axis
-        :param iou: list of IoU Threshold i.e the X-axis.
-        :param AP: list of corresponding AP i.e the Y-axis
-        :param model: Under which model were the results found
-        
-        :return: None
+        :param weight: dictionary of the form {category: weight}, or a list of them. Missing categories have a weight of 1.
+        :return: [WxC] weight vectors ordered as `self.categories`
         """
-        ax.plot(iou,AP,label = model)
-        idx = np.argmax(np.flip(AP))
-        xmax = np.flip(iou)[idx]
-        ymax = np.flip(AP)[idx]
-        ax.annotate('IoU = {}, var = {}'.format(np.format_float_scientific(xmax, unique=False, precision=2),np.format_float_scientific(np.var(AP), unique=False, precision=2)), xy=(xmax, ymax),
-        arrowprops=dict(facecolor='black', shrink=0.05),
-        )
+        if isinstance(weight,dict):
+            weight = [weight]
+        return np.array([[w.get(category,1) for category in self.categories] for w in weight],dtype=np.float64).reshape((-1,len(self.categories)))
+
 
     def compare_model(self):
         """
@@ -126,50 +180,29 @@ class optimisedNMS(nmsAnalysis):
         The results will be written in the folder `model_comparisons` in the relative path.
         If `self.withTrain` is set to True, 2 axis will be plot one using only the validation set and one
         using the fn/npig ratio of the training dataset.
+        The graphs are rendered in background by `self.plotter`, call `self.plotter.wait()` to wait for them.
         """
-        if not os.path.isdir(self.DIR_MODEL_COMPARISON):
-            os.mkdir(self.DIR_MODEL_COMPARISON)
+        validation = self.getStore(with_train=False)
+        train = self.getStore(with_train=True) if self.with_train else None
         
         for category in tqdm(self.categories,desc="model comparisons"):
-            if self.with_train:
-                fig, (ax1, ax2) = plt.subplots(1, 2,figsize=(18, 10))
-            else:
-                fig,ax1 = plt.subplots(1, 1,figsize=(18, 10))
-            no_detection = 0
+            validationCurves = list()
+            trainCurves = list() if self.with_train else None
             for model in self.models:
-                path = model + "/"
-                file = category + '.json'
-                if not os.path.isfile(path + self.DIR_VALIDATION + file):
+                if not validation.has(model,category):
                     print("No detection by the model {} for the category {}".format(model,category))
-                    no_detection += 1
                     continue
                 
-                iou,AP,fn,numberInstances = self.openJsonData(path + self.DIR_VALIDATION+file)
-                self._plotModels(ax1,iou,AP,model)
+                iou,AP,fn,numberInstances = validation.curve(model,category)
+                validationCurves.append((model,iou,AP))
                 if self.with_train:
-                    iou,AP,fn,numberInstances = self.openJsonData(path + self.DIR_VALIDATION_TRAIN+file)
-                    self._plotModels(ax2,iou,AP,model)
-                
+                    iou,AP,fn,numberInstances = train.curve(model,category)
+                    trainCurves.append((model,iou,AP))
                 
-            if no_detection == len(self.models):
-                plt.close('all')
+            if len(validationCurves) == 0:
                 continue  
-            fig.suptitle("Comparison per model of AP to IoU Threshold for {}".format(category))
-            
-            ax1.title.set_text("AP[IoU=0.5] validation")
-            ax1.set_xlabel("IoU threshold")
-            ax1.set_ylabel("AP[IoU=0.5]")
-            ax1.legend(loc = 'lower left')
-            if self.with_train:
-                ax2.title.set_text("AP[IoU=0.5] validation with train MR_nms")
-                ax2.set_xlabel("IoU threshold")
-                ax2.set_ylabel("AP[IoU=0.5]")
-                ax2.legend(loc = 'lower left')
-            
-            
-            
-            fig.savefig(self.DIR_MODEL_COMPARISON + '{}.png'.format(category), bbox_inches='tight')
-            plt.close('all')
+            self.plotter.submit(renderModelComparison, category, validationCurves, trainCurves,
+                                self.DIR_MODEL_COMPARISON + '{}.png'.format(category))
 
 
     def overallArgmax(self,model,weight = dict()):
@@ -182,8 +215,8 @@ class optimisedNMS(nmsAnalysis):
         - argmax_{iou}(sum_{cat}AP(cat,iou)*var(AP(cat)))
         - argmax_{iou}(sum_{cat}AP(cat,iou)*weight(cat))
         
-        Each formula inside the argmax will be ploted. The result of it will be written
-        inside `argmax_{computationDir}.json`
+        Each formula inside the argmax will be ploted in background by `self.plotter`. The result of it will be written
+        inside `argmax_{validation,validation_train}.json`
         
         Results can be found in the model folder inside `nms_analysis/optimal_overall`
         
@@ -192,93 +225,207 @@ class optimisedNMS(nmsAnalysis):
         
         :return: None
         """
-        data = dict()
-        computationDir = self.DIR_VALIDATION if not self.with_train else self.DIR_VALIDATION_TRAIN
-        final_weight = {category : 1 for category in self.categories}
-        for category in weight.keys():
-            final_weight[category] = weight[category]
-            
+        store = self.getStore()
+        m = store.models.index(model)
         for category in self.categories:
-            path = model + "/" 
-            file = category + '.json'
-            if not os.path.isfile(path + computationDir + file):
+            if not store.has(model,category):
                 print("No detection by the model {} for the category {}".format(model,category))
-                continue
-            
-            iou,AP,_,_ = self.openJsonData(path + computationDir+file)
-            data[category] = AP
-            
+        
+        iou = store.iou
+        sums = store.overallSums(self.getWeights(weight))
         overallSum = {
-            "AP" : np.zeros(len(iou)),
-            "AP*var" : np.zeros(len(iou)),
-            "AP*weight" : np.zeros(len(iou)),
+            "AP" : sums["AP"][m],
+            "AP*var" : sums["AP*var"][m],
+            "AP*weight" : sums["AP*weight"][m,0],
         } #All the corresponding sum for each ious i.e sum_{category}formula
-        
-        for i,iouThresh in enumerate(iou):
-            s = 0
-            for category,AP in data.items():
-                overallSum["AP"][i] += AP[i]
-                overallSum["AP*var"][i] += AP[i] * np.var(AP)
-                overallSum["AP*weight"][i] += AP[i] * final_weight[category]
                 
-            
-        plt.figure(figsize=(18,10))
-        plt.rc('text', usetex=True)
-        plt.rc('font', family='serif')
-        plt.plot(iou,self._minMaxScaler(overallSum["AP*var"]),label = r"$\displaystyle\sum_{cat}AP(cat,iou)*var(AP(cat))$")
-        plt.plot(iou,self._minMaxScaler(overallSum["AP"]),label = r"$\displaystyle\sum_{cat}AP(cat,iou)$")
-        plt.plot(iou,self._minMaxScaler(overallSum["AP*weight"]),label = r"$\displaystyle\sum_{cat}AP(cat,iou)*w(cat)$")
-        # plt.annotate('IoU = {}'.format(np.format_float_scientific(finalIoU, unique=False, precision=2)), xy=(finalIoU, bestScore),arrowprops=dict(facecolor='black', shrink=0.05))
-        plt.ylabel("AP[IoU] = 0.5")
-        plt.xlabel("IoU Threshold")
-        plt.legend()
-        
-        # plt.rc('text', usetex=False)
-        plt.title("Function min max scaled")
+        name = "validation_train" if self.with_train else "validation"
         path = model + "/" + self.DIR_GENERAL
         if not os.path.isdir(path + "optimal_overall/"):
             os.mkdir(path + "optimal_overall/")
-        plt.savefig(path + "optimal_overall/overallSum_{}.png".format("validation_train" if computationDir == self.DIR_VALIDATION_TRAIN else self.DIR_VALIDATION),bbox_inches='tight')
+        self.plotter.submit(renderOverallSum, iou, overallSum, path + "optimal_overall/overallSum_{}.png".format(name))
         
         result = {
             "Normal Distribution": iou[np.argmax(overallSum["AP"])],
             "Weight with variance":iou[np.argmax(overallSum["AP*var"])],
             "Weighted by user": iou[np.argmax(overallSum["AP*weight"])],
         }
-        with open(path + "optimal_overall/argmax_{}.json".format("validation_train" if computationDir == self.DIR_VALIDATION_TRAIN else self.DIR_VALIDATION),"w") as fs:
+        with open(path + "optimal_overall/argmax_{}.json".format(name),"w") as fs:
             json.dump(result,fs,indent=1)
+
+    def weightedArgmax(self,weights):
+        """
+        Evaluate argmax_{iou}(sum_{cat}AP(cat,iou)*weight(cat)) of `overallArgmax` for many weightings at once,
+        for every model in `self.models`. Nothing is written nor plotted.
+        
+        :param weights: list of dictionaries of the form {category: weight}, missing categories have a weight of 1.
+        :return: dictionary {model: list of the best IoU threshold for each weighting}
+        """
+        store = self.getStore()
+        best = store.overallArgmax(self.getWeights(weights))["Weighted by user"]
+        return {model: best[m].tolist() for m,model in enumerate(store.models)}
+        
+
+
+    def confidenceIntervals(self,numberResamples=500,confidence=0.95,seed=0):
+        """
+        Bootstrap the images of each category in order to know how reliable its best IoU threshold is.
+        The images are drawn with replacement `numberResamples` times and the AP of every threshold is recomputed
+        from the per image statistics saved by `nmsAnalysis` in `nms_analysis/image_statistics`, no nms nor matching is rerun.
+        
+        The result is written in `modelPath/nms_analysis/confidence_intervals_{validation,validation_train}.json` with for each category:
+        
+        - iou_threshold: best IoU threshold on all the images
+        - low, high: bounds of the `confidence` interval of the best threshold
+        - std: standard deviation of the best threshold
+        - agreement: ratio of the resamplings giving the same best threshold than all the images
+        
+        :return: dictionary {model: {category: result}}
+        """
+        name = "validation_train" if self.with_train else "validation"
+        alpha = 1 - confidence
+        results = dict()
+        for model in self.models:
+            results[model] = dict()
+            for category in tqdm(self.categories,desc="bootstrap {}".format(model)):
+                dataFile = model + "/" + self.DIR_GENERAL + "image_statistics/{}/{}.npz".format(name,category.replace(' ', '_'))
+                if not os.path.isfile(dataFile):
+                    print("No image statistics for the model {} and the category {}, please rerun nmsAnalysis".format(model,category))
+                    continue
+                iou,AP,bestIoU = bootstrapThresholds(dataFile,numberResamples=numberResamples,seed=seed)
+                bestIoU = np.sort(bestIoU[~np.isnan(bestIoU)])
+                if len(bestIoU) == 0 or np.isnan(AP).any():
+                    continue
+                best = iou[len(iou) - 1 - np.argmax(AP[::-1])]
+                n = len(bestIoU)
+                results[model][category] = {
+                    "iou_threshold": float(best),
+                    "low": float(bestIoU[int(np.floor(alpha / 2 * (n - 1)))]),
+                    "high": float(bestIoU[int(np.ceil((1 - alpha / 2) * (n - 1)))]),
+                    "std": float(np.std(bestIoU)),
+                    "agreement": float(np.mean(np.isclose(bestIoU, best))),
+                    "resamples": n,
+                }
+            with open(model + "/" + self.DIR_GENERAL + "confidence_intervals_{}.json".format(name),"w") as fs:
+                json.dump({"confidence": confidence, "categories": results[model]},fs,indent=1)
+        return results
+
+    def _evaluateDetections(self,detections,imgIds,catIds):
+        """
+        Evaluate the detections of every category of `catIds` at once, the way `getOverallAP` does.
+        :param detections: [Nx7] array where each row is {imageID,x1,y1,w,h,score,class}
+        :return: AP[IoU=0.5] of all the categories, dictionary {category id: AP[IoU=0.5]} (-1 without instance)
+        """
+        cocoEval = evaluateDetections(self.coco,detections,imgIds,catIds,0.,profiler=self.profiler)
+        # precision at IoU=0.5 for the area 'all' and 1000 detections per image
+        precision = cocoEval.eval['precision'][0,:,:,0,-1]
+        perClass = dict()
+        for k,catId in enumerate(cocoEval.params.catIds):
+            valid = precision[:,k] > -1
+            perClass[catId] = float(np.mean(precision[valid,k])) if valid.any() else -1.
+        return float(cocoEval.stats[1]),perClass
+
+    def validateMapIoU(self,with_train=False):
+        """
+        Measure the AP of the `iouThreshmap.pbtxt` written by `writeMapIoU`, i.e. with each category using its
+        own IoU threshold, against the best single IoU threshold for all the categories (argmax_{iou}(sum_{cat}AP(cat,iou))
+        of `overallArgmax`). Both nms are applied to the detections of all_output_dict.json in a single batched pass of
+        `PerClassNMS` and evaluated once on every category, no sweep is rerun.
+        
+        The result is written in `modelPath/nms_analysis/closed_loop_{validation,validation_train}.json` with:
+        
+        - iou thresholds: threshold of each category in the map
+        - baseline iou threshold: the single threshold
+        - AP[IoU:0.5]: overall AP of the map and of the baseline
+        - categories: AP of each category with the map and with the baseline
+        - seconds: time of the validation
         
+        :param with_train: validate the map written from the results computed with the training dataset
+        :return: dictionary {model: result}
+        """
+        name = "validation_train" if with_train else "validation"
+        store = self.getStore(with_train=with_train)
+        baselines = store.overallArgmax()["Normal Distribution"]
+        catIds = [self.getCatId(category) for category in self.categories]
+        catImgIds = [self.coco.getImgIds(catIds=[catId]) for catId in catIds]
+        imgIds = sorted(set().union(*catImgIds))
+        results = dict()
+        for m,model in enumerate(self.models):
+            tic = time.time()
+            path = model + "/" + self.DIR_GENERAL
+            if not os.path.isfile(path + "iouThreshmap.pbtxt"):
+                print("No iouThreshmap.pbtxt for the model {}, please run writeMapIoU first".format(model))
+                continue
+            self._study["modelPath"] = model
+            self.load_all_output_dict()
+            images = [img for img in self.coco.loadImgs(imgIds)
+                      if self._study["all_output_dict"].get(img["file_name"]) and self._study["all_output_dict"][img["file_name"]]["num_detections"]]
+            outputs = [self._study["all_output_dict"][img["file_name"]] for img in images]
+            numDetections = np.array([output_dict["num_detections"] for output_dict in outputs],dtype=np.int64)
+            N = numDetections.max(initial=0)
+            boxes = np.zeros((len(outputs),N,4))
+            scores = np.zeros((len(outputs),N))
+            classes = np.zeros((len(outputs),N),dtype=np.int64)
+            for i,output_dict in enumerate(outputs):
+                boxes[i,:numDetections[i]] = output_dict["detection_boxes"]
+                scores[i,:numDetections[i]] = output_dict["detection_scores"]
+                classes[i,:numDetections[i]] = output_dict["detection_classes"]
+            # as in `getOverallAP` the detections of a category are only kept in the images containing it
+            ids = np.array([img["id"] for img in images],dtype=np.int64)
+            contains = np.stack([np.isin(ids,catImgIds[k]) for k in range(len(catIds))] + [np.zeros(len(ids),dtype=bool)],axis=1)
+            position = {catId: k for k,catId in enumerate(catIds)}
+            k = np.vectorize(lambda catId: position.get(catId,len(catIds)),otypes=[np.int64])(classes)
+            valid = (np.arange(N)[None,:] < numDetections[:,None]) & np.take_along_axis(contains,k,axis=1)
+            width = np.array([img["width"] for img in images],dtype=np.float64)[:,None]
+            height = np.array([img["height"] for img in images],dtype=np.float64)[:,None]
 
+            mapNMS = PerClassNMS(path + "iouThreshmap.pbtxt")
+            baselineNMS = PerClassNMS(defaultThreshold=float(baselines[m]))
+            result = {"iou thresholds": {category: mapNMS.thresholds.get(catId) for category,catId in zip(self.categories,catIds)},
+                      "baseline iou threshold": float(baselines[m]),
+                      "AP[IoU:0.5]": dict(),
+                      "categories": {category: dict() for category in self.categories}}
+            for key,engine in (("map",mapNMS),("baseline",baselineNMS)):
+                with self.profiler.stage("perClassNMS"):
+                    keep = engine.applyBatch(boxes,scores,classes,numDetections) & valid
+                # [ymin,xmin,ymax,xmax] in the percentage of the image scale -> [left,top,width,height], see `putCOCOformat`
+                left,right = boxes[...,1] * width,boxes[...,3] * width
+                top,bottom = boxes[...,0] * height,boxes[...,2] * height
+                detections = np.stack([np.broadcast_to(ids[:,None],keep.shape).astype(np.float64),left,top,right - left,bottom - top,scores,classes],axis=-1)[keep]
+                overall,perClass = self._evaluateDetections(detections,imgIds,catIds)
+                result["AP[IoU:0.5]"][key] = overall
+                for category,catId in zip(self.categories,catIds):
+                    result["categories"][category][key] = perClass[catId]
+            result["seconds"] = time.time() - tic
+            print("{}: AP[IoU=0.5] {:0.4f} with iouThreshmap.pbtxt, {:0.4f} with the single threshold {:0.3f}".format(
+                model,result["AP[IoU:0.5]"]["map"],result["AP[IoU:0.5]"]["baseline"],result["baseline iou threshold"]))
+            with open(path + "closed_loop_{}.json".format(name),"w") as fs:
+                json.dump(result,fs,indent=1)
+            results[model] = result
+        return results
 
     def plotOverall(self):
         """
         Plot the AP to iouThreshold for the overall categories.
         Inside the plot there will be a curve for each model in `self.models`.
         
-        Result will be found in the `model_comparisons` folder in the relative path.
+        Result will be found in the `model_comparisons` folder in the relative path, once rendered by `self.plotter`.
         """
-        
-        plt.figure(figsize=(18, 10))
+        if not os.path.isdir(self.DIR_MODEL_COMPARISON):
+            os.mkdir(self.DIR_MODEL_COMPARISON)
+        curves = list()
         for model in self.models:
             path = model + "/"
             file = 'all.json'
             
             
             iou,AP,fn,numberInstances = self.openJsonData(path + self.DIR_VALIDATION+file)
-        
-            plt.plot(iou,AP,label = model)
-            idx = np.argmax(np.flip(AP))
-            xmax = np.flip(iou)[idx]
-            ymax = np.flip(AP)[idx]
-            plt.annotate('IoU = {}, var = {}'.format(np.format_float_scientific(xmax, unique=False, precision=2),np.format_float_scientific(np.var(AP), unique=False, precision=2)), xy=(xmax, ymax),
-            arrowprops=dict(facecolor='black', shrink=0.05))
+            if self.metric is not None:
+                data = np.load(path + self.DIR_GENERAL + "pr_tensors/validation/all.npz")
+                iou,AP = data["iou_threshold"],metricCurve(data,self.metric)
+            curves.append((model,iou,AP))
             
-        plt.title("AP[IoU=0.5] validation")
-        plt.xlabel("IoU threshold")
-        plt.ylabel("AP[IoU=0.5]")
-        plt.legend()
-        plt.savefig(self.DIR_MODEL_COMPARISON + 'all.png', bbox_inches='tight')
-        plt.close('all')
+        self.plotter.submit(renderOverall, curves, self.DIR_MODEL_COMPARISON + 'all.png')
 
     def writeMapIoU(self,with_train=False):
         """
@@ -293,29 +440,18 @@ class optimisedNMS(nmsAnalysis):
         The file will be in `modelPath/nms_analysis/iouThreshmap.pbtxt`
         """
         
-        end = '\n'
-        s = ' '
-        for model in self.models:
+        validation = self.getStore(with_train=False)
+        store = self.getStore(with_train=with_train)
+        bestThresholds = store.bestThresholds()
+        for m,model in enumerate(self.models):
             path = model + "/"
-            open(path + self.DIR_GENERAL + "iouThreshmap.pbtxt","w").close() 
-            for category in self.categories:
-                file = category + '.json'
-                if not os.path.isfile(path + self.DIR_VALIDATION + file):
+            items = list()
+            for c,category in enumerate(self.categories):
+                if not validation.has(model,category):
                     print("No detection by the model {} for the category {}".format(model,category))
                     continue
-                catId = self.getCatId(category)
-                if not with_train:
-                    iou,AP,_,_ = self.openJsonData(path + self.DIR_VALIDATION+file)
-                else:
-                    iou,AP,fn,numberInstances = self.openJsonData(path + self.DIR_VALIDATION_TRAIN+file)
-                    
-                idx = np.argmax(np.flip(AP))
-                bestIoU = np.flip(iou)[idx]
-                out = ''
-                out += 'item' + s + '{' + end
-                out += s*2 + 'id:' + s + str(catId) + end
-                out += s*2 + 'display_name:' + s + str(category)  + end
-                out += s*2 + 'iou_threshold:' + s  + str(bestIoU)  + end
-                out += '}' + end*2
-                with open(path + self.DIR_GENERAL + "iouThreshmap.pbtxt","a") as fs:
-                    fs.write(out) 
+                if not store.has(model,category):
+                    print("No validation_train result of the model {} for the category {}, run `nmsAnalysis` with `with_train` on it".format(model,category))
+                    continue
+                items.append((self.getCatId(category),category,bestThresholds[m,c]))
+            writeThresholdMap(path + self.DIR_GENERAL + "iouThreshmap.pbtxt",items)
@@ -0,0 +1,158 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import re
+import numpy as np
+
+###############################################################################
+
+
+def readThresholdMap(pbtxtFile):
+    """
+    Read the pbtxt written by `optimisedNMS.writeMapIoU`.
+    :return: dictionnary {category id: IoU threshold}
+    """
+    with open(pbtxtFile, "r") as fs:
+        text = fs.read()
+    thresholds = dict()
+    for item in re.findall(r"item\s*\{(.*?)\}", text, re.S):
+        fields = dict(re.findall(r"(\w+):\s*(.*)", item))
+        thresholds[int(fields["id"])] = float(fields["iou_threshold"])
+    return thresholds
+
+
+def _iou(boxes1, boxes2):
+    """
+    IoU of each pair of bbox the way tensorflow computes it in `non_max_suppression`: the coordinates of a bbox
+    may be given in any order and a bbox without area has an IoU of 0.
+    :param boxes1, boxes2: [Nx4] bbox of the form [ymin,xmin,ymax,xmax]
+    :return: [N] IoU of boxes1[i] with boxes2[i]
+    """
+    ymin1, ymax1 = np.minimum(boxes1[:, 0], boxes1[:, 2]), np.maximum(boxes1[:, 0], boxes1[:, 2])
+    xmin1, xmax1 = np.minimum(boxes1[:, 1], boxes1[:, 3]), np.maximum(boxes1[:, 1], boxes1[:, 3])
+    ymin2, ymax2 = np.minimum(boxes2[:, 0], boxes2[:, 2]), np.maximum(boxes2[:, 0], boxes2[:, 2])
+    xmin2, xmax2 = np.minimum(boxes2[:, 1], boxes2[:, 3]), np.maximum(boxes2[:, 1], boxes2[:, 3])
+    area1 = (ymax1 - ymin1) * (xmax1 - xmin1)
+    area2 = (ymax2 - ymin2) * (xmax2 - xmin2)
+    intersection = np.maximum(np.minimum(ymax1, ymax2) - np.maximum(ymin1, ymin2), 0.) * \
+        np.maximum(np.minimum(xmax1, xmax2) - np.maximum(xmin1, xmin2), 0.)
+    union = area1 + area2 - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = intersection / union
+    return np.where((area1 > 0) & (area2 > 0), iou, 0.)
+
+
+def greedyNMS(boxes, scores, iouThreshold, maxOutput=100):
+    """
+    Non max suppression of the bbox of a single class, as `tf.image.non_max_suppression`.
+    :param boxes: [Nx4] bbox of the form [ymin,xmin,ymax,xmax]
+    :param scores: [N] score of each bbox
+    :return: indexes of the bbox kept, by decreasing score
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape((-1, 4))
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind='mergesort')
+    selected = list()
+    while len(order) and len(selected) < maxOutput:
+        best = order[0]
+        selected.append(best)
+        order = order[1:]
+        order = order[_iou(np.repeat(boxes[best][None], len(order), axis=0), boxes[order]) <= iouThreshold]
+    return np.array(selected, dtype=np.int64)
+
+
+class PerClassNMS:
+
+    #The goal of this class is to apply after a detector the IoU threshold of each category found by `optimisedNMS`,
+    #for a whole batch of images at once instead of one nms per category and image.
+    #The detections are sorted by (image, category) group then by decreasing score, and the greedy nms runs on every
+    #group in lockstep: each step keeps the best detection left in each group and suppresses the ones of its group
+    #overlapping it more than the threshold of the category. The number of steps is the greatest number of detections
+    #kept in a group, and each step is a vectorized pass over the detections left.
+
+    #   Parameters:
+    #    thresholds:         - dictionnary {category id: IoU threshold}, read from a pbtxt written by `optimisedNMS.writeMapIoU`
+    #    defaultThreshold:   - IoU threshold of the categories missing in `thresholds`
+    #    maxOutput:          - maximal number of detections kept per category and image, as `max_output_size`
+    #                           of `tf.image.non_max_suppression` called once per category
+
+    def __init__(self, pbtxtFile=None, defaultThreshold=0.5, maxOutput=100):
+        """
+        Initialize PerClassNMS
+        :param pbtxtFile: iouThreshmap.pbtxt written by `optimisedNMS.writeMapIoU`. If set to None every category uses `defaultThreshold`
+        :param defaultThreshold: IoU threshold of the categories missing in the pbtxt
+        :param maxOutput: maximal number of detections kept per category and image
+        :return: None
+        """
+        self.thresholds = dict() if pbtxtFile is None else readThresholdMap(pbtxtFile)
+        self.defaultThreshold = defaultThreshold
+        self.maxOutput = maxOutput
+
+    def applyBatch(self, boxes, scores, classes, numDetections=None):
+        """
+        Apply the per category nms on a batch of images in a single pass.
+        :param boxes: [BxNx4] bbox of the form [ymin,xmin,ymax,xmax], as 'detection_boxes' of the model
+        :param scores: [BxN] score of each bbox
+        :param classes: [BxN] category id of each bbox
+        :param numDetections: [B] number of valid detections of each image, the following ones are padding. If None all are valid
+        :return: [BxN] boolean, True for the detections kept
+        """
+        boxes = np.asarray(boxes, dtype=np.float64)
+        scores = np.asarray(scores, dtype=np.float64)
+        classes = np.asarray(classes).astype(np.int64)
+        B, N = scores.shape
+        valid = np.ones((B, N), dtype=bool) if numDetections is None else np.arange(N)[None, :] < np.asarray(numDetections)[:, None]
+        images, positions = np.nonzero(valid)
+        keep = np.zeros((B, N), dtype=bool)
+        if len(images) == 0:
+            return keep
+
+        # groups of (image, category), sorted by decreasing score inside each group
+        uniqueClasses, classIndex = np.unique(classes[images, positions], return_inverse=True)
+        _, group = np.unique(images * len(uniqueClasses) + classIndex, return_inverse=True)
+        order = np.lexsort((-scores[images, positions], group))
+        images, positions, group = images[order], positions[order], group[order]
+        threshold = np.array([self.thresholds.get(int(c), self.defaultThreshold) for c in uniqueClasses])[classIndex[order]]
+        groupBoxes = boxes[images, positions]
+
+        G = group[-1] + 1
+        alive = np.ones((len(group),), dtype=bool)
+        selected = np.zeros((len(group),), dtype=bool)
+        numberSelected = np.zeros((G,), dtype=np.int64)
+        head = np.full((G,), -1, dtype=np.int64)
+        while alive.any():
+            # best detection left of each group, the first alive since each group is sorted
+            aliveIndex = np.flatnonzero(alive)
+            _, first = np.unique(group[aliveIndex], return_index=True)
+            heads = aliveIndex[first]
+            selected[heads] = True
+            alive[heads] = False
+            numberSelected[group[heads]] += 1
+            head[group[heads]] = heads
+
+            candidates = np.flatnonzero(alive)
+            iou = _iou(groupBoxes[head[group[candidates]]], groupBoxes[candidates])
+            alive[candidates[iou > threshold[candidates]]] = False
+            alive &= numberSelected[group] < self.maxOutput
+
+        keep[images[selected], positions[selected]] = True
+        return keep
+
+    def apply(self, output_dict):
+        """
+        Apply the per category nms on the detections of a single image.
+        :param output_dict: the dictionnary ouput of the inference computation
+        keyDic = ['num_detections','detection_classes','detection_boxes','detection_scores']
+        :return: A 3D tuple in the order of `nmsAnalysis.computeNMS`: final_classes, final_scores, final_boxes
+        """
+        scores = np.asarray(output_dict['detection_scores'], dtype=np.float64)
+        if len(scores) == 0:
+            return [], [], []
+        keep = self.applyBatch(np.asarray(output_dict['detection_boxes'])[None], scores[None],
+                               np.asarray(output_dict['detection_classes'])[None])[0]
+        kept = np.flatnonzero(keep)
+        kept = kept[np.argsort(-scores[kept], kind='mergesort')]
+        return [output_dict['detection_classes'][i] for i in kept], [scores[i] for i in kept], \
+            [output_dict['detection_boxes'][i] for i in kept]
@@ -0,0 +1,380 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import argparse
+import hashlib
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from cocoCache import annotationHash, loadCoco
+from nmsAnalysis import nmsAnalysis
+from groundTruthFN import GroundTruthFN
+from optimised_nms import optimisedNMS
+
+###############################################################################
+
+# Folder of the source files, the code of a stage is part of its key.
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+COCO_SOURCES = ["pycocotools/coco.py", "pycocotools/cocoeval.py", "pycocotools/mask.py"]
+SWEEP_SOURCES = ["nmsAnalysis.py", "nmsCore.py", "bootstrap.py", "prTensors.py", "maskNMS.py", "keypointNMS.py"] + COCO_SOURCES
+STAGE_SOURCES = {
+    "inference": ["imageDecoding.py"],
+    "fn": ["groundTruthFN.py"] + SWEEP_SOURCES,
+    "sweep": SWEEP_SOURCES,
+    "overall": SWEEP_SOURCES,
+    "optimiser": ["optimised_nms.py", "resultsStore.py", "prTensors.py", "perClassNMS.py", "plotRenderer.py"],
+}
+
+# Settings of the config file, with their default value. See `interface.main` for their meaning.
+DEFAULT_CONFIG = {
+    "models": [],
+    "imagesPath": None,
+    "annotationValidation": None,
+    "annotationTrain": None,
+    "catFocus": None,
+    "number_IoU_thresh": 50,
+    "overall": True,
+    "with_train": False,
+    "iouType": "bbox",
+    "inputSize": None,
+    "maxOutput": 100,
+    "metric": None,
+    "workers": os.cpu_count(),
+    "stateFile": ".pipeline_state.json",
+}
+
+# Attributes of `nmsAnalysis` set from the config file.
+ANALYSER_SETTINGS = ("iouType", "inputSize", "maxOutput")
+
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def _analyser(config, categories):
+    """
+    :return: nmsAnalysis of the validation dataset for `categories` with the settings of the config
+    """
+    analyser = nmsAnalysis(config["models"], config["imagesPath"], config["annotationValidation"], catFocus=categories,
+                           number_IoU_thresh=config["number_IoU_thresh"], overall=config["overall"])
+    for key in ANALYSER_SETTINGS:
+        setattr(analyser, key, config[key])
+    return analyser
+
+
+def runInference(config, model, categories, fingerprint):
+    """
+    Stage inference/model: infer the images of `categories` missing in the detections of the model, see `nmsAnalysis.load_all_output_dict`.
+    The detections are thrown away when they were computed by another version of the model or with other decoding settings.
+    :param fingerprint: fingerprint of the model and of the decoding settings
+    :return: files written
+    """
+    analyser = _analyser(config, categories)
+    try:
+        analyser._study["modelPath"] = model
+        fingerprintFile = analyser._analysisFolder() + "/inference_fingerprint.json"
+        if os.path.isfile(fingerprintFile) and os.path.isfile(analyser._detectionsFile()):
+            with open(fingerprintFile, "r") as fs:
+                if json.load(fs) != fingerprint:
+                    os.remove(analyser._detectionsFile())
+        analyser.load_all_output_dict()
+        with open(fingerprintFile, "w") as fs:
+            json.dump(fingerprint, fs)
+    finally:
+        analyser.plotter.close()
+    return [analyser._detectionsFile(), fingerprintFile]
+
+
+def runGroundTruthFN(config, dataType, categories):
+    """
+    Stage fn/dataType: `GroundTruthFN.runAnalysis` on the validation or train annotations.
+    :param categories: categories studied, None for all the categories of the annotations
+    :return: files written
+    """
+    annotationPath = config["annotationTrain"] if dataType == "train" else config["annotationValidation"]
+    fn = GroundTruthFN(annotationPath, dataType=dataType, catFocus=categories, number_IoU_thresh=config["number_IoU_thresh"])
+    try:
+        fn.runAnalysis()
+    finally:
+        fn.plotter.close()
+    files = [fn.DIRECTORY + fn.resultPath + "{}.json".format(category) for category in fn.categories]
+    return [file for file in files if os.path.isfile(file)]
+
+
+def runSweep(config, model, category, with_train):
+    """
+    Stage sweep/model/category/split: `nmsAnalysis.getClassAP` of a single category.
+    :return: files written
+    """
+    analyser = _analyser(config, [category])
+    try:
+        analyser.with_train = with_train
+        analyser._study["modelPath"] = model
+        analyser.load_all_output_dict()
+        analyser._study["catStudied"] = category
+        analyser.getImgClass(category)
+        analyser.getClassAP()
+    finally:
+        analyser.plotter.close()
+    file = analyser._analysisFolder() + "/AP[IoU=0.5]/{}/{}.json".format("validation_train" if with_train else "validation", category)
+    return [file] if os.path.isfile(file) else []
+
+
+def runOverall(config, model, categories):
+    """
+    Stage overall/model: `nmsAnalysis.getOverallAP` of all the categories.
+    :return: files written
+    """
+    analyser = _analyser(config, categories)
+    try:
+        analyser._study["modelPath"] = model
+        analyser.load_all_output_dict()
+        analyser.getOverallAP()
+    finally:
+        analyser.plotter.close()
+    file = analyser._analysisFolder() + "/AP[IoU=0.5]/validation/all.json"
+    return [file] if os.path.isfile(file) else []
+
+
+def runOptimiser(config, categories):
+    """
+    Stage optimiser: compare the models with `optimisedNMS.compare_model`, compute the overall best IoU threshold of each
+    model with `overallArgmax`, plot the overall AP and write the iouThreshmap.pbtxt of each model. Also run by `interface.getResult`.
+    :return: files written
+    """
+    optimiser = optimisedNMS(config["models"], None, config["annotationValidation"], catFocus=categories,
+                             number_IoU_thresh=config["number_IoU_thresh"])
+    optimiser.iouType = config["iouType"]
+    optimiser.with_train = config["with_train"]
+    optimiser.metric = config["metric"]
+    try:
+        optimiser.compare_model()
+        for model in config["models"]:
+            optimiser.overallArgmax(model)
+        if config["overall"]:
+            optimiser.plotOverall()
+        # the map holds the thresholds of the validation dataset even with `with_train`, as before the pipeline
+        optimiser.writeMapIoU()
+    finally:
+        # the renderer processes must stop for the stage process to exit, see `Pipeline.run`
+        optimiser.plotter.close()
+    files = [model + "/" + optimiser.DIR_GENERAL + "iouThreshmap.pbtxt" for model in config["models"]]
+    return [file for file in files if os.path.isfile(file)]
+
+
+class Pipeline:
+
+    #The goal of this class is to run the whole study described by a config file as a graph of stages, rerunning only
+    #the stages whose inputs changed since the last run. Each stage has a key, the sha1 of its settings, of the content
+    #of its input files, of its source files and of the keys of the stages it depends on: a change anywhere makes the
+    #stage and everything after it stale. The stages ready to run are run in parallel processes.
+
+    #   Stages:
+    #    inference/model:                - detections of the model, keyed by the model files and the decoding settings
+    #    fn/validation, fn/train:        - `GroundTruthFN` curves when `with_train` is set
+    #    sweep/model/category/split:     - `getClassAP` of each category, split being validation (and validation_train)
+    #    overall/model:                  - `getOverallAP` when `overall` is set
+    #    optimiser:                      - comparisons, overall argmax and iouThreshmap.pbtxt of every model
+
+    #   Parameters:
+    #    config:             - settings of the study, see `DEFAULT_CONFIG`
+    #    state:              - dictionnary saved in `config["stateFile"]`: {"stages": {name: {"key", "outputs"}}, "files": {path: [size, mtime, sha1]}}
+
+    def __init__(self, config):
+        """
+        Initialize Pipeline
+        :param config: path of a json config file, or a dictionnary with the keys of `DEFAULT_CONFIG`
+        :return: None
+        """
+        if isinstance(config, str):
+            with open(config, "r") as fs:
+                config = json.load(fs)
+        unknown = set(config) - set(DEFAULT_CONFIG)
+        assert not unknown, "Unknown settings in the config: {}".format(sorted(unknown))
+        self.config = dict(DEFAULT_CONFIG, **config)
+        assert not self.config["with_train"] or self.config["annotationTrain"] is not None, \
+            "Please input an annotation file for the training set"
+        self.state = {"stages": dict(), "files": dict()}
+        if os.path.isfile(self.config["stateFile"]):
+            with open(self.config["stateFile"], "r") as fs:
+                self.state = json.load(fs)
+
+    def _saveState(self):
+        tmpFile = "{}.{}.tmp".format(self.config["stateFile"], os.getpid())
+        with open(tmpFile, "w") as fs:
+            json.dump(self.state, fs, indent=1)
+        os.replace(tmpFile, self.config["stateFile"])
+
+    def fileHash(self, path):
+        """
+        sha1 of the content of a file, only recomputed when its size or modification time changed.
+        :return: hexadecimal digest, None if the file does not exist
+        """
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        known = self.state["files"].get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        digest = annotationHash(path)
+        self.state["files"][path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def modelFingerprint(self, model):
+        """
+        :return: sha1 of the files of modelPath/saved_model and of modelPath/pipeline.config
+        """
+        files = [os.path.join(model, "pipeline.config")]
+        for root, _, names in os.walk(os.path.join(model, "saved_model")):
+            files += [os.path.join(root, name) for name in names]
+        return _hash({os.path.relpath(file, model): self.fileHash(file) for file in sorted(files)})
+
+    def categories(self):
+        """
+        :return: categories studied, all the ones of the validation annotations if `catFocus` is None
+        """
+        if self.config["catFocus"] is not None:
+            return list(self.config["catFocus"])
+        coco = loadCoco(self.config["annotationValidation"])
+        return [cat["name"] for cat in coco.loadCats(coco.getCatIds())]
+
+    def stages(self):
+        """
+        Build the graph of the study.
+        :return: dictionnary {name: stage} in an order where each stage comes after its dependencies. A stage is a
+                 dictionnary {"kind", "function", "args", "deps", "inputs"}
+        """
+        config = self.config
+        categories = self.categories()
+        grid = {"number_IoU_thresh": config["number_IoU_thresh"], "iouType": config["iouType"], "maxOutput": config["maxOutput"]}
+        validation = {"annotation": self.fileHash(config["annotationValidation"])}
+        stages = dict()
+
+        def add(name, kind, function, args, deps, inputs):
+            stages[name] = {"kind": kind, "function": function, "args": args, "deps": deps, "inputs": inputs}
+
+        splits = [False]
+        if config["with_train"]:
+            splits.append(True)
+            for dataType in ("validation", "train"):
+                annotationPath = config["annotationTrain"] if dataType == "train" else config["annotationValidation"]
+                add("fn/" + dataType, "fn", runGroundTruthFN, (config, dataType, categories), [],
+                    {"annotation": self.fileHash(annotationPath), "categories": categories,
+                     "number_IoU_thresh": config["number_IoU_thresh"]})
+        for model in config["models"]:
+            fingerprint = {"model": self.modelFingerprint(model), "iouType": config["iouType"], "inputSize": config["inputSize"]}
+            add("inference/" + model, "inference", runInference, (config, model, categories, fingerprint), [],
+                dict(validation, categories=categories, imagesPath=config["imagesPath"], **fingerprint))
+            for category in categories:
+                for with_train in splits:
+                    split = "validation_train" if with_train else "validation"
+                    add("sweep/{}/{}/{}".format(model, category, split), "sweep", runSweep, (config, model, category, with_train),
+                        ["inference/" + model] + (["fn/validation", "fn/train"] if with_train else []),
+                        dict(validation, category=category, **grid))
+            if config["overall"]:
+                add("overall/" + model, "overall", runOverall, (config, model, categories), ["inference/" + model],
+                    dict(validation, categories=categories, **grid))
+        add("optimiser", "optimiser", runOptimiser, (config, categories),
+            [name for name, stage in stages.items() if stage["kind"] in ("sweep", "overall")],
+            dict(validation, categories=categories, metric=config["metric"], with_train=config["with_train"], **grid))
+        return stages
+
+    def keys(self, stages):
+        """
+        :return: dictionnary {name: key} of every stage
+        """
+        keys = dict()
+        for name, stage in stages.items():
+            code = {source: self.fileHash(os.path.join(SOURCE_DIRECTORY, source)) for source in STAGE_SOURCES[stage["kind"]]}
+            keys[name] = _hash({"name": name, "inputs": stage["inputs"], "code": code, "deps": [keys[dep] for dep in stage["deps"]]})
+        return keys
+
+    def isStale(self, name, key):
+        """
+        :return: True if the stage never ran with this key or one of its outputs is missing
+        """
+        done = self.state["stages"].get(name)
+        return done is None or done["key"] != key or not all(os.path.isfile(file) for file in done["outputs"])
+
+    def status(self):
+        """
+        :return: dictionnary {name: "stale" or "fresh"} of every stage
+        """
+        stages = self.stages()
+        keys = self.keys(stages)
+        self._saveState()
+        return {name: "stale" if self.isStale(name, keys[name]) else "fresh" for name in stages}
+
+    def run(self, workers=None):
+        """
+        Run the stale stages, each one as soon as all its dependencies are done, up to `workers` at once.
+        The state is saved after each stage, so an interrupted run resumes where it stopped. A failed stage is reported
+        and the stages depending on it are skipped, the others still run.
+
+        :param workers: number of parallel processes, by default the one of the config. With 1 the stages run in this process
+        :return: dictionnary {name: "fresh", "ran", "failed" or "skipped"}
+        """
+        workers = self.config["workers"] if workers is None else workers
+        stages = self.stages()
+        keys = self.keys(stages)
+        status = {name: "fresh" for name in stages if not self.isStale(name, keys[name])}
+        pending = [name for name in stages if name not in status]
+        self._saveState()
+
+        def finish(name, outputs=None, error=None):
+            if error is None:
+                self.state["stages"][name] = {"key": keys[name], "outputs": outputs}
+                self._saveState()
+                status[name] = "ran"
+            else:
+                print("Stage {} failed:\n{}".format(name, error))
+                status[name] = "failed"
+
+        pool = ProcessPoolExecutor(workers) if workers > 1 else None
+        running = dict()
+        try:
+            while pending or running:
+                for name in list(pending):
+                    deps = [status.get(dep) for dep in stages[name]["deps"]]
+                    if any(dep in ("failed", "skipped") for dep in deps):
+                        status[name] = "skipped"
+                        pending.remove(name)
+                    elif all(dep in ("fresh", "ran") for dep in deps):
+                        pending.remove(name)
+                        print("Run stage {}".format(name))
+                        if pool is None:
+                            try:
+                                finish(name, stages[name]["function"](*stages[name]["args"]))
+                            except Exception:
+                                finish(name, error=traceback.format_exc())
+                        else:
+                            running[pool.submit(stages[name]["function"], *stages[name]["args"])] = name
+                if not running:
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        finish(name, future.result())
+                    except Exception:
+                        finish(name, error=traceback.format_exc())
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stale stages of the study described by a json config file.")
+    parser.add_argument("config", help="json config file, see `pipeline.DEFAULT_CONFIG`")
+    parser.add_argument("--workers", type=int, default=None, help="number of parallel processes")
+    parser.add_argument("--status", action="store_true", help="only print which stages are stale")
+    args = parser.parse_args()
+    pipeline = Pipeline(args.config)
+    result = pipeline.status() if args.status else pipeline.run(args.workers)
+    for name, state in result.items():
+        print("{:<8} {}".format(state, name))
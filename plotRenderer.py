@@ -0,0 +1,295 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import numpy as np
+import os
+import matplotlib
+from concurrent.futures import ProcessPoolExecutor
+
+###############################################################################
+
+# All the render functions only take plain data (lists, arrays, paths) so that they can be
+# sent to a worker process. They are kept out of the analysis classes in order to keep the
+# matplotlib work off the computation.
+
+
+def _initWorker():
+    """
+    Every worker renders in files only, no display is needed.
+    """
+    matplotlib.use('Agg')
+
+
+class PlotRenderer:
+
+    #The goal of this class is to render the graphs of the analysis in a pool of processes
+    #while the computation goes on.
+
+    #   Parameters:
+    #    processes:          - number of worker processes. If set to 0 the graphs are rendered right away in the current process.
+    #                           If set to None the number of cpus is used.
+
+    def __init__(self, processes=None):
+        """
+        Initialize PlotRenderer
+        :param processes: number of worker processes, 0 to render in the current process
+        :return: None
+        """
+        self.processes = processes
+        self._pool = None
+        self._futures = []
+
+    def submit(self, function, *args):
+        """
+        Schedule the rendering `function(*args)`.
+        :param function: one of the render functions of this module
+        :return: None
+        """
+        if self.processes == 0:
+            function(*args)
+            return
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.processes, initializer=_initWorker)
+        self._futures.append(self._pool.submit(function, *args))
+
+    def wait(self):
+        """
+        Wait for all the scheduled graphs to be written. Raise the first rendering error if any.
+        :return: None
+        """
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """
+        Wait for the scheduled graphs and stop the worker processes, even if a rendering failed.
+        :return: None
+        """
+        try:
+            self.wait()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def savePrecisionToRecall(dataFile, category, iouThresholds, precisions):
+    """
+    Save the precision to recall curves of a category for every IoU threshold in a compressed npz.
+    :param dataFile: path of the npz file
+    :param category: category studied
+    :param iouThresholds: list of the T IoU thresholds of the nms
+    :param precisions: [TxR] precision for each recall threshold
+    :return: None
+    """
+    np.savez_compressed(dataFile, category=category, iou_threshold=np.asarray(iouThresholds),
+                        precision=np.asarray(precisions, dtype=np.float32))
+
+
+def renderPrecisionToRecall(dataFile, outputFolder, smallMultiples=False):
+    """
+    Graph the precision to recall saved by `savePrecisionToRecall`.
+    :param dataFile: path of the npz file
+    :param outputFolder: folder where the graphs are written
+    :param smallMultiples: if set to True write one figure with a graph per IoU threshold (`all_iou.png`),
+                            else write one figure `iou={}.png` per IoU threshold.
+    :return: None
+    """
+    from matplotlib import pyplot as plt
+    data = np.load(dataFile)
+    category = str(data["category"])
+    precisions = data["precision"]
+    recall = np.linspace(0, 1, precisions.shape[1])
+    if not os.path.isdir(outputFolder):
+        os.makedirs(outputFolder)
+
+    if smallMultiples:
+        columns = int(np.ceil(np.sqrt(len(precisions))))
+        rows = int(np.ceil(len(precisions) / columns))
+        fig, axes = plt.subplots(rows, columns, figsize=(3 * columns, 3 * rows), sharex=True, sharey=True, squeeze=False)
+        for ax in axes.flat[len(precisions):]:
+            ax.axis('off')
+        for ax, iouThreshold, precision in zip(axes.flat, data["iou_threshold"], precisions):
+            ax.plot(recall, precision)
+            ax.set_title('IoU = {}'.format(round(float(iouThreshold), 3)), fontsize=8)
+        fig.suptitle('Class = {}'.format(category))
+        fig.text(0.5, 0.04, 'Recall', ha='center')
+        fig.text(0.04, 0.5, 'Precision', va='center', rotation='vertical')
+        fig.savefig(outputFolder + '/all_iou.png', bbox_inches='tight')
+        plt.close('all')
+        return
+
+    for iouThreshold, precision in zip(data["iou_threshold"], precisions):
+        iouThreshold = round(float(iouThreshold), 3)
+        plt.figure(figsize=(18, 10))
+        # Plot the data
+        plt.plot(recall, precision,
+                 label='Precision to recall for IoU = {}'.format(iouThreshold))
+        # Add a legend
+        plt.legend(loc="lower left")
+        plt.title('Class = {}'.format(category))
+        plt.xlabel('Recall')
+        plt.ylabel('Precision')
+        plt.savefig(outputFolder +
+                    '/iou={}.png'.format(iouThreshold), bbox_inches='tight')
+        plt.close('all')
+
+
+def renderAPCurve(iou, AP, category, label, outputFile):
+    """
+    Plot the AP to IoU Threshold of a category.
+    :param label: name of the metric, e.g AP[IoU=0.95]
+    :return: None
+    """
+    from matplotlib import pyplot as plt
+    plt.figure(figsize=(18, 10))
+    # Plot the data
+    plt.plot(iou, AP, label=label)
+    # Add a legend
+    plt.legend(loc="lower left")
+    plt.title('Class = {}'.format(category))
+    plt.xlabel('iou threshold')
+    plt.ylabel(label)
+    plt.savefig(outputFile, bbox_inches='tight')
+    plt.close('all')
+
+
+def renderHistogram(values, category, outputFile, nb_bins=20):
+    """
+    Plot the historigram of the intersection over union in between all instances of a category.
+    :return: None
+    """
+    from matplotlib import pyplot as plt
+    plt.figure(figsize=(18, 10))
+    plt.hist(values, bins=nb_bins)
+    plt.ylabel('Number of detections')
+    plt.xlabel("IoU")
+    plt.title('Class = {}'.format(category))
+    plt.savefig(outputFile, bbox_inches='tight')
+    plt.close('all')
+
+
+def _plotModels(ax, iou, AP, model):
+    """
+    Plot the AP to IoU for a given model onto a given axis of the graph, annotated with its argmax and variance.
+    :param ax: a matplotlib.pyplot axis
+    :param iou: list of IoU Threshold i.e the X-axis.
+    :param AP: list of corresponding AP i.e the Y-axis
+    :param model: Under which model were the results found
+    :return: None
+    """
+    iou = np.asarray(iou)
+    AP = np.asarray(AP)
+    ax.plot(iou, AP, label=model)
+    idx = np.argmax(np.flip(AP))
+    xmax = np.flip(iou)[idx]
+    ymax = np.flip(AP)[idx]
+    ax.annotate('IoU = {}, var = {}'.format(np.format_float_scientific(xmax, unique=False, precision=2), np.format_float_scientific(np.var(AP), unique=False, precision=2)), xy=(xmax, ymax),
+                arrowprops=dict(facecolor='black', shrink=0.05),
+                )
+
+
+def renderModelComparison(category, validationCurves, trainCurves, outputFile):
+    """
+    Plot the AP to IoU treshold of each model for a category onto the same graph.
+    :param validationCurves: list of (model, iou, AP) using only the validation set
+    :param trainCurves: list of (model, iou, AP) using the fn/npig ratio of the training dataset, None to skip the second axis
+    :return: None
+    """
+    from matplotlib import pyplot as plt
+    if trainCurves is not None:
+        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(18, 10))
+    else:
+        fig, ax1 = plt.subplots(1, 1, figsize=(18, 10))
+    for model, iou, AP in validationCurves:
+        _plotModels(ax1, iou, AP, model)
+    fig.suptitle("Comparison per model of AP to IoU Threshold for {}".format(category))
+
+    ax1.title.set_text("AP[IoU=0.5] validation")
+    ax1.set_xlabel("IoU threshold")
+    ax1.set_ylabel("AP[IoU=0.5]")
+    ax1.legend(loc='lower left')
+    if trainCurves is not None:
+        for model, iou, AP in trainCurves:
+            _plotModels(ax2, iou, AP, model)
+        ax2.title.set_text("AP[IoU=0.5] validation with train MR_nms")
+        ax2.set_xlabel("IoU threshold")
+        ax2.set_ylabel("AP[IoU=0.5]")
+        ax2.legend(loc='lower left')
+
+    fig.savefig(outputFile, bbox_inches='tight')
+    plt.close('all')
+
+
+def renderOverall(curves, outputFile):
+    """
+    Plot the AP to iouThreshold for the overall categories, a curve for each model.
+    :param curves: list of (model, iou, AP)
+    :return: None
+    """
+    from matplotlib import pyplot as plt
+    fig, ax = plt.subplots(1, 1, figsize=(18, 10))
+    for model, iou, AP in curves:
+        _plotModels(ax, iou, AP, model)
+    ax.set_title("AP[IoU=0.5] validation")
+    ax.set_xlabel("IoU threshold")
+    ax.set_ylabel("AP[IoU=0.5]")
+    ax.legend()
+    fig.savefig(outputFile, bbox_inches='tight')
+    plt.close('all')
+
+
+def _minMaxScaler(array):
+    """
+    :param array: array of digits
+    :return: (array-min)/(max - min) if max != min else array.
+    """
+    M = max(array)
+    m = min(array)
+    if m == M:
+        return array
+    else:
+        return (array-m)/(M - m)
+
+
+def renderOverallSum(iou, overallSum, outputFile):
+    """
+    Plot the min max scaled sum over the categories of each formula of `optimisedNMS.overallArgmax`.
+    :param overallSum: dictionnary with keys "AP", "AP*var" and "AP*weight"
+    :return: None
+    """
+    from matplotlib import pyplot as plt
+    # the latex settings must not leak into the next graphs rendered by the same worker
+    with plt.rc_context({'text.usetex': True, 'font.family': 'serif'}):
+        plt.figure(figsize=(18, 10))
+        plt.plot(iou, _minMaxScaler(np.asarray(overallSum["AP*var"])), label=r"$\displaystyle\sum_{cat}AP(cat,iou)*var(AP(cat))$")
+        plt.plot(iou, _minMaxScaler(np.asarray(overallSum["AP"])), label=r"$\displaystyle\sum_{cat}AP(cat,iou)$")
+        plt.plot(iou, _minMaxScaler(np.asarray(overallSum["AP*weight"])), label=r"$\displaystyle\sum_{cat}AP(cat,iou)*w(cat)$")
+        plt.ylabel("AP[IoU] = 0.5")
+        plt.xlabel("IoU Threshold")
+        plt.legend()
+        plt.title("Function min max scaled")
+        plt.savefig(outputFile, bbox_inches='tight')
+        plt.close('all')
+
+
+def renderScaling(parameter, values, timings, outputFile):
+    """
+    Plot the time of each stage of `benchmark.Benchmark` against the value of a parameter of the synthetic dataset.
+    :param timings: dictionnary {stage: list of seconds for each value}
+    :return: None
+    """
+    from matplotlib import pyplot as plt
+    fig, ax = plt.subplots(1, 1, figsize=(18, 10))
+    for stage, seconds in timings.items():
+        ax.plot(values, seconds, marker='o', label=stage)
+    ax.set_title("Time per stage")
+    ax.set_xlabel(parameter)
+    ax.set_ylabel("seconds")
+    ax.legend()
+    fig.savefig(outputFile, bbox_inches='tight')
+    plt.close('all')
@@ -0,0 +1,103 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import numpy as np
+
+###############################################################################
+
+# Metrics of `COCOeval.summarize`: (ap, iouThr, areaRng, index in params.maxDets). iouThr None is the mean over [.5:.95]
+METRICS = {
+    "AP": (1, None, 'all', -1),
+    "AP50": (1, .5, 'all', -1),
+    "AP75": (1, .75, 'all', -1),
+    "APs": (1, None, 'small', -1),
+    "APm": (1, None, 'medium', -1),
+    "APl": (1, None, 'large', -1),
+    "AR1": (0, None, 'all', 0),
+    "AR10": (0, None, 'all', 1),
+    "AR": (0, None, 'all', -1),
+    "ARs": (0, None, 'small', -1),
+    "ARm": (0, None, 'medium', -1),
+    "ARl": (0, None, 'large', -1),
+}
+
+
+def prTensors(cocoEval):
+    """
+    :param cocoEval: COCOeval after `accumulate`
+    :return: precision [TxRxKxAxM] and recall [TxKxAxM] of the evaluation, in float32 to be kept for a whole sweep
+    """
+    return cocoEval.eval["precision"].astype(np.float32), cocoEval.eval["recall"].astype(np.float32)
+
+
+def savePRTensors(dataFile, iouThresholds, tensors, params):
+    """
+    Save the precision and recall of `COCOeval.accumulate` for every IoU threshold of the nms in a compressed npz, so that
+    any metric of `COCOeval.summarize` can be computed later by `metricCurve` without rerunning the sweep.
+    :param iouThresholds: [T] IoU thresholds of the nms
+    :param tensors: list of the T `prTensors`
+    :param params: `COCOeval.params` of the evaluations
+    :return: None
+    """
+    np.savez_compressed(dataFile, iou_threshold=np.asarray(iouThresholds),
+                        precision=np.stack([precision for precision, _ in tensors]),
+                        recall=np.stack([recall for _, recall in tensors]),
+                        eval_iou_thresholds=params.iouThrs, recall_thresholds=params.recThrs,
+                        area_labels=np.array(params.areaRngLbl), max_dets=np.array(params.maxDets),
+                        category_ids=np.array(params.catIds))
+
+
+def _mean(values):
+    # mean of the values computed by COCOeval, -1 where there is none
+    valid = values > -1
+    count = valid.sum(axis=tuple(range(1, values.ndim)))
+    total = np.where(valid, values, 0.).sum(axis=tuple(range(1, values.ndim)), dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(count > 0, total / count, -1.)
+
+
+def metricCurve(data, metric="AP50"):
+    """
+    Value of a metric for every IoU threshold of the nms, computed the way `COCOeval.summarize` does.
+    :param data: npz written by `savePRTensors`
+    :param metric: one of `METRICS`, or a function (data) -> [T], e.g `recallWeighted`
+    :return: [T] metric, -1 where there is no instance
+    """
+    if callable(metric):
+        return np.asarray(metric(data), dtype=np.float64)
+    ap, iouThr, areaRng, maxDet = METRICS[metric]
+    a = list(data["area_labels"]).index(areaRng)
+    # precision [TxTcxRxKxAxM], recall [TxTcxKxAxM]
+    values = data["precision"][..., a, maxDet] if ap else data["recall"][..., a, maxDet]
+    if iouThr is not None:
+        values = values[:, np.where(np.isclose(data["eval_iou_thresholds"], iouThr))[0]]
+    return _mean(values)
+
+
+def recallWeighted(weights, iouThr=.5, areaRng='all'):
+    """
+    Custom metric for `metricCurve`: the mean of the precision over the recall thresholds weighted by `weights`,
+    e.g a weight of 0 below a recall of 0.5 to favour the high recalls. All the weights set to 1 give the AP.
+    :param weights: [R] weight of each recall threshold of `COCOeval`, 101 by default
+    :param iouThr: IoU threshold of the evaluation, None for the mean over [.5:.95]
+    :return: function (data) -> [T]
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+
+    def metric(data):
+        a = list(data["area_labels"]).index(areaRng)
+        precision = data["precision"][..., a, -1]
+        if iouThr is not None:
+            precision = precision[:, np.where(np.isclose(data["eval_iou_thresholds"], iouThr))[0]]
+        # [TxTcxRxK] -> weighted mean over the recall thresholds of the valid precisions
+        valid = precision > -1
+        w = weights[None, None, :, None] * valid
+        total = (np.where(valid, precision, 0.) * w).sum(axis=2, dtype=np.float64)
+        norm = w.sum(axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            perClass = np.where(norm > 0, total / norm, -1.)
+        return _mean(perClass)
+    return metric
@@ -0,0 +1,169 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import contextlib
+import json
+import os
+import sys
+import time
+try:
+    import resource
+except ImportError:  # not available on windows, the peak memory is then not reported
+    resource = None
+
+###############################################################################
+
+# Returned by `Profiler.stage` when the profiler is disabled, so that an instrumented
+# call only costs an attribute lookup and an empty `with` block.
+_NO_PROFILING = contextlib.nullcontext()
+
+
+def peakRss():
+    """
+    :return: high-water mark of the resident set size of the current process since its start in MB, None if unknown.
+             It never decreases, see `currentRss` for the memory of a stage.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxrss / 1024. ** 2 if sys.platform == "darwin" else maxrss / 1024.
+
+
+def currentRss():
+    """
+    :return: resident set size of the current process in MB, None if unknown (only read from /proc on linux)
+    """
+    try:
+        with open("/proc/self/statm", "r") as fs:
+            pages = int(fs.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024. ** 2
+
+
+class Profiler:
+
+    #The goal of this class is to record the wall time, cpu time and memory growth of each stage of the analysis,
+    #for every category and IoU threshold studied.
+
+    #   Parameters:
+    #    enabled:            - if set to False `stage` does nothing
+    #    labels:             - dictionnary {"category": ..., "iouThreshold": ...} attached to the stages recorded
+    #    records:            - dictionnary {(stage, category, iouThreshold): {"calls", "wall", "cpu", "rssGrowth"}}. The calls of a stage
+    #                           with the same labels are summed, e.g the nms of every image for a given threshold. rssGrowth is
+    #                           the largest growth in MB of the resident set size over a call, None where `currentRss` is unknown.
+    #    stack:              - names of the stages currently running, nested stages are named "outer/inner"
+
+    def __init__(self, enabled=False):
+        """
+        Initialize Profiler
+        :param enabled: if set to False `stage` does nothing
+        :return: None
+        """
+        self.enabled = enabled
+        self.labels = {"category": None, "iouThreshold": None}
+        self.records = dict()
+        self.stack = list()
+
+    def setLabels(self, category=None, iouThreshold=None):
+        """
+        Attach a category and an IoU threshold to the next stages recorded.
+        :return: None
+        """
+        self.labels = {"category": category, "iouThreshold": None if iouThreshold is None else float(iouThreshold)}
+
+    def stage(self, name):
+        """
+        Context manager recording the block it wraps as the stage `name`.
+        :return: a context manager
+        """
+        if not self.enabled:
+            return _NO_PROFILING
+        return self._record(name)
+
+    @contextlib.contextmanager
+    def _record(self, name):
+        """
+        Add the time of the wrapped block to the record of the stage and of the current labels.
+        """
+        self.stack.append(name)
+        wall, cpu, rss = time.perf_counter(), time.process_time(), currentRss()
+        try:
+            yield
+        finally:
+            key = ("/".join(self.stack), self.labels["category"], self.labels["iouThreshold"])
+            record = self.records.get(key)
+            if record is None:
+                record = self.records[key] = {"calls": 0, "wall": 0., "cpu": 0., "rssGrowth": None}
+            record["calls"] += 1
+            record["wall"] += time.perf_counter() - wall
+            record["cpu"] += time.process_time() - cpu
+            if rss is not None:
+                record["rssGrowth"] = max(record["rssGrowth"] or 0., currentRss() - rss)
+            self.stack.pop()
+
+    def reset(self):
+        """
+        Forget the stages recorded.
+        :return: None
+        """
+        self.records = dict()
+        self.setLabels()
+
+    def _aggregate(self, records):
+        """
+        :param records: list of ((stage, category, iouThreshold), record) from `self.records`
+        :return: dictionnary {stage: {"calls", "wall", "cpu", "rssGrowth"}} summing the time and taking the maximal memory growth
+        """
+        stages = dict()
+        for (name, _, _), record in records:
+            stage = stages.setdefault(name, {"calls": 0, "wall": 0., "cpu": 0., "rssGrowth": None})
+            stage["calls"] += record["calls"]
+            stage["wall"] += record["wall"]
+            stage["cpu"] += record["cpu"]
+            if record["rssGrowth"] is not None:
+                stage["rssGrowth"] = max(stage["rssGrowth"] or 0., record["rssGrowth"])
+        return stages
+
+    def summary(self):
+        """
+        :return: table of the time and memory growth of each stage, then the peak memory of the process, as a string
+        """
+        lines = ["{:<40} {:>8} {:>12} {:>12} {:>16}".format("stage", "calls", "wall (s)", "cpu (s)", "RSS growth (MB)")]
+        for name, stage in self._aggregate(self.records.items()).items():
+            growth = "-" if stage["rssGrowth"] is None else "{:0.1f}".format(stage["rssGrowth"])
+            lines.append("{:<40} {:>8} {:>12.3f} {:>12.3f} {:>16}".format(name, stage["calls"], stage["wall"], stage["cpu"], growth))
+        peak = peakRss()
+        lines.append("peak RSS of the process (MB): {}".format("-" if peak is None else "{:0.1f}".format(peak)))
+        return "\n".join(lines)
+
+    def report(self, reportFile):
+        """
+        Write the stages recorded in a json file with the keys:
+
+        - stages: totals for each stage
+        - categories: totals for each stage of each category
+        - records: every stage recorded for each category and IoU threshold
+        - peakRss: high-water mark of the memory of the process when the report is written, see `peakRss`
+
+        and print `summary`.
+        :return: None
+        """
+        categories = dict()
+        for key, record in self.records.items():
+            categories.setdefault(str(key[1]), list()).append((key, record))
+        records = list()
+        for (name, category, iouThreshold), record in self.records.items():
+            records.append(dict({"stage": name, "category": category, "iouThreshold": iouThreshold}, **record))
+        with open(reportFile, "w") as fs:
+            json.dump({
+                "stages": self._aggregate(self.records.items()),
+                "categories": {category: self._aggregate(items) for category, items in categories.items()},
+                "records": records,
+                "peakRss": peakRss(),
+            }, fs, indent=1)
+        print(self.summary())
@@ -24,12 +24,15 @@ __version__ = '2.0'
 #  getAnnIds  - Get ann ids that satisfy given filter conditions.
 #  getCatIds  - Get cat ids that satisfy given filter conditions.
 #  getImgIds  - Get img ids that satisfy given filter conditions.
+#  createColumnarIndex - Build numpy columns backing getAnnIds/getImgIds.
+#  getAnnColumns - Get the annotation columns that satisfy given filter conditions.
 #  loadAnns   - Load anns with the specified ids.
 #  loadCats   - Load cats with the specified ids.
 #  loadImgs   - Load imgs with the specified ids.
 #  annToMask  - Convert segmentation in an annotation to binary mask.
 #  showAnns   - Display the specified annotations.
 #  loadRes    - Load algorithm results and create API for accessing them.
+#  loadResBbox - Load bbox results without synthesizing polygons nor re-indexing the images.
 #  download   - Download COCO images from mscoco.org server.
 # Throughout the API "ann"=annotation, "cat"=category, and "img"=image.
 # Help on each functions can be accessed by: "help COCO>function".
@@ -63,10 +66,32 @@ elif PYTHON_VERSION == 3:
     from urllib.request import urlretrieve
 
 
+# below this number of images the python lists answer getAnnIds faster than numpy
+COLUMNAR_MIN_IMGS = 16
+
+
 def _isArrayLike(obj):
     return hasattr(obj, '__iter__') and hasattr(obj, '__len__')
 
 
+def _ranges(starts, ends):
+    # concatenation of np.arange(s, e) for every (s, e) without python loop
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros((0,), dtype=np.int64)
+    shift = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return np.arange(total, dtype=np.int64) + shift
+
+
+def _offsetTable(keys):
+    # keys must be sorted. return unique keys and offsets such that the
+    # elements with key uniqueKeys[i] are in [offsets[i], offsets[i+1])
+    uniqueKeys, starts = np.unique(keys, return_index=True)
+    offsets = np.append(starts, len(keys)).astype(np.int64)
+    return uniqueKeys, offsets
+
+
 class COCO:
     def __init__(self, annotation_file=None):
         """
@@ -78,6 +103,8 @@ class COCO:
         # load dataset
         self.dataset,self.anns,self.cats,self.imgs = dict(),dict(),dict(),dict()
         self.imgToAnns, self.catToImgs = defaultdict(list), defaultdict(list)
+        self.columns = None
+        self.dtGroups = None
         if not annotation_file == None:
             print('loading annotations into memory...')
             tic = time.time()
@@ -117,6 +144,81 @@ class COCO:
         self.catToImgs = catToImgs
         self.imgs = imgs
         self.cats = cats
+        # the columnar index describes the previous annotations
+        self.columns = None
+
+    def createColumnarIndex(self, columns=None):
+        """
+        Create numpy columns for the annotations, used by getAnnIds and getImgIds instead of
+        the python lists. Annotations are kept in the dataset order, and two permutations sorted
+        by image id and by category id come with offset tables so that a query is a set of slices.
+        :param columns (dict) : precomputed columns (e.g. memory mapped from disk). Built from the dataset if None
+        :return: columns (dict)
+        """
+        if columns is None:
+            print('creating columnar index...')
+            anns = self.dataset.get('annotations', [])
+            N = len(anns)
+            columns = {
+                'id':          np.fromiter((ann['id'] for ann in anns), dtype=np.int64, count=N),
+                'image_id':    np.fromiter((ann['image_id'] for ann in anns), dtype=np.int64, count=N),
+                'category_id': np.fromiter((ann.get('category_id', -1) for ann in anns), dtype=np.int64, count=N),
+                'area':        np.fromiter((ann.get('area', 0) for ann in anns), dtype=np.float64, count=N),
+                'iscrowd':     np.fromiter((ann.get('iscrowd', 0) for ann in anns), dtype=np.int8, count=N),
+                'bbox':        np.array([ann.get('bbox', [0, 0, 0, 0]) for ann in anns], dtype=np.float64).reshape((N, 4)),
+            }
+            # mergesort keeps the dataset order inside a same image / category
+            columns['imgOrder'] = np.argsort(columns['image_id'], kind='mergesort')
+            columns['imgKeys'], columns['imgOffsets'] = _offsetTable(columns['image_id'][columns['imgOrder']])
+            columns['catOrder'] = np.argsort(columns['category_id'], kind='mergesort')
+            columns['catKeys'], columns['catOffsets'] = _offsetTable(columns['category_id'][columns['catOrder']])
+            # sorted unique image ids of every category
+            pairs = np.unique(np.stack((columns['category_id'], columns['image_id']), axis=1).reshape((N, 2)), axis=0)
+            columns['catImgIds'] = pairs[:, 1].copy()
+            columns['catImgKeys'], columns['catImgOffsets'] = _offsetTable(pairs[:, 0])
+            print('columnar index created!')
+        self.columns = columns
+        return columns
+
+    def _slices(self, keys, offsets, order, values):
+        # indices (in dataset order of `order`) of the elements whose key is in values
+        values = np.asarray(values, dtype=np.int64).reshape(-1)
+        pos = np.searchsorted(keys, values)
+        pos[pos == len(keys)] = 0
+        pos = pos[keys[pos] == values] if len(keys) else pos[:0]
+        inds = _ranges(offsets[pos], offsets[pos + 1])
+        return inds if order is None else order[inds]
+
+    def _annIndices(self, imgIds, catIds, areaRng, iscrowd):
+        # columnar equivalent of the filters of getAnnIds, return positions in the dataset
+        c = self.columns
+        if not len(imgIds) == 0:
+            inds = self._slices(c['imgKeys'], c['imgOffsets'], c['imgOrder'], imgIds)
+            if not len(catIds) == 0:
+                inds = inds[np.isin(c['category_id'][inds], catIds)]
+        elif not len(catIds) == 0:
+            # sort back to the dataset order, once per ann even if a category id is repeated
+            inds = np.unique(self._slices(c['catKeys'], c['catOffsets'], c['catOrder'], catIds))
+        else:
+            inds = np.arange(len(c['id']), dtype=np.int64)
+        if not len(areaRng) == 0:
+            area = c['area'][inds]
+            inds = inds[(area > areaRng[0]) & (area < areaRng[1])]
+        if not iscrowd == None:
+            inds = inds[c['iscrowd'][inds] == int(iscrowd)]
+        return inds
+
+    def getAnnColumns(self, imgIds=[], catIds=[], areaRng=[], iscrowd=None):
+        """
+        Get the columns of the anns that satisfy given filter conditions. Same filters as getAnnIds.
+        Requires createColumnarIndex.
+        :return: columns (dict) : 'id', 'image_id', 'category_id', 'area', 'iscrowd' and 'bbox' [Nx4] numpy arrays
+        """
+        assert self.columns is not None, 'Please run createColumnarIndex() first'
+        imgIds = imgIds if _isArrayLike(imgIds) else [imgIds]
+        catIds = catIds if _isArrayLike(catIds) else [catIds]
+        inds = self._annIndices(imgIds, catIds, areaRng, iscrowd)
+        return {key: self.columns[key][inds] for key in ['id', 'image_id', 'category_id', 'area', 'iscrowd', 'bbox']}
 
     def info(self):
         """
@@ -138,6 +240,9 @@ class COCO:
         imgIds = imgIds if _isArrayLike(imgIds) else [imgIds]
         catIds = catIds if _isArrayLike(catIds) else [catIds]
 
+        if self.columns is not None and not 0 < len(imgIds) < COLUMNAR_MIN_IMGS:
+            return self.columns['id'][self._annIndices(imgIds, catIds, areaRng, iscrowd)].tolist()
+
         if len(imgIds) == len(catIds) == len(areaRng) == 0:
             anns = self.dataset['annotations']
         else:
@@ -188,6 +293,14 @@ class COCO:
 
         if len(imgIds) == len(catIds) == 0:
             ids = self.imgs.keys()
+        elif self.columns is not None:
+            c = self.columns
+            ids = np.unique(np.asarray(imgIds, dtype=np.int64)) if len(imgIds) else None
+            for catId in catIds:
+                catImgs = self._slices(c['catImgKeys'], c['catImgOffsets'], None, [catId])
+                catImgs = c['catImgIds'][catImgs]
+                ids = catImgs if ids is None else np.intersect1d(ids, catImgs, assume_unique=True)
+            ids = ids.tolist()
         else:
             ids = set(imgIds)
             for i, catId in enumerate(catIds):
@@ -363,6 +476,53 @@ class COCO:
         res.createIndex()
         return res
 
+    def loadResBbox(self, data):
+        """
+        Load bbox results and return a lightweight result api object. Compared to loadRes no polygon
+        segmentation is synthesized, the images and categories are shared by reference with self and
+        only the per-(image, category) groups used by COCOeval are built (res.dtGroups). An empty array is
+        accepted, e.g. a shard of images where the nms left no detection.
+        :param   data (numpy.ndarray or dict) : [Nx7] array where each row contains {imageID,x1,y1,w,h,score,class}
+                                                or dict of columns 'image_id' [N], 'bbox' [Nx4], 'score' [N], 'category_id' [N]
+        :return: res (obj)                    : result api object
+        """
+        print('Loading and preparing bbox results...')
+        tic = time.time()
+        if type(data) == np.ndarray:
+            assert data.ndim == 2 and data.shape[1] == 7, 'results are not a [Nx7] array'
+            data = {'image_id': data[:, 0], 'bbox': data[:, 1:5], 'score': data[:, 5], 'category_id': data[:, 6]}
+        imageIds = np.asarray(data['image_id']).astype(np.int64)
+        categoryIds = np.asarray(data['category_id']).astype(np.int64)
+        bboxes = np.asarray(data['bbox'], dtype=np.float64).reshape((-1, 4))
+        scores = np.asarray(data['score'], dtype=np.float64)
+        assert all(imgId in self.imgs for imgId in np.unique(imageIds).tolist()), \
+               'Results do not correspond to current coco set'
+
+        res = COCO()
+        res.dataset['images'] = self.dataset['images']
+        res.dataset['categories'] = self.dataset['categories']
+        res.imgs = self.imgs
+        res.cats = self.cats
+        areas = (bboxes[:, 2] * bboxes[:, 3]).tolist()
+        anns = [{
+            'id': id+1,
+            'image_id': imgId,
+            'category_id': catId,
+            'bbox': bb,
+            'score': score,
+            'area': area,
+            'iscrowd': 0,
+            } for id, (imgId, catId, bb, score, area) in enumerate(
+                zip(imageIds.tolist(), categoryIds.tolist(), bboxes.tolist(), scores.tolist(), areas))]
+        dtGroups = defaultdict(list)
+        for ann in anns:
+            dtGroups[ann['image_id'], ann['category_id']].append(ann)
+        res.dataset['annotations'] = anns
+        res.anns = {ann['id']: ann for ann in anns}
+        res.dtGroups = dtGroups
+        print('DONE (t={:0.2f}s)'.format(time.time()- tic))
+        return res
+
     def download(self, tarDir = None, imgIds = [] ):
         '''
         Download COCO images from mscoco.org server.
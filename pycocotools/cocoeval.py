@@ -7,11 +7,165 @@ Edited by Noah Sarfati
 import numpy as np
 import datetime
 import time
+import contextlib
 from collections import defaultdict
 from . import mask as maskUtils
+from .coco import _ranges
 import copy
 import json
 
+def oks(dtKeypoints, gtKeypoints, gtBoxes, gtAreas, sigmas):
+    # object keypoint similarity of every detection with every ground truth, vectorized over the D detections,
+    # the G ground truths and the K keypoints
+    # dtKeypoints [DxK*3], gtKeypoints [GxK*3] of the form [x1,y1,v1,...], gtBoxes [Gx4], gtAreas [G] -> [DxG]
+    vars = (sigmas * 2)**2
+    xd = dtKeypoints[:, None, 0::3]; yd = dtKeypoints[:, None, 1::3]
+    xg = gtKeypoints[None, :, 0::3]; yg = gtKeypoints[None, :, 1::3]
+    visible = gtKeypoints[:, 2::3] > 0
+    k1 = np.count_nonzero(visible, axis=1)
+    # gt without visible keypoint: distance to the ignore region, the gt bbox doubled
+    x0 = (gtBoxes[:, 0] - gtBoxes[:, 2])[None, :, None]; x1 = (gtBoxes[:, 0] + gtBoxes[:, 2] * 2)[None, :, None]
+    y0 = (gtBoxes[:, 1] - gtBoxes[:, 3])[None, :, None]; y1 = (gtBoxes[:, 1] + gtBoxes[:, 3] * 2)[None, :, None]
+    hasVisible = (k1 > 0)[None, :, None]
+    dx = np.where(hasVisible, xd - xg, np.maximum(0, x0 - xd) + np.maximum(0, xd - x1))
+    dy = np.where(hasVisible, yd - yg, np.maximum(0, y0 - yd) + np.maximum(0, yd - y1))
+    e = (dx**2 + dy**2) / vars / (gtAreas[None, :, None] + np.spacing(1)) / 2
+    counted = np.where((k1 > 0)[:, None], visible, True)
+    return np.sum(np.exp(-e) * counted[None], axis=2) / np.count_nonzero(counted, axis=1)[None, :]
+
+def _noStage(name):
+    return contextlib.nullcontext()
+
+def _unpackBits(packed, columns, count):
+    # boolean values at the given columns of bits packed along the last axis with np.packbits
+    if len(columns) == 0:
+        return np.zeros(packed.shape[:-1] + (0,), dtype=bool)
+    lo, hi = int(columns.min()), int(columns.max()) + 1
+    bits = np.unpackbits(packed[..., lo // 8:(hi + 7) // 8], axis=-1)
+    return bits[..., columns - (lo // 8) * 8].astype(bool)
+
+class EvalImgs:
+    # Packed per-image per-category evaluation results of COCOeval.evaluate().
+    #
+    # Only the non-empty (category, area range, image) entries are stored. The detections
+    # and ground truths of all the entries are concatenated in columns, entry e owning the
+    # detections [dtOffsets[e], dtOffsets[e+1]) and the ground truths [gtOffsets[e], gtOffsets[e+1]):
+    #  keys       - [E] position of each entry in the KxAxI list of the original evalImgs
+    #  dtIds      - [D] id of each detection, sorted by score inside an entry
+    #  dtScores   - [D] confidence of each dt, float32 when it holds the scores exactly
+    #  dtMatches  - [TxD] int32 position in its entry + 1 of the matching gt, or 0
+    #  dtIgnore   - [TxD] ignore flag for each dt, bit packed
+    #  gtIds      - [G] id of each ground truth, ignored ones last inside an entry
+    #  gtMatches  - [TxG] int32 position in its entry + 1 of the matching dt, or 0
+    #  gtIgnore   - [G] ignore flag for each gt, bit packed
+    #  FN         - [G] gt neither ignored nor matched at the first IoU threshold, bit packed
+    # Indexing or iterating gives the original dict (or None) of each entry, rebuilt on demand.
+    def __init__(self, catIds, areaRng, imgIds, maxDet, T):
+        self.catIds = list(catIds)
+        self.areaRng = list(areaRng)
+        self.imgIds = list(imgIds)
+        self.maxDet = maxDet
+        self.T = T
+        self._entries = []
+
+    def append(self, key, result):
+        # result of COCOeval._matchImg for the entry at `key`, packed by pack()
+        self._entries.append((key, result))
+
+    def pack(self):
+        T = self.T
+        entries, self._entries = self._entries, []
+        self.keys = np.array([key for key, _ in entries], dtype=np.int64)
+        dtCounts = [len(result[0]) for _, result in entries]
+        gtCounts = [len(result[1]) for _, result in entries]
+        self.dtOffsets = np.concatenate(([0], np.cumsum(dtCounts))).astype(np.int64)
+        self.gtOffsets = np.concatenate(([0], np.cumsum(gtCounts))).astype(np.int64)
+        self.D, self.G = int(self.dtOffsets[-1]), int(self.gtOffsets[-1])
+        def _concat(index, shape, dtype, axis=0):
+            return np.concatenate([np.zeros(shape, dtype=dtype)] + [np.asarray(result[index], dtype=dtype) for _, result in entries], axis=axis)
+        self.dtIds = _concat(0, (0,), np.int64)
+        self.gtIds = _concat(1, (0,), np.int64)
+        self.dtMatches = _concat(2, (T, 0), np.int32, axis=1)
+        self.gtMatches = _concat(3, (T, 0), np.int32, axis=1)
+        scores = _concat(4, (0,), np.float64)
+        self.dtScores = scores.astype(np.float32) if np.array_equal(scores.astype(np.float32), scores) else scores
+        self.gtIgnore = np.packbits(_concat(5, (0,), bool))
+        self.dtIgnore = np.packbits(_concat(6, (T, 0), bool, axis=1), axis=1)
+        self.FN = np.packbits(_concat(7, (0,), bool))
+        return self
+
+    def __len__(self):
+        return len(self.catIds) * len(self.areaRng) * len(self.imgIds)
+
+    def __iter__(self):
+        for key in range(len(self)):
+            yield self[key]
+
+    def __getitem__(self, key):
+        e = np.searchsorted(self.keys, key)
+        if e == len(self.keys) or self.keys[e] != key:
+            return None
+        I, A = len(self.imgIds), len(self.areaRng)
+        dt = np.arange(self.dtOffsets[e], self.dtOffsets[e+1])
+        gt = np.arange(self.gtOffsets[e], self.gtOffsets[e+1])
+        gtIds = self.gtIds[gt]
+        dtIds = self.dtIds[dt]
+        dtm = self.dtMatches[:, dt]
+        gtm = self.gtMatches[:, gt]
+        return {
+                'image_id':     self.imgIds[key % I],
+                'category_id':  self.catIds[key // (A * I)],
+                'aRng':         self.areaRng[key // I % A],
+                'maxDet':       self.maxDet,
+                'dtIds':        dtIds.tolist(),
+                'gtIds':        gtIds.tolist(),
+                'dtMatches':    np.where(dtm > 0, np.append(gtIds, 0)[dtm - 1], 0).astype(np.float64),
+                'gtMatches':    np.where(gtm > 0, np.append(dtIds, 0)[gtm - 1], 0).astype(np.float64),
+                'dtScores':     self.dtScores[dt].astype(np.float64).tolist(),
+                'gtIgnore':     _unpackBits(self.gtIgnore, gt, self.G).astype(np.int64),
+                'dtIgnore':     _unpackBits(self.dtIgnore, dt, self.D),
+                'FN':           _unpackBits(self.FN, gt, self.G),
+            }
+
+    def numberFN(self):
+        # number of false negatives summed over all the entries
+        return int(np.unpackbits(self.FN, count=self.G).sum())
+
+    def numberInstances(self):
+        # number of non ignored gt summed over all the entries
+        return self.G - int(np.unpackbits(self.gtIgnore, count=self.G).sum())
+
+    def imageCounts(self):
+        # [I] number of false negatives and of non ignored gt of each image of imgIds, summed over its entries:
+        # they sum to numberFN() and numberInstances()
+        I = len(self.imgIds)
+        images = np.repeat(self.keys % I, np.diff(self.gtOffsets))
+        FN = np.bincount(images, weights=np.unpackbits(self.FN, count=self.G), minlength=I)
+        instances = np.bincount(images, weights=1 - np.unpackbits(self.gtIgnore, count=self.G).astype(np.int64), minlength=I)
+        return FN.astype(np.int64), instances.astype(np.int64)
+
+    def block(self, start, i_list, maxDet, images=False):
+        # dtScores [D], dtMatches [TxD], dtIgnore [TxD] of the maxDet first detections and gtIgnore [G]
+        # of the entries start + i for i in i_list, concatenated in this order. None if they are all empty.
+        # if images is True the position in i_list of the entry of each dt [D] and gt [G] is also returned.
+        keys = start + np.asarray(i_list, dtype=np.int64)
+        e = np.searchsorted(self.keys, keys)
+        positions = np.nonzero(e < len(self.keys))[0]
+        e = e[positions]
+        match = self.keys[e] == keys[positions]
+        e, positions = e[match], positions[match]
+        if len(e) == 0:
+            return None
+        dtStarts = self.dtOffsets[e]
+        dtEnds = np.minimum(self.dtOffsets[e+1], dtStarts + maxDet)
+        dt = _ranges(dtStarts, dtEnds)
+        gt = _ranges(self.gtOffsets[e], self.gtOffsets[e+1])
+        block = (self.dtScores[dt].astype(np.float64), self.dtMatches[:, dt],
+                 _unpackBits(self.dtIgnore, dt, self.D), _unpackBits(self.gtIgnore, gt, self.G))
+        if images:
+            block += (np.repeat(positions, dtEnds - dtStarts), np.repeat(positions, self.gtOffsets[e+1] - self.gtOffsets[e]))
+        return block
+
 class COCOeval:
     # Interface for evaluating detection on the Microsoft COCO dataset.
     #
@@ -82,6 +236,8 @@ class COCOeval:
         self._paramsEval = {}               # parameters for evaluation
         self.stats = []                     # result summarization
         self.ious = {}                      # ious between all gts and dts
+        self.profiler = None                # optional profiler with a stage(name) context manager timing the steps of evaluate
+        self.maskIoU = None                 # optional cache of the mask IoU of the detections before nms, see maskNMS.MaskIoU
         if not cocoGt is None:
             self.params.imgIds = sorted(cocoGt.getImgIds())
             self.params.catIds = sorted(cocoGt.getCatIds())
@@ -98,18 +254,23 @@ class COCOeval:
                 rle = coco.annToRLE(ann)
                 ann['segmentation'] = rle
         p = self.params
+        # bbox results loaded with loadResBbox are already grouped by (image, category)
+        dtGroups = getattr(self.cocoDt, 'dtGroups', None) if p.iouType == 'bbox' else None
         if p.useCats:
             gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
-            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
+            if dtGroups is None:
+                dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
         else:
             gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds))
-            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
+            if dtGroups is None:
+                dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
 
         # convert ground truth to mask if iouType == 'segm'
         if p.iouType == 'segm':
             _toMask(gts, self.cocoGt)
             _toMask(dts, self.cocoDt)
-        # set ignore flag
+        # set ignore flag, on copies: the annotations of cocoGt are shared by the evaluations running at once
+        gts = [dict(gt) for gt in gts]
         for gt in gts:
             gt['ignore'] = gt['ignore'] if 'ignore' in gt else 0
             gt['ignore'] = 'iscrowd' in gt and gt['iscrowd']
@@ -119,14 +280,21 @@ class COCOeval:
         self._dts = defaultdict(list)       # dt for evaluation
         for gt in gts:
             self._gts[gt['image_id'], gt['category_id']].append(gt)
-        for dt in dts:
-            self._dts[dt['image_id'], dt['category_id']].append(dt)
+        if dtGroups is None:
+            for dt in dts:
+                self._dts[dt['image_id'], dt['category_id']].append(dt)
+        else:
+            setI = set(p.imgIds)
+            setK = set(p.catIds)
+            for (imgId, catId), dts in dtGroups.items():
+                if imgId in setI and (not p.useCats or catId in setK):
+                    self._dts[imgId, catId] = dts
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
         self.eval     = {}                  # accumulated evaluation results
 
     def evaluate(self):
         '''
-        Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        Run per image evaluation on given images and store results (an EvalImgs) in self.evalImgs
         :return: None
         '''
         tic = time.time()
@@ -142,8 +310,10 @@ class COCOeval:
             p.catIds = list(np.unique(p.catIds))
         p.maxDets = sorted(p.maxDets)
         self.params=p
+        stage = self.profiler.stage if self.profiler is not None else _noStage
 
-        self._prepare()
+        with stage('prepare'):
+            self._prepare()
         # loop through images, area range, max detection number
         catIds = p.catIds if p.useCats else [-1]
 
@@ -151,17 +321,25 @@ class COCOeval:
             computeIoU = self.computeIoU
         elif p.iouType == 'keypoints':
             computeIoU = self.computeOks
-        self.ious = {(imgId, catId): computeIoU(imgId, catId) \
-                        for imgId in p.imgIds
-                        for catId in catIds}
+        with stage('computeIoU'):
+            self.ious = {(imgId, catId): computeIoU(imgId, catId) \
+                            for imgId in p.imgIds
+                            for catId in catIds}
 
-        evaluateImg = self.evaluateImg
+        matchImg = self._matchImg
         maxDet = p.maxDets[-1]
-        self.evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
-                 for catId in catIds
-                 for areaRng in p.areaRng
-                 for imgId in p.imgIds
-             ]
+        A0 = len(p.areaRng)
+        I0 = len(p.imgIds)
+        with stage('evaluateImg'):
+            # only the non-empty entries are kept, packed in columns instead of a dict per entry
+            evalImgs = EvalImgs(catIds, p.areaRng, p.imgIds, maxDet, len(p.iouThrs))
+            for k, catId in enumerate(catIds):
+                for a, areaRng in enumerate(p.areaRng):
+                    for i, imgId in enumerate(p.imgIds):
+                        result = matchImg(imgId, catId, areaRng, maxDet)
+                        if result is not None:
+                            evalImgs.append(k*A0*I0 + a*I0 + i, result)
+            self.evalImgs = evalImgs.pack()
         
         self._paramsEval = copy.deepcopy(self.params)
         toc = time.time()
@@ -193,6 +371,9 @@ class COCOeval:
 
         # compute iou between each dt and gt region
         iscrowd = [int(o['iscrowd']) for o in gt]
+        if p.iouType == 'segm' and self.maskIoU is not None and len(d) and len(g) and all('sourceIndex' in o for o in dt):
+            # rows of the detections kept by the nms in the iou of all the detections, computed once for the sweep
+            return self.maskIoU.groundTruthIoU(imgId,catId,g,iscrowd)[[o['sourceIndex'] for o in dt]]
         ious = maskUtils.iou(d,g,iscrowd)
         return ious
 
@@ -208,42 +389,41 @@ class COCOeval:
         # if len(gts) == 0 and len(dts) == 0:
         if len(gts) == 0 or len(dts) == 0:
             return []
-        ious = np.zeros((len(dts), len(gts)))
-        sigmas = p.kpt_oks_sigmas
-        vars = (sigmas * 2)**2
-        k = len(sigmas)
-        # compute oks between each detection and ground truth object
-        for j, gt in enumerate(gts):
-            # create bounds for ignore regions(double the gt bbox)
-            g = np.array(gt['keypoints'])
-            xg = g[0::3]; yg = g[1::3]; vg = g[2::3]
-            k1 = np.count_nonzero(vg > 0)
-            bb = gt['bbox']
-            x0 = bb[0] - bb[2]; x1 = bb[0] + bb[2] * 2
-            y0 = bb[1] - bb[3]; y1 = bb[1] + bb[3] * 2
-            for i, dt in enumerate(dts):
-                d = np.array(dt['keypoints'])
-                xd = d[0::3]; yd = d[1::3]
-                if k1>0:
-                    # measure the per-keypoint distance if keypoints visible
-                    dx = xd - xg
-                    dy = yd - yg
-                else:
-                    # measure minimum distance to keypoints in (x0,y0) & (x1,y1)
-                    z = np.zeros((k))
-                    dx = np.max((z, x0-xd),axis=0)+np.max((z, xd-x1),axis=0)
-                    dy = np.max((z, y0-yd),axis=0)+np.max((z, yd-y1),axis=0)
-                e = (dx**2 + dy**2) / vars / (gt['area']+np.spacing(1)) / 2
-                if k1 > 0:
-                    e=e[vg > 0]
-                ious[i, j] = np.sum(np.exp(-e)) / e.shape[0]
-        return ious
+        return oks(np.array([d['keypoints'] for d in dts], dtype=np.float64),
+                   np.array([g['keypoints'] for g in gts], dtype=np.float64),
+                   np.array([g['bbox'] for g in gts], dtype=np.float64),
+                   np.array([g['area'] for g in gts], dtype=np.float64), p.kpt_oks_sigmas)
 
     def evaluateImg(self, imgId, catId, aRng, maxDet):
         '''
         perform evaluation for single category and image
         :return: dict (single image results)
         '''
+        result = self._matchImg(imgId, catId, aRng, maxDet)
+        if result is None:
+            return None
+        dtIds, gtIds, dtm, gtm, dtScores, gtIg, dtIg, dtFN = result
+        return {
+                'image_id':     imgId,
+                'category_id':  catId,
+                'aRng':         aRng,
+                'maxDet':       maxDet,
+                'dtIds':        dtIds,
+                'gtIds':        gtIds,
+                'dtMatches':    np.where(dtm > 0, np.array(gtIds + [0])[dtm - 1], 0).astype(np.float64),
+                'gtMatches':    np.where(gtm > 0, np.array(dtIds + [0])[gtm - 1], 0).astype(np.float64),
+                'dtScores':     dtScores,
+                'gtIgnore':     gtIg,
+                'dtIgnore':     dtIg,
+                'FN':           dtFN,
+            }
+
+    def _matchImg(self, imgId, catId, aRng, maxDet):
+        '''
+        perform evaluation for single category and image, matches are stored as positions instead of ids
+        :return: tuple (dtIds, gtIds, dtMatches, gtMatches, dtScores, gtIgnore, dtIgnore, FN) or None if no gt and no dt
+                 where dtMatches [TxD] (resp. gtMatches [TxG]) is the position + 1 of the matching gt (resp. dt), or 0
+        '''
         p = self.params
         if p.useCats:
             gt = self._gts[imgId,catId]
@@ -299,33 +479,24 @@ class COCOeval:
                     if m ==-1:
                         continue
                     dtIg[tind,dind] = gtIg[m]
-                    dtm[tind,dind]  = gt[m]['id']
-                    gtm[tind,m]     = d['id']
+                    dtm[tind,dind]  = m + 1
+                    gtm[tind,m]     = dind + 1
         # set unmatched detections outside of area range to ignore
         a = np.array([d['area']<aRng[0] or d['area']>aRng[1] for d in dt]).reshape((1, len(dt)))
         dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,T,0)))
         # store results for given image and category
         dtFN = np.logical_and(np.logical_not(gtIg),np.logical_not(gtm[0,:]))
        
-        return {
-                'image_id':     imgId,
-                'category_id':  catId,
-                'aRng':         aRng,
-                'maxDet':       maxDet,
-                'dtIds':        [d['id'] for d in dt],
-                'gtIds':        [g['id'] for g in gt],
-                'dtMatches':    dtm,
-                'gtMatches':    gtm,
-                'dtScores':     [d['score'] for d in dt],
-                'gtIgnore':     gtIg,
-                'dtIgnore':     dtIg,
-                'FN':           dtFN,
-            }
+        # float64 while matching, its scalars compare faster than int32 ones
+        return ([d['id'] for d in dt], [g['id'] for g in gt], dtm.astype(np.int32), gtm.astype(np.int32),
+                [d['score'] for d in dt], gtIg, dtIg, dtFN)
 
-    def accumulate(self,iou_threshold, p = None,category='bicycle',withTrain = False):
+    def accumulate(self,iou_threshold, p = None,category='bicycle',withTrain = False,nmsError = None):
         '''
         Accumulate per image evaluation results and store the result in self.eval
         :param p: input params for evaluation
+        :param nmsError: (validation, train) false negatives generated by the nms on the ground truth, see `nmsCore.loadNMSError`.
+                         Read from FN_with_nms/ if None and withTrain
         :return: None
         '''
         print('Accumulating evaluation results...')
@@ -364,13 +535,17 @@ class COCOeval:
         # retrieve E at each category, area range, and max number of detections
         
         """If one wants to add MRnms_train and remove MRerr"""
+        nmsFN = None
         if withTrain:
-            with open("FN_with_nms/validationFN/{}.json".format(category),"r") as fs:
-                nmserror = json.load(fs)
-                npig_val = nmserror["number of instances"]
-            with open("FN_with_nms/trainFN/{}.json".format(category),"r") as fs:
-                trainData = json.load(fs)
-                npig_train = trainData["number of instances"]
+            if nmsError is None:
+                with open("FN_with_nms/validationFN/{}.json".format(category),"r") as fs:
+                    nmserror = json.load(fs)
+                with open("FN_with_nms/trainFN/{}.json".format(category),"r") as fs:
+                    trainData = json.load(fs)
+            else:
+                nmserror, trainData = nmsError
+            npig_val = nmserror["number of instances"]
+            npig_train = trainData["number of instances"]
                 
                 
         for k, k0 in enumerate(k_list):
@@ -378,20 +553,18 @@ class COCOeval:
             for a, a0 in enumerate(a_list):
                 Na = a0*I0
                 for m, maxDet in enumerate(m_list):
-                    E = [self.evalImgs[Nk + Na + i] for i in i_list]
-                    E = [e for e in E if not e is None]
-                    if len(E) == 0:
+                    E = self.evalImgs.block(Nk + Na, i_list, maxDet)
+                    if E is None:
                         continue
-                    dtScores = np.concatenate([e['dtScores'][0:maxDet] for e in E])
+                    dtScores, dtm, dtIg, gtIg = E
 
                     # different sorting method generates slightly different results.
                     # mergesort is used to be consistent as Matlab implementation.
                     inds = np.argsort(-dtScores, kind='mergesort')
                     dtScoresSorted = dtScores[inds]
 
-                    dtm  = np.concatenate([e['dtMatches'][:,0:maxDet] for e in E], axis=1)[:,inds]
-                    dtIg = np.concatenate([e['dtIgnore'][:,0:maxDet]  for e in E], axis=1)[:,inds]
-                    gtIg = np.concatenate([e['gtIgnore'] for e in E])
+                    dtm  = dtm[:,inds]
+                    dtIg = dtIg[:,inds]
                     
                     
                     npig = np.count_nonzero(gtIg==0)
@@ -403,8 +576,8 @@ class COCOeval:
                     
                     fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
 
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float64)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float64)
                     
                     
                     
@@ -414,6 +587,7 @@ class COCOeval:
                                 pos = idx
                         fn_nms_validation = nmserror['False Negatives'][pos]
                         fn_nms_train = trainData['False Negatives'][pos]
+                        nmsFN = (fn_nms_validation, npig_val, fn_nms_train, npig_train)
                         
                     
                     
@@ -465,6 +639,7 @@ class COCOeval:
             'recall':   recall,
             'scores': scores,
             'instances':instances,
+            'nmsFN': nmsFN,         # (fn_nms_validation, npig_val, fn_nms_train, npig_train) used for the recall if withTrain
         }
         toc = time.time()
         print('DONE (t={:0.2f}s).'.format( toc-tic))
@@ -525,16 +700,16 @@ class COCOeval:
             return stats
         def _summarizeKps():
             stats = np.zeros((10,))
-            stats[0] = _summarize(1, maxDets=20)
-            stats[1] = _summarize(1, maxDets=20, iouThr=.5)
-            stats[2] = _summarize(1, maxDets=20, iouThr=.75)
-            stats[3] = _summarize(1, maxDets=20, areaRng='medium')
-            stats[4] = _summarize(1, maxDets=20, areaRng='large')
-            stats[5] = _summarize(0, maxDets=20)
-            stats[6] = _summarize(0, maxDets=20, iouThr=.5)
-            stats[7] = _summarize(0, maxDets=20, iouThr=.75)
-            stats[8] = _summarize(0, maxDets=20, areaRng='medium')
-            stats[9] = _summarize(0, maxDets=20, areaRng='large')
+            stats[0] = _summarize(1, maxDets=self.params.maxDets[-1])
+            stats[1] = _summarize(1, maxDets=self.params.maxDets[-1], iouThr=.5)
+            stats[2] = _summarize(1, maxDets=self.params.maxDets[-1], iouThr=.75)
+            stats[3] = _summarize(1, maxDets=self.params.maxDets[-1], areaRng='medium')
+            stats[4] = _summarize(1, maxDets=self.params.maxDets[-1], areaRng='large')
+            stats[5] = _summarize(0, maxDets=self.params.maxDets[-1])
+            stats[6] = _summarize(0, maxDets=self.params.maxDets[-1], iouThr=.5)
+            stats[7] = _summarize(0, maxDets=self.params.maxDets[-1], iouThr=.75)
+            stats[8] = _summarize(0, maxDets=self.params.maxDets[-1], areaRng='medium')
+            stats[9] = _summarize(0, maxDets=self.params.maxDets[-1], areaRng='large')
             return stats
         if not self.eval:
             raise Exception('Please run accumulate() first')
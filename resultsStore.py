@@ -0,0 +1,242 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import numpy as np
+import json
+import os
+from prTensors import metricCurve
+
+###############################################################################
+
+
+def readCurve(file):
+    """
+    Load a json file in the shape of the one written in `nmsAnalysis` or `GroundTruthFN`.
+    :return:
+
+    - iou: List of different IoU treshold studied
+    - AP:  AP corresponding to each treshold
+    - fn:  false negatives corresponding to each treshold
+    - numberInstances: The number of instances that were evaluated.
+    """
+    with open(file, "r") as fs:
+        data = json.load(fs)
+        iou = np.array(data['iou threshold'])
+        try:
+            AP = np.array(data['AP[IoU:0.5]'])
+        except KeyError:
+            AP = np.array(data['AP[IoU:0.95]'])
+
+        numberInstances = data["number of instances"]
+        fn = np.array(data['False Negatives'])
+    return iou, AP, fn, numberInstances
+
+
+class ResultsStore:
+
+    #The goal of this class is to keep the results of the sweeps of `nmsAnalysis` in a single
+    #models x categories x thresholds cube, so that the objectives of `optimisedNMS` are numpy queries.
+
+    #   Parameters:
+    #    models:             - list of paths of the models, first axis of the cube
+    #    categories:         - list of categories, second axis of the cube
+    #    iou:                - [T] IoU thresholds, third axis of the cube
+    #    AP:                 - [MxCxT] AP for each model, category and threshold. NaN if the model has no result for the category
+    #    FN:                 - [MxCxT] false negatives, -1 if missing
+    #    instances:          - [MxC] number of instances evaluated, -1 if missing
+
+    def __init__(self, models, categories, iou, AP, FN, instances):
+        self.models = list(models)
+        self.categories = list(categories)
+        self.iou = np.asarray(iou, dtype=np.float64)
+        self.AP = np.asarray(AP, dtype=np.float64)
+        self.FN = np.asarray(FN, dtype=np.int64)
+        self.instances = np.asarray(instances, dtype=np.int64)
+
+    @classmethod
+    def fromJson(cls, models, categories, computationDir):
+        """
+        Read the json written by `nmsAnalysis.getClassAP` for every model and category.
+        :param computationDir: folder relative to a model path containing the json, e.g `nms_analysis/AP[IoU=0.5]/validation/`
+        :return: ResultsStore
+        """
+        curves = dict()
+        iou = None
+        for m, model in enumerate(models):
+            for c, category in enumerate(categories):
+                file = model + "/" + computationDir + category + '.json'
+                if not os.path.isfile(file):
+                    continue
+                curveIou, AP, fn, numberInstances = readCurve(file)
+                if iou is None:
+                    iou = curveIou
+                assert len(curveIou) == len(iou) and np.allclose(curveIou, iou), \
+                    "{} was computed with other IoU thresholds, please rerun the analysis with the same number_IoU_thresh".format(file)
+                curves[m, c] = (AP, fn, numberInstances)
+        if iou is None:
+            iou = np.zeros((0,))
+        T = len(iou)
+        AP = np.full((len(models), len(categories), T), np.nan)
+        FN = -np.ones((len(models), len(categories), T), dtype=np.int64)
+        instances = -np.ones((len(models), len(categories)), dtype=np.int64)
+        for (m, c), (curveAP, fn, numberInstances) in curves.items():
+            AP[m, c] = curveAP
+            FN[m, c] = fn
+            instances[m, c] = numberInstances
+        return cls(models, categories, iou, AP, FN, instances)
+
+    @classmethod
+    def fromTensors(cls, models, categories, tensorDir, computationDir, metric):
+        """
+        Compute a metric for every model and category from the precision and recall saved by `nmsAnalysis.getClassAP`,
+        see `prTensors.metricCurve`. The false negatives and the number of instances are read from the json if any.
+        :param tensorDir: folder relative to a model path containing the npz, e.g `nms_analysis/pr_tensors/validation/`
+        :param computationDir: folder relative to a model path containing the json, e.g `nms_analysis/AP[IoU=0.5]/validation/`
+        :param metric: one of `prTensors.METRICS` or a function, it replaces the AP of the cube
+        :return: ResultsStore
+        """
+        store = cls.fromJson(models, categories, computationDir)
+        curves = dict()
+        iou = None
+        for m, model in enumerate(models):
+            for c, category in enumerate(categories):
+                file = model + "/" + tensorDir + category.replace(' ', '_') + '.npz'
+                if not os.path.isfile(file):
+                    continue
+                data = np.load(file)
+                if iou is None:
+                    iou = data["iou_threshold"]
+                assert len(data["iou_threshold"]) == len(iou) and np.allclose(data["iou_threshold"], iou), \
+                    "{} was computed with other IoU thresholds, please rerun the analysis with the same number_IoU_thresh".format(file)
+                curves[m, c] = metricCurve(data, metric)
+        if iou is None:
+            iou = np.zeros((0,))
+        T = len(iou)
+        AP = np.full((len(models), len(categories), T), np.nan)
+        FN = -np.ones((len(models), len(categories), T), dtype=np.int64)
+        instances = -np.ones((len(models), len(categories)), dtype=np.int64)
+        for (m, c), curve in curves.items():
+            AP[m, c] = curve
+            if store.available[m, c] and len(store.iou) == T:
+                FN[m, c] = store.FN[m, c]
+                instances[m, c] = store.instances[m, c]
+        return cls(models, categories, iou, AP, FN, instances)
+
+    @classmethod
+    def load(cls, storeFile):
+        """
+        :return: ResultsStore saved with `save`
+        """
+        data = np.load(storeFile)
+        return cls(data["models"].tolist(), data["categories"].tolist(), data["iou"], data["AP"], data["FN"], data["instances"])
+
+    def save(self, storeFile):
+        """
+        Write the cube in a npz file.
+        :return: None
+        """
+        np.savez_compressed(storeFile, models=np.array(self.models), categories=np.array(self.categories), iou=self.iou,
+                            AP=self.AP, FN=self.FN, instances=self.instances)
+
+    @classmethod
+    def build(cls, models, categories, computationDir, storeFile):
+        """
+        Load `storeFile` if it holds the requested models and categories and is more recent than all their json,
+        else read the json with `fromJson` and rewrite `storeFile`.
+        :return: ResultsStore
+        """
+        if os.path.isfile(storeFile):
+            store = cls.load(storeFile)
+            if store._isUpToDate(models, categories, computationDir, os.path.getmtime(storeFile)):
+                return store
+        store = cls.fromJson(models, categories, computationDir)
+        store.save(storeFile)
+        return store
+
+    def _isUpToDate(self, models, categories, computationDir, storeTime):
+        """
+        :return: True if the store holds exactly the given models and categories and no json was written after `storeTime`
+        """
+        if self.models != list(models) or self.categories != list(categories):
+            return False
+        available = self.available
+        for m, model in enumerate(models):
+            for c, category in enumerate(categories):
+                file = model + "/" + computationDir + category + '.json'
+                if os.path.isfile(file):
+                    if os.path.getmtime(file) >= storeTime or not available[m, c]:
+                        return False
+                elif available[m, c]:
+                    return False
+        return True
+
+    @property
+    def available(self):
+        """
+        :return: [MxC] True where the model has results for the category
+        """
+        return ~np.isnan(self.AP).any(axis=-1) if self.AP.shape[-1] else np.zeros(self.AP.shape[:2], dtype=bool)
+
+    def has(self, model, category):
+        """
+        :return: True if the model has results for the category
+        """
+        return bool(self.available[self.models.index(model), self.categories.index(category)])
+
+    def curve(self, model, category):
+        """
+        :return: iou, AP, fn, numberInstances of a model and a category, in the same shape as `readCurve`
+        """
+        m = self.models.index(model)
+        c = self.categories.index(category)
+        return self.iou, self.AP[m, c], self.FN[m, c], int(self.instances[m, c])
+
+    def bestThresholds(self):
+        """
+        IoU threshold maximising the AP of each model and category. On equality the greatest threshold is kept.
+        :return: [MxC] thresholds, NaN where there is no result
+        """
+        T = len(self.iou)
+        if T == 0:
+            return np.full(self.AP.shape[:2], np.nan)
+        AP = np.where(np.isnan(self.AP), -np.inf, self.AP)
+        idx = T - 1 - np.argmax(AP[..., ::-1], axis=-1)
+        return np.where(self.available, self.iou[idx], np.nan)
+
+    def overallSums(self, weights=None):
+        """
+        Sum over the categories of each formula of `optimisedNMS.overallArgmax`, for every model:
+
+        - sum_{cat}AP(cat,iou)
+        - sum_{cat}AP(cat,iou)*var(AP(cat))
+        - sum_{cat}AP(cat,iou)*weight(cat)  for each weight vector
+
+        Categories without result for a model are left out of its sums.
+        :param weights: [WxC] weight vectors, or [C]. If None each category has a weight of 1
+        :return: dictionnary {"AP": [MxT], "AP*var": [MxT], "AP*weight": [MxWxT]}
+        """
+        AP = np.where(self.available[..., None], self.AP, 0.)
+        if weights is None:
+            weights = np.ones((1, len(self.categories)))
+        weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+        return {
+            "AP": AP.sum(axis=1),
+            "AP*var": (AP * np.var(AP, axis=-1, keepdims=True)).sum(axis=1),
+            "AP*weight": np.einsum('wc,mct->mwt', weights, AP),
+        }
+
+    def overallArgmax(self, weights=None):
+        """
+        argmax over the IoU thresholds of each sum of `overallSums`. On equality the smallest threshold is kept.
+        :param weights: [WxC] weight vectors, or [C]. If None each category has a weight of 1
+        :return: dictionnary {"Normal Distribution": [M], "Weight with variance": [M], "Weighted by user": [MxW]}
+        """
+        sums = self.overallSums(weights)
+        return {
+            "Normal Distribution": self.iou[np.argmax(sums["AP"], axis=-1)],
+            "Weight with variance": self.iou[np.argmax(sums["AP*var"], axis=-1)],
+            "Weighted by user": self.iou[np.argmax(sums["AP*weight"], axis=-1)],
+        }
@@ -0,0 +1,295 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import socket
+import time
+import numpy as np
+from nmsAnalysis import nmsAnalysis
+from groundTruthFN import GroundTruthFN
+from bootstrap import saveImageStatistics, mergeImageStatistics, resampledPrecision
+
+###############################################################################
+
+# Folders of the queue, a job moves from one to the next with an atomic rename.
+TODO, RUNNING, DONE, PARTIALS = "todo", "running", "done", "partials"
+
+
+class ShardQueue:
+
+    #The goal of this class is to share the shards of an analysis in between workers through a folder, e.g on a network
+    #file system mounted by every machine. Each job is a json file, claimed by renaming it from todo/ to running/:
+    #only one worker can succeed, so no lock nor server is needed.
+
+    #   Parameters:
+    #    directory:          - folder of the queue, with the subfolders todo/, running/, done/ and partials/ where the
+    #                           statistics of each shard are written
+
+    def __init__(self, directory):
+        """
+        Initialize ShardQueue, creating the folders if necessary
+        :param directory: folder of the queue
+        :return: None
+        """
+        self.directory = directory
+        for folder in (TODO, RUNNING, DONE, PARTIALS):
+            os.makedirs(os.path.join(directory, folder), exist_ok=True)
+
+    def _path(self, folder, job):
+        return os.path.join(self.directory, folder, job["id"] + ".json")
+
+    def partialFile(self, job):
+        """
+        :return: npz file where the statistics of `job` are written
+        """
+        return os.path.join(self.directory, PARTIALS, job["id"] + ".npz")
+
+    def put(self, job):
+        """
+        Add `job` to the queue unless it is already queued, running or done.
+        :return: True if the job was added
+        """
+        if any(os.path.isfile(self._path(folder, job)) for folder in (TODO, RUNNING, DONE)):
+            return False
+        tmpFile = self._path(TODO, job) + ".{}.tmp".format(os.getpid())
+        with open(tmpFile, "w") as fs:
+            json.dump(job, fs, indent=1)
+        os.replace(tmpFile, self._path(TODO, job))
+        return True
+
+    def claim(self):
+        """
+        Take the first job waiting in todo/ and move it to running/.
+        :return: the job, None if no job is waiting
+        """
+        for name in sorted(os.listdir(os.path.join(self.directory, TODO))):
+            if not name.endswith(".json"):
+                continue
+            running = os.path.join(self.directory, RUNNING, name)
+            try:
+                os.rename(os.path.join(self.directory, TODO, name), running)
+            except OSError:  # claimed by another worker
+                continue
+            os.utime(running)
+            with open(running, "r") as fs:
+                return json.load(fs)
+        return None
+
+    def complete(self, job):
+        """
+        Move `job` from running/ to done/, its statistics must be in `partialFile(job)`.
+        :return: None
+        """
+        os.rename(self._path(RUNNING, job), self._path(DONE, job))
+
+    def release(self, job):
+        """
+        Give back `job` to the queue, e.g when the worker failed.
+        :return: None
+        """
+        os.rename(self._path(RUNNING, job), self._path(TODO, job))
+
+    def requeue(self, timeout):
+        """
+        Give back to the queue the jobs running for more than `timeout` seconds, left by a worker that died.
+        :return: number of jobs given back
+        """
+        count = 0
+        for running in glob.glob(os.path.join(self.directory, RUNNING, "*.json")):
+            if time.time() - os.path.getmtime(running) > timeout:
+                try:
+                    os.rename(running, os.path.join(self.directory, TODO, os.path.basename(running)))
+                    count += 1
+                except OSError:
+                    continue
+        return count
+
+    def status(self):
+        """
+        :return: dictionnary {"todo", "running", "done"} with the number of jobs in each folder
+        """
+        return {folder: len(glob.glob(os.path.join(self.directory, folder, "*.json"))) for folder in (TODO, RUNNING, DONE)}
+
+    def doneJobs(self):
+        """
+        :return: list of the jobs done
+        """
+        jobs = list()
+        for done in sorted(glob.glob(os.path.join(self.directory, DONE, "*.json"))):
+            with open(done, "r") as fs:
+                jobs.append(json.load(fs))
+        return jobs
+
+
+def _settings(analyser):
+    """
+    :param analyser: nmsAnalysis or GroundTruthFN
+    :return: dictionnary with what a worker needs to build the same analyser
+    """
+    if isinstance(analyser, GroundTruthFN):
+        return {"kind": "GroundTruthFN", "annotationPath": analyser.annotationPath, "dataType": analyser.dataType,
+                "number_IoU_thresh": analyser.number_IoU_thresh}
+    return {"kind": "nmsAnalysis", "annotationPath": analyser.annotationPath,
+            "number_IoU_thresh": analyser.number_IoU_thresh, "with_train": analyser.with_train, "iouType": analyser.iouType}
+
+
+def _analyser(settings, analysers):
+    """
+    Build the analyser described by `settings`, reused from `analysers` if it was already built by the worker.
+    :return: nmsAnalysis or GroundTruthFN
+    """
+    key = json.dumps(settings, sort_keys=True)
+    if key not in analysers:
+        if settings["kind"] == "GroundTruthFN":
+            analyser = GroundTruthFN(settings["annotationPath"], settings["dataType"], catFocus=[],
+                                     number_IoU_thresh=settings["number_IoU_thresh"])
+        else:
+            analyser = nmsAnalysis([], None, settings["annotationPath"], catFocus=[],
+                                   number_IoU_thresh=settings["number_IoU_thresh"])
+            analyser.with_train = settings["with_train"]
+            analyser.iouType = settings["iouType"]
+        analysers[key] = analyser
+    return analysers[key]
+
+
+def planShards(analyser, queueDirectory, numberShards):
+    """
+    Split the images of every model and category of `analyser` in `numberShards` shards and queue one job per shard.
+    The shards are consecutive slices of the sorted image ids, so that the merge of `reduceShards` ranks the
+    detections exactly as `getClassAP` does.
+    Planning again the same analysis does not queue the jobs already queued, running or done.
+
+    :param analyser: nmsAnalysis or GroundTruthFN, with the attributes changed after initialization already set
+    :param queueDirectory: folder of the `ShardQueue`
+    :return: number of jobs added
+    """
+    queue = ShardQueue(queueDirectory)
+    settings = _settings(analyser)
+    models = [None] if settings["kind"] == "GroundTruthFN" else analyser.models
+    count = 0
+    for model in models:
+        for category in analyser.categories:
+            analyser.getImgClass(category)
+            imgIds = sorted(img["id"] for img in analyser._study["img"])
+            shards = [shard for shard in np.array_split(imgIds, numberShards) if len(shard)]
+            group = hashlib.sha1(json.dumps([settings, model, category], sort_keys=True).encode()).hexdigest()[:16]
+            for index, shard in enumerate(shards):
+                job = {"id": "{}-{:04d}".format(group, index), "group": group, "shard": index, "shards": len(shards),
+                       "settings": settings, "modelPath": model, "category": category, "imgIds": shard.tolist()}
+                count += queue.put(job)
+    return count
+
+
+def runJob(job, partialFile, analysers=None):
+    """
+    Evaluate the shard of `job` and write its statistics in `partialFile`, see `nmsAnalysis.shardStatistics`.
+    :param analysers: dictionnary of the analysers already built by the worker
+    :return: None
+    """
+    analyser = _analyser(job["settings"], dict() if analysers is None else analysers)
+    if job["modelPath"] is not None and analyser._study["modelPath"] != job["modelPath"]:
+        analyser._study["modelPath"] = job["modelPath"]
+        analyser.load_all_output_dict()
+    analyser._study["catStudied"] = job["category"]
+    analyser.getImgClass(job["category"])
+    imgIds, statistics, FN, instances = analyser.shardStatistics(job["imgIds"])
+    tmpFile = "{}.{}.tmp.npz".format(partialFile[:-len(".npz")], os.getpid())
+    saveImageStatistics(tmpFile, imgIds, analyser.iou_thresholdXaxis, statistics,
+                        falseNegatives=FN, numberInstances=instances)
+    os.replace(tmpFile, partialFile)
+
+
+def runWorker(queueDirectory, wait=False, poll=10., timeout=None):
+    """
+    Process the jobs of the queue until none is left. Several workers can run at once, on one or many machines,
+    from the same working directory so that the relative paths of the jobs are the same.
+
+    :param queueDirectory: folder of the `ShardQueue`
+    :param wait: if set to True wait for the jobs running elsewhere instead of returning, in order to take them back
+                 if their worker dies
+    :param poll: number of seconds in between two looks at the queue when waiting
+    :param timeout: if given, the jobs running for more than `timeout` seconds are given back to the queue
+    :return: number of jobs processed
+    """
+    queue = ShardQueue(queueDirectory)
+    analysers = dict()
+    count = 0
+    while True:
+        if timeout is not None:
+            queue.requeue(timeout)
+        job = queue.claim()
+        if job is None:
+            if not wait or queue.status()[RUNNING] == 0:
+                return count
+            time.sleep(poll)
+            continue
+        print("{} processes shard {}/{} of {}".format(socket.gethostname(), job["shard"] + 1, job["shards"], job["category"]))
+        try:
+            runJob(job, queue.partialFile(job), analysers)
+        except BaseException:
+            queue.release(job)
+            raise
+        queue.complete(job)
+        count += 1
+
+
+def reduceShards(queueDirectory):
+    """
+    Merge the statistics of the shards of every category whose shards are all done and write the results where
+    `runAnalysis` would: the json of the AP and false negatives, and for `nmsAnalysis` the image statistics
+    and the precision to recall.
+
+    :param queueDirectory: folder of the `ShardQueue`
+    :return: list of (modelPath, category) written, modelPath is None for `GroundTruthFN`
+    """
+    queue = ShardQueue(queueDirectory)
+    groups = dict()
+    for job in queue.doneJobs():
+        groups.setdefault(job["group"], list()).append(job)
+    analysers = dict()
+    written = list()
+    for jobs in groups.values():
+        jobs = sorted(jobs, key=lambda job: job["shard"])
+        job = jobs[0]
+        if len(jobs) < job["shards"]:
+            continue
+        data = mergeImageStatistics([queue.partialFile(job) for job in jobs])
+        T, N = len(data["iou_threshold"]), len(data["image_ids"])
+        # COCOeval leaves the precision to -1 without instances
+        precisions = [np.nan_to_num(resampledPrecision(data, t, np.ones((1, N)))[0], nan=-1.) for t in range(T)]
+        AP = [float(np.mean(precision)) for precision in precisions]
+
+        analyser = _analyser(job["settings"], analysers)
+        analyser._study["modelPath"] = job["modelPath"]
+        analyser._study["catStudied"] = job["category"]
+        analyser.writeClassAP(AP, data["false_negatives"].tolist(), data["number_instances"])
+        if job["settings"]["kind"] == "nmsAnalysis":
+            statistics = {key: value for key, value in data.items() if key not in ("false_negatives", "number_instances")}
+            np.savez_compressed(analyser._studyFolder("image_statistics") + job["category"].replace(' ', '_') + ".npz", **statistics)
+            analyser._study["precisions"] = precisions
+            analyser.savePrecisionToRecall()
+        written.append((job["modelPath"], job["category"]))
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process or reduce the shards queued by `planShards`.")
+    parser.add_argument("command", choices=["worker", "reduce", "status"])
+    parser.add_argument("queue", help="folder of the queue")
+    parser.add_argument("--wait", action="store_true", help="wait for the jobs running on other workers")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds after which a running job is given back")
+    args = parser.parse_args()
+    if args.command == "worker":
+        print("{} jobs processed".format(runWorker(args.queue, wait=args.wait, timeout=args.timeout)))
+    elif args.command == "reduce":
+        for modelPath, category in reduceShards(args.queue):
+            print("{} {}".format(category, "" if modelPath is None else modelPath))
+    else:
+        print(ShardQueue(args.queue).status())
@@ -0,0 +1,157 @@
+__author__ = 'noahsfi'
+
+###############################################################################
+
+# import the necessary packages
+
+import json
+import os
+import numpy as np
+from nmsAnalysis import nmsAnalysis
+from optimised_nms import writeThresholdMap
+from resultsStore import ResultsStore
+from bootstrap import saveImageStatistics, mergeImageStatistics, resampledPrecision
+
+###############################################################################
+
+
+class StreamingAnalysis:
+
+    #The goal of this class is to keep the optimal IoU thresholds of a model up to date while new labelled validation
+    #images arrive. Each batch of images is inferred and evaluated alone, then its per image statistics (see `bootstrap`)
+    #are folded into one accumulator per category, from which the AP of every threshold is recomputed without
+    #rerunning anything on the images seen before.
+
+    #   Parameters:
+    #    modelPath:          - path redirecting to an OD model
+    #    number_IoU_thresh:  - number of different IoU treshold to analyse in between 0.2 and 0.9
+    #    directory:          - folder modelPath/nms_analysis/stream/ containing:
+    #                           detections/{batch}.json the inferences of each batch, in the format of all_output_dict.json
+    #                           batches/{batch}/{category}.npz the statistics of each batch
+    #                           accumulators/{category}.npz the statistics of every image folded so far
+    #                           state.json the batches folded and the id of each category
+    #                           results.npz the `ResultsStore` of the last update
+    #    profiler, metrics:  - given to the `nmsAnalysis` of each batch
+
+    def __init__(self, modelPath, number_IoU_thresh=50):
+        """
+        Initialize StreamingAnalysis, reading the state of the previous updates if any
+        :param modelPath: path redirecting to an OD model
+        :param number_IoU_thresh: number of different IoU treshold to analyse in between 0.2 and 0.9
+        :return: None
+        """
+        self.modelPath = modelPath
+        self.number_IoU_thresh = number_IoU_thresh
+        self.iou_thresholdXaxis = np.linspace(0.2, 0.9, number_IoU_thresh)
+        self.directory = "{}/nms_analysis/stream/".format(modelPath)
+        for folder in ("detections", "batches", "accumulators"):
+            os.makedirs(self.directory + folder, exist_ok=True)
+        self.state = {"batches": list(), "categories": dict()}
+        if os.path.isfile(self.directory + "state.json"):
+            with open(self.directory + "state.json", "r") as fs:
+                self.state = json.load(fs)
+        self._model = None  # TF model, loaded at the first batch to infer
+
+        # Can be changed after initialization
+        self.profiler = None
+        self.metrics = None
+
+    def _accumulatorFile(self, category):
+        return self.directory + "accumulators/" + category.replace(' ', '_') + ".npz"
+
+    def loadDetections(self, analyser, batch):
+        """
+        Infer the images of the batch containing a category, or read the inferences if the batch was already inferred.
+        :param analyser: nmsAnalysis of the batch
+        :return: dictionnary in the format of all_output_dict.json
+        """
+        filename = self.directory + "detections/{}.json".format(batch)
+        if os.path.isfile(filename):
+            with open(filename, "r") as fs:
+                return json.load(fs)
+        if self._model is None:
+            self._model = analyser.loadModel(self.modelPath)
+        analyser._study["model"] = self._model
+        all_output_dict = analyser.computeInferenceBbox(fileNames=analyser.imagesToInfer(analyser.categories, dict()))
+        with open(filename, "w") as fs:
+            json.dump(all_output_dict, fs, indent=1)
+        return all_output_dict
+
+    def update(self, imagesPath, annotationPath, batch=None):
+        """
+        Fold a batch of new images in the accumulators and publish the updated thresholds, see `publish`.
+        Only the images of the batch are inferred and evaluated. The image ids must be unique across the batches,
+        the images of a category already folded are left out.
+
+        :param imagesPath: folder containing the images of the batch in the jpg format
+        :param annotationPath: annotation file of the images of the batch
+        :param batch: name of the batch, by default the name of the annotation file
+        :return: ResultsStore with the AP of every category folded so far
+        """
+        if batch is None:
+            batch = os.path.splitext(os.path.basename(annotationPath))[0]
+        analyser = nmsAnalysis([self.modelPath], imagesPath, annotationPath, number_IoU_thresh=self.number_IoU_thresh)
+        if self.profiler is not None:
+            analyser.profiler = self.profiler
+        if self.metrics is not None:
+            analyser.metrics = self.metrics
+        analyser._study["modelPath"] = self.modelPath
+        analyser._study["all_output_dict"] = self.loadDetections(analyser, batch)
+
+        os.makedirs(self.directory + "batches/" + batch, exist_ok=True)
+        for category in analyser.categories:
+            analyser._study["catStudied"] = category
+            analyser.getImgClass(category)
+            accumulatorFile = self._accumulatorFile(category)
+            folded = set(np.load(accumulatorFile)["image_ids"].tolist()) if os.path.isfile(accumulatorFile) else set()
+            imgIds = [img["id"] for img in analyser._study["img"] if img["id"] not in folded]
+            if not imgIds:
+                continue
+            imgIds, statistics, FN, instances = analyser.shardStatistics(imgIds)
+            batchFile = self.directory + "batches/{}/{}.npz".format(batch, category.replace(' ', '_'))
+            saveImageStatistics(batchFile, imgIds, self.iou_thresholdXaxis, statistics,
+                                falseNegatives=FN, numberInstances=instances)
+            if folded:
+                accumulator = mergeImageStatistics([accumulatorFile, batchFile])
+            else:
+                accumulator = dict(np.load(batchFile))
+            tmpFile = accumulatorFile[:-len(".npz")] + ".tmp.npz"
+            np.savez_compressed(tmpFile, **accumulator)
+            os.replace(tmpFile, accumulatorFile)
+            self.state["categories"][category] = int(analyser._study["catId"])
+
+        if batch not in self.state["batches"]:
+            self.state["batches"].append(batch)
+        with open(self.directory + "state.json", "w") as fs:
+            json.dump(self.state, fs, indent=1)
+        return self.publish()
+
+    def publish(self):
+        """
+        Recompute the AP of every threshold from the accumulators and write:
+
+        - modelPath/nms_analysis/iouThreshmap.pbtxt, in the format of `optimisedNMS.writeMapIoU`
+        - modelPath/nms_analysis/stream/results.npz, the `ResultsStore` of the model
+
+        :return: ResultsStore
+        """
+        categories = sorted(self.state["categories"])
+        T = self.number_IoU_thresh
+        AP = np.full((1, len(categories), T), np.nan)
+        FN = np.full((1, len(categories), T), -1, dtype=np.int64)
+        instances = np.full((1, len(categories)), -1, dtype=np.int64)
+        for c, category in enumerate(categories):
+            data = dict(np.load(self._accumulatorFile(category)))
+            N = len(data["image_ids"])
+            for t in range(T):
+                # COCOeval leaves the precision to -1 without instances
+                AP[0, c, t] = np.mean(np.nan_to_num(resampledPrecision(data, t, np.ones((1, N)))[0], nan=-1.))
+            FN[0, c] = data["false_negatives"]
+            instances[0, c] = data["number_instances"]
+        store = ResultsStore([self.modelPath], categories, self.iou_thresholdXaxis, AP, FN, instances)
+        store.save(self.directory + "results.npz")
+        bestThresholds = store.bestThresholds()[0]
+        writeThresholdMap("{}/nms_analysis/iouThreshmap.pbtxt".format(self.modelPath),
+                          [(self.state["categories"][category], category, bestThresholds[c])
+                           for c, category in enumerate(categories)])
+        return store